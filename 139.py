@@ -12,18 +12,45 @@ import os
 import sys
 import json
 import time
+import math
 import random
 import logging
 import requests
 import threading
 import datetime
 import io
+import gc
+import re
+import zlib
+import codecs
+import sqlite3
+import queue
+import heapq
+import signal
+import multiprocessing
+import itertools
+import hmac
+import secrets
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
 from matplotlib.font_manager import FontProperties
 from PIL import Image, ImageDraw, ImageFont
-from typing import Dict, Any, List, Tuple, Union, Optional, Set
+from typing import Dict, Any, List, Tuple, Union, Optional, Set, Iterator
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import orjson  # 可选依赖，用于加速快照和日志的编解码
+except ImportError:
+    orjson = None
 
 # 设置matplotlib字体，避免中文乱码
 matplotlib.use('Agg')  # 非交互式后端
@@ -45,8 +72,75 @@ logger = logging.getLogger(__name__)
 TOKEN = os.environ.get("BOT_TOKEN")
 API_URL = f"https://api.telegram.org/bot{TOKEN}"
 
-# 定义持久化数据文件
-DATA_FILE = "data/user_data.json"
+# Telegram API 连接池大小（应不少于同时发送请求的线程数），以及连接和读取超时（秒）
+# getUpdates 长轮询的读取超时为轮询时间再加上 API_READ_TIMEOUT
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", "32"))
+API_CONNECT_TIMEOUT = 5
+API_READ_TIMEOUT = 30
+
+# Telegram 发送频率限制（令牌桶）：全局每秒 30 条，私聊每秒 1 条，群组每分钟 20 条；桶容量允许短时突发
+# 仍然收到 429 时按响应中的 retry_after 暂停该聊天，然后重试，最多重试 API_MAX_RETRIES 次
+API_GLOBAL_RATE = 30.0
+API_GLOBAL_BURST = 30
+API_PRIVATE_CHAT_RATE = 1.0
+API_PRIVATE_CHAT_BURST = 3
+API_GROUP_CHAT_RATE = 20 / 60
+API_GROUP_CHAT_BURST = 20
+API_MAX_RETRIES = 3
+
+# 定义持久化数据文件（旧版 data/user_data.json 会在首次启动时自动读取）
+DATA_FILE = "data/user_data.snap"
+
+# 快照文件头，用于区分记录流格式和旧版缩进 JSON
+SNAPSHOT_MAGIC = b"DICESNAP1\n"
+
+# 保留的快照代数；每代快照以其包含的最大日志序号命名（user_data.snap.<序号>）
+# 最新一代损坏时回退到上一代，并重放之后保留的日志段
+SNAPSHOT_GENERATIONS = 3
+
+# 每个用户保留的历史记录条数，以及内存中缓存历史记录的用户数
+# 用户历史单独存放在快照旁的 .history 文件中，按需读取
+USER_HISTORY_LIMIT = 50
+HISTORY_CACHE_SIZE = 1000
+
+# 加载快照时输出进度的间隔（秒）
+LOAD_PROGRESS_INTERVAL = 5.0
+
+# 存储后端: "json"（快照+日志）或 "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_FILE = "data/user_data.db"
+
+# 日志（追加写）批量落盘间隔（秒）和批量大小
+JOURNAL_FLUSH_INTERVAL = 1.0
+JOURNAL_BATCH_SIZE = 200
+
+# 日志超过此大小时压缩为快照（字节）
+COMPACT_JOURNAL_BYTES = 64 * 1024 * 1024
+
+# SQLite WAL 检查点间隔（秒）
+SQLITE_CHECKPOINT_INTERVAL = 300
+
+# 未领完的红包过期时间（退还给发送者）和预设骰子点数的过期时间（秒），以及检查间隔
+HONGBAO_EXPIRE_SECONDS = 24 * 60 * 60
+FIXED_DICE_EXPIRE_SECONDS = 24 * 60 * 60
+EXPIRE_CHECK_INTERVAL = 60
+
+# 排行榜快照的最短重建间隔（秒）：用户数据变化后，最多每隔这么久重新排序一次
+LEADERBOARD_REFRESH_INTERVAL = 1.0
+
+# 用户锁的分段数：用户按 user_id 散列到固定数量的锁上
+# 锁顺序（必须按此顺序获取，避免死锁）：
+#   1. 群组锁（每个群组一把，同时持有多把时按群组ID升序）
+#   2. 红包锁
+#   3. 用户锁（同一时刻只持有一把；结算多个用户时逐个获取和释放）
+#   4. 统计锁（全局统计、全局历史、群组计数器和日志缓冲区）
+#   5. 历史文件锁、SQLite 连接锁（叶子锁，持有时不再获取其它锁）
+# 落盘和压缩需要一致的数据视图时按上述顺序获取全部锁
+USER_LOCK_STRIPES = 256
+
+# 锁分析：设置环境变量 LOCK_PROFILING=1 后记录各锁在各调用位置的等待时间和持有时间
+# 管理员发送 /lockstats 查看，退出时写入日志；未开启时使用普通锁，没有额外开销
+LOCK_PROFILING = os.environ.get("LOCK_PROFILING") == "1"
 
 # 反水比例 (0.5%)
 REBATE_RATE = 0.005
@@ -77,6 +171,49 @@ GROUP_GAME_ROLLING = "ROLLING"
 # 群组游戏等待时间（秒）
 GROUP_GAME_WAIT_TIME = 30
 
+# 倒计时检查间隔（秒），最后10秒编辑倒计时消息的时刻，以及仅人数变化时两次编辑的最短间隔（秒）
+COUNTDOWN_TICK = 1
+COUNTDOWN_FINAL_MARKS = (10, 5, 3, 1)
+COUNTDOWN_MIN_EDIT_INTERVAL = 3
+
+# 群组投注确认方式: "each"（每条投注消息单独回复）或 "batch"（一段时间内的投注确认合并成一条消息发送）
+# 投注失败的提示在两种方式下都立即回复
+BET_CONFIRM_MODE = os.environ.get("BET_CONFIRM_MODE", "each")
+# batch 方式下合并投注确认的时间窗口（秒），投注截止时也会立即发送
+BET_CONFIRM_WINDOW = 5
+
+# 处理群组邮箱的工作线程数（与群组数量无关）
+GROUP_WORKER_THREADS = 8
+
+# 发送 Telegram 请求的工作线程数，以及排队请求的上限（达到上限时提交方等待）
+OUTBOUND_WORKER_THREADS = 8
+OUTBOUND_QUEUE_LIMIT = 5000
+
+# 运行模式: "threaded"（工作线程池按会话分发更新）
+# 或 "sharded"（主进程拉取更新，按会话ID散列分发到多个工作进程，共用一个 SQLite 文件）
+# 各模式下同一会话的更新都按顺序处理，不同会话并发处理
+RUNTIME_MODE = os.environ.get("RUNTIME_MODE", "threaded")
+
+# sharded 模式的工作进程数
+SHARD_PROCESSES = int(os.environ.get("SHARD_PROCESSES", str(os.cpu_count() or 4)))
+
+# threaded 模式下处理更新的工作线程数，以及待处理更新的上限（达到上限时暂停拉取新更新）
+UPDATE_WORKER_THREADS = int(os.environ.get("UPDATE_WORKER_THREADS", "16"))
+UPDATE_QUEUE_LIMIT = 1000
+
+# 更新来源: "polling"（getUpdates 长轮询）或 "webhook"（本地 HTTP 服务器接收 Telegram 推送）
+UPDATE_SOURCE = os.environ.get("UPDATE_SOURCE", "polling")
+
+# webhook 模式: Telegram 推送的公网 HTTPS 地址（由反向代理终止 TLS 后转发到本地监听地址）
+# 未设置密钥时每次启动随机生成，并在 setWebhook 时一起注册
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Telegram 同时推送的最大连接数，以及接受的最大请求体（字节）
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_MAX_BODY = 1 << 20
+
 # 高额投注阈值（达到此金额可以摇骰子）
 HIGH_ROLLER_THRESHOLD = 1000
 
@@ -404,121 +541,1062 @@ BET_CONFIRMATION_MESSAGE = """
 
 # ============== 数据管理 ==============
 
+def _empty_data() -> Dict[str, Any]:
+    """创建空的数据结构"""
+    return {
+        'users': {},
+        'game_history': [],
+        'chat_messages': [],
+        'global_stats': {
+            'total_games': 0,
+            'total_bets': 0,
+            'total_winnings': 0,
+            'biggest_win': {'user_id': None, 'amount': 0, 'date': None}
+        },
+        'group_game_counters': {},
+        'group_games': {},
+        'rebate_records': {},
+        'hongbao': {},
+        'group_fixed_dice': {},
+        'journal_seq': 0,
+        # 用户历史：快照的历史文件、其中每个用户的 [偏移, 长度]，以及尚未合并进文件的游戏日志记录
+        'history_file': None,
+        'history_index': {},
+        'history_tail': {}
+    }
+
+def _dumps_compact(obj: Any) -> bytes:
+    """紧凑编码为一行 JSON（有 orjson 时使用 orjson）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _loads(data: bytes) -> Any:
+    """解码一行 JSON（有 orjson 时使用 orjson）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _journal_file_for(data_file: str) -> str:
+    """快照对应的日志文件路径"""
+    return os.path.splitext(data_file)[0] + ".journal"
+
+def _legacy_data_file(data_file: str) -> str:
+    """快照对应的旧版缩进 JSON 数据文件路径"""
+    return os.path.splitext(data_file)[0] + ".json"
+
+@contextmanager
+def _gc_paused():
+    """批量创建大量字典时暂停循环垃圾回收，避免反复全量扫描"""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def _peak_rss_mb() -> float:
+    """当前进程的峰值常驻内存（MB），平台不支持时返回0"""
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class LockProfiler:
+    """按（锁名, 调用位置）统计等待时间和持有时间的直方图"""
+
+    # 直方图按微秒取 2 的幂分桶：第 i 桶为 [2^(i-1), 2^i) 微秒，最后一桶包含更长的时间
+    BUCKETS = 24
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(锁名, 调用位置): [次数, 等待总时间, 持有总时间, 最长等待, 最长持有, 等待直方图, 持有直方图]}
+        self._stats = {}
+
+    @classmethod
+    def _bucket(cls, seconds: float) -> int:
+        return min(int(seconds * 1e6).bit_length(), cls.BUCKETS - 1)
+
+    def record(self, name: str, site: str, wait: float, hold: float) -> None:
+        """记录一次获取锁的等待时间和持有时间（秒）"""
+        with self._lock:
+            stats = self._stats.get((name, site))
+            if stats is None:
+                stats = self._stats[(name, site)] = [0, 0.0, 0.0, 0.0, 0.0, [0] * self.BUCKETS, [0] * self.BUCKETS]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] += hold
+            stats[3] = max(stats[3], wait)
+            stats[4] = max(stats[4], hold)
+            stats[5][self._bucket(wait)] += 1
+            stats[6][self._bucket(hold)] += 1
+
+    @staticmethod
+    def _percentile_us(histogram: List[int], p: float) -> int:
+        """直方图的百分位数（取所在桶的上界，微秒）"""
+        target = sum(histogram) * p
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return 1 << bucket
+        return 1 << (len(histogram) - 1)
+
+    def dump(self, limit: int = 20) -> str:
+        """按总持有时间排序输出统计表"""
+        with self._lock:
+            rows = [(name, site, list(stats[:5]), list(stats[5]), list(stats[6]))
+                    for (name, site), stats in self._stats.items()]
+        if not rows:
+            return "暂无锁统计数据" if LOCK_PROFILING else "锁分析未开启（设置环境变量 LOCK_PROFILING=1）"
+        rows.sort(key=lambda row: row[2][2], reverse=True)
+        lines = ["锁/调用位置  次数  等待总计ms 等待p99us 等待最长ms  持有总计ms 持有p99us 持有最长ms"]
+        for name, site, (count, wait, hold, max_wait, max_hold), wait_hist, hold_hist in rows[:limit]:
+            lines.append(f"{name}/{site}  {count}  {wait * 1000:.1f} {self._percentile_us(wait_hist, 0.99)} "
+                         f"{max_wait * 1000:.1f}  {hold * 1000:.1f} {self._percentile_us(hold_hist, 0.99)} "
+                         f"{max_hold * 1000:.1f}")
+        return "\n".join(lines)
+
+LOCK_PROFILER = LockProfiler()
+
+# 查找调用位置时跳过的锁内部函数
+_LOCK_INTERNAL_FUNCTIONS = frozenset(('acquire', 'release', '__enter__', '__exit__', '_transaction', '_lock_call_site'))
+
+def _lock_call_site() -> str:
+    """获取锁的业务代码位置（函数名:行号）"""
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_code.co_name in _LOCK_INTERNAL_FUNCTIONS
+                                 or frame.f_code.co_filename == contextmanager.__code__.co_filename):
+        frame = frame.f_back
+    return f"{frame.f_code.co_name}:{frame.f_lineno}" if frame is not None else "?"
+
+class _ProfiledLock:
+    """记录等待时间和持有时间的可重入锁（只在开启锁分析时使用），重入时只统计最外层"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        started = time.perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        local = self._local
+        depth = getattr(local, 'depth', 0)
+        if depth == 0:
+            local.acquired = time.perf_counter()
+            local.wait = local.acquired - started
+            local.site = _lock_call_site()
+        local.depth = depth + 1
+        return True
+
+    def release(self) -> None:
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            LOCK_PROFILER.record(self._name, local.site, local.wait, time.perf_counter() - local.acquired)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+def _make_lock(name: str):
+    """创建可重入锁；开启锁分析时创建带统计的锁"""
+    return _ProfiledLock(name) if LOCK_PROFILING else threading.RLock()
+
+class _LockSet:
+    """
+    按顺序获取一组锁、按相反顺序释放
+    锁由生成器逐个给出，后面的锁可以在持有前面的锁之后再确定
+    """
+
+    def __init__(self, locks_fn):
+        self._locks_fn = locks_fn
+        self._held = threading.local()
+
+    def __enter__(self):
+        if LOCK_PROFILING:
+            started = time.perf_counter()
+        acquired = []
+        try:
+            for lock in self._locks_fn():
+                lock.acquire()
+                acquired.append(lock)
+        except BaseException:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+        # 可重入：每层 with 记录自己获取的锁
+        stack = getattr(self._held, 'stack', None)
+        if stack is None:
+            stack = self._held.stack = []
+        stack.append(acquired)
+        if LOCK_PROFILING and len(stack) == 1:
+            self._held.acquired = time.perf_counter()
+            self._held.wait = self._held.acquired - started
+            self._held.site = _lock_call_site()
+        return self
+
+    def __exit__(self, *exc_info):
+        stack = self._held.stack
+        if LOCK_PROFILING and len(stack) == 1:
+            LOCK_PROFILER.record("全部锁", self._held.site, self._held.wait,
+                                 time.perf_counter() - self._held.acquired)
+        for lock in reversed(stack.pop()):
+            lock.release()
+        return False
+
+class _LoadProgress:
+    """加载快照时定期输出进度和峰值内存"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.total_bytes = max(os.path.getsize(path), 1)
+        self.started = self.reported = time.perf_counter()
+
+    def update(self, bytes_read: int, users: int) -> None:
+        now = time.perf_counter()
+        if now - self.reported >= LOAD_PROGRESS_INTERVAL:
+            self.reported = now
+            logger.info(f"正在加载 {self.path}: {bytes_read / self.total_bytes:.0%}, {users} 个用户, "
+                        f"峰值内存 {_peak_rss_mb():.0f} MB")
+
+    def done(self, users: int) -> None:
+        logger.info(f"已加载快照 {self.path}: {users} 个用户, 耗时 {time.perf_counter() - self.started:.2f} 秒, "
+                    f"峰值内存 {_peak_rss_mb():.0f} MB")
+
+class _HistoryWriter:
+    """
+    把旧格式用户记录中内嵌的历史逐个写入快照旁的历史文件，加载时不必把所有历史留在内存中
+    只有遇到内嵌历史时才创建文件
+    """
+
+    def __init__(self, history_file: str):
+        self.history_file = history_file
+        self.temp_file = history_file + '.tmp'
+        self.f = None
+        self.index = {}
+        self.offset = 0
+
+    def add(self, user_id_str: str, history: List[Dict[str, Any]]) -> None:
+        if self.f is None:
+            self.f = open(self.temp_file, 'wb')
+        line = _history_line(user_id_str, history)
+        self.f.write(line)
+        self.index[user_id_str] = [self.offset, len(line)]
+        self.offset += len(line)
+
+    def close(self, data: Dict[str, Any]) -> None:
+        """写完后原子替换历史文件，并让 data 指向它"""
+        if self.f is None:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.temp_file, self.history_file)
+        data['history_file'] = self.history_file
+        data['history_index'] = self.index
+
+    def discard(self) -> None:
+        if self.f is not None:
+            self.f.close()
+            os.remove(self.temp_file)
+
+class _JsonStream:
+    """
+    增量解析 JSON：按块读取文件，每次只解码一个值，内存占用与单个值的大小成正比
+    用于流式读取旧版缩进 JSON 数据文件
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        """读取下一块数据，丢弃已解析的部分；文件结束时返回False"""
+        chunk = self.f.read(self.CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.bytes_read += len(chunk)
+        self.buffer = self.buffer[self.pos:] + self._text_decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """跳过空白并返回下一个字符"""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("JSON 数据不完整")
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"JSON 格式错误: 位置 {self.bytes_read} 附近应为 {char!r}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """解码下一个完整的值；值可能被块边界截断（例如数字），所以值之后还需有数据或已到文件末尾"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _next_separator(self, close: str) -> bool:
+        """读取 ',' 或结束符，遇到结束符时返回False"""
+        char = self.peek()
+        self.pos += 1
+        if char == close:
+            return False
+        if char != ',':
+            raise ValueError(f"JSON 格式错误: 位置 {self.bytes_read} 附近应为 ',' 或 {close!r}")
+        return True
+
+    def iter_object(self):
+        """逐个产出对象的键，调用方在每次产出后必须用 value() 或嵌套迭代读取对应的值"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if not self._next_separator('}'):
+                return
+
+    def iter_array(self):
+        """逐个产出数组中的值"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if not self._next_separator(']'):
+                return
+
+def _stream_legacy_json(f, data: Dict[str, Any], history: _HistoryWriter, progress: _LoadProgress) -> Set[str]:
+    """流式读取旧版缩进 JSON 数据文件，逐个填充用户和游戏记录，返回文件中出现的顶层键"""
+    stream = _JsonStream(f)
+    keys = set()
+    for key in stream.iter_object():
+        keys.add(key)
+        if key == 'users' and stream.peek() == '{':
+            for user_id_str in stream.iter_object():
+                user = stream.value()
+                if user.get('history'):
+                    history.add(user_id_str, user['history'][-USER_HISTORY_LIMIT:])
+                user.pop('history', None)
+                data['users'][user_id_str] = user
+                progress.update(stream.bytes_read, len(data['users']))
+        elif key == 'game_history' and stream.peek() == '[':
+            data['game_history'].extend(stream.iter_array())
+        else:
+            value = stream.value()
+            if key in data:
+                data[key] = value
+    return keys
+
+def _read_snapshot(data_file: str) -> Dict[str, Any]:
+    """
+    逐条记录流式读取快照文件，文件不存在时返回空数据，文件损坏时抛出异常
+    根据文件头自动识别记录流格式和旧版缩进 JSON 格式；旧格式中内嵌的用户历史直接写入历史文件
+    峰值内存只比加载结果多出单条记录的大小
+    """
+    data = _empty_data()
+    if not os.path.exists(data_file):
+        return data
+
+    progress = _LoadProgress(data_file)
+    history = _HistoryWriter(data_file + '.history')
+    try:
+        with open(data_file, 'rb') as f, _gc_paused():
+            if f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                # 记录流格式：每行一条 [类型, ...] 记录，最后一行为 ['end', 记录数, CRC32]
+                count = 0
+                checksum = 0
+                bytes_read = len(SNAPSHOT_MAGIC)
+                for line in f:
+                    record = _loads(line)
+                    kind = record[0]
+                    if kind == 'end':
+                        if record[1] != count or record[2] != checksum:
+                            raise ValueError("快照校验失败")
+                        break
+                    count += 1
+                    checksum = zlib.crc32(line, checksum)
+                    bytes_read += len(line)
+                    if kind == 'user':
+                        user = record[2]
+                        if 'history' in user:
+                            history.add(record[1], user.pop('history')[-USER_HISTORY_LIMIT:])
+                        data['users'][record[1]] = user
+                        progress.update(bytes_read, len(data['users']))
+                    elif kind == 'rebate':
+                        data['rebate_records'][record[1]] = record[2]
+                    elif kind == 'game':
+                        data['game_history'].append(record[1])
+                    elif kind == 'hidx':
+                        data['history_file'] = data_file + '.history'
+                        data['history_index'] = record[1]
+                    elif kind == 'meta':
+                        data.update(record[1])
+                else:
+                    raise ValueError("快照不完整")
+            else:
+                f.seek(0)
+                keys = _stream_legacy_json(f, data, history, progress)
+                if 'group_game_counters' not in keys:
+                    # 旧版快照没有计数器，从历史记录统计
+                    counters = data['group_game_counters']
+                    for game in data['game_history']:
+                        if game.get('is_group_game') and game.get('group_id') is not None:
+                            group_id_str = str(game['group_id'])
+                            counters[group_id_str] = counters.get(group_id_str, 0) + 1
+    except BaseException:
+        history.discard()
+        raise
+
+    history.close(data)
+    progress.done(len(data['users']))
+    return data
+
+def _split_user_history(data: Dict[str, Any]) -> None:
+    """把旧格式用户记录中内嵌的历史移到待合并历史中，用户记录只保留标量字段"""
+    seq = data['journal_seq']
+    for user_id_str, user in data['users'].items():
+        history = user.pop('history', None)
+        if history:
+            data['history_tail'][user_id_str] = [{'seq': seq, 'data': record}
+                                                 for record in history[-USER_HISTORY_LIMIT:]]
+
+def _history_record(game_record: Dict[str, Any]) -> Dict[str, Any]:
+    """用户历史中的记录不包含用户ID和用户名"""
+    return {k: v for k, v in game_record.items() if k not in ('user_id', 'user_name')}
+
+def _read_history(f, history_index: Dict[str, List[int]], user_id_str: str) -> List[Dict[str, Any]]:
+    """从历史文件中读取一个用户的历史记录"""
+    position = history_index.get(user_id_str)
+    if position is None:
+        return []
+    f.seek(position[0])
+    line = f.read(position[1])
+    return _loads(line[line.index(b'\t') + 1:])
+
+def _history_line(user_id_str: str, records: List[Dict[str, Any]]) -> bytes:
+    """历史文件中的一行，格式为 user_id<TAB>[记录...]"""
+    return user_id_str.encode() + b'\t' + _dumps_compact(records) + b'\n'
+
+def _write_history(history_file: str, data: Dict[str, Any]) -> Dict[str, List[int]]:
+    """
+    合并上一代历史文件和待合并的历史记录，写出新的历史文件并 fsync
+    每行格式为 "user_id\t[记录...]"，没有新记录的用户直接复制原行，无需解析
+    返回：{user_id: [偏移, 长度]} 索引
+    """
+    tail = data['history_tail']
+    index = {}
+    offset = 0
+    temp_file = history_file + '.tmp'
+
+    def merged_line(user_id_str, records):
+        records = records + [_history_record(entry['data']) for entry in tail[user_id_str]]
+        return _history_line(user_id_str, records[-USER_HISTORY_LIMIT:])
+
+    with open(temp_file, 'wb') as out:
+        def write_line(user_id_str, line):
+            nonlocal offset
+            out.write(line)
+            index[user_id_str] = [offset, len(line)]
+            offset += len(line)
+
+        if data['history_file'] is not None:
+            with open(data['history_file'], 'rb') as f:
+                for line in f:
+                    separator = line.index(b'\t')
+                    user_id_str = line[:separator].decode()
+                    if user_id_str in tail:
+                        line = merged_line(user_id_str, _loads(line[separator + 1:]))
+                    write_line(user_id_str, line)
+        for user_id_str in tail:
+            if user_id_str not in index:
+                write_line(user_id_str, merged_line(user_id_str, []))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temp_file, history_file)
+    return index
+
+def _fsync_directory(path: str) -> None:
+    """fsync 文件所在目录，保证重命名本身已落盘"""
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _write_snapshot(data_file: str, data: Dict[str, Any]) -> None:
+    """
+    以记录流格式写快照，末尾附带记录数和 CRC32 校验
+    先写临时文件并 fsync，再原子替换并 fsync 目录，崩溃时不会留下不完整的快照
+    用户历史先合并写入快照旁的 .history 文件，写完后 data 指向新的历史文件
+    """
+    history_file = data_file + '.history'
+    history_index = _write_history(history_file, data)
+    temp_file = data_file + '.tmp'
+    meta = {key: data[key] for key in ('journal_seq', 'global_stats', 'group_game_counters',
+                                       'group_games', 'hongbao', 'group_fixed_dice', 'chat_messages')}
+
+    def records():
+        yield ['meta', meta]
+        yield ['hidx', history_index]
+        for user_id_str, user in data['users'].items():
+            yield ['user', user_id_str, user]
+        for user_id_str, rebate_record in data['rebate_records'].items():
+            yield ['rebate', user_id_str, rebate_record]
+        for entry in data['game_history']:
+            yield ['game', entry]
+
+    count = 0
+    checksum = 0
+    with open(temp_file, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        for record in records():
+            line = _dumps_compact(record) + b'\n'
+            f.write(line)
+            count += 1
+            checksum = zlib.crc32(line, checksum)
+        f.write(_dumps_compact(['end', count, checksum]) + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, data_file)
+    _fsync_directory(data_file)
+
+    data['history_file'] = history_file
+    data['history_index'] = history_index
+    data['history_tail'] = {}
+
+def _append_game_record(users: Dict[str, Any], game_history: List[Dict[str, Any]],
+                        history_tail: Dict[str, List[Dict[str, Any]]], entry: Dict[str, Any]) -> None:
+    """将游戏日志记录追加到全局历史，并加入用户的待合并历史"""
+    history_entry = entry['data']
+    user_id_str = history_entry['user_id']
+    if user_id_str in users:
+        pending = history_tail.setdefault(user_id_str, [])
+        pending.append(entry)
+        # 仅保留最近50条记录
+        del pending[:-USER_HISTORY_LIMIT]
+    
+    game_history.append(history_entry)
+    
+    # 仅保留最近1000条全局记录
+    del game_history[:-1000]
+
+def _copy_group_game(group_game: Dict[str, Any]) -> Dict[str, Any]:
+    """复制群组游戏状态用于锁外编码；单条投注追加后不再修改，只需复制列表"""
+    copied = dict(group_game)
+    copied['bets'] = {user_id_str: list(bets) for user_id_str, bets in group_game['bets'].items()}
+    if 'user_dice_values' in group_game:
+        copied['user_dice_values'] = list(group_game['user_dice_values'])
+    return copied
+
+def _copy_hongbao(hongbao_info: Dict[str, Any]) -> Dict[str, Any]:
+    """复制红包信息用于锁外编码，只有领取者列表会被修改"""
+    copied = dict(hongbao_info)
+    if 'receivers' in hongbao_info:
+        copied['receivers'] = list(hongbao_info['receivers'])
+    return copied
+
+def _apply_journal_entry(data: Dict[str, Any], entry: Dict[str, Any]) -> None:
+    """将一条日志记录应用到数据"""
+    op = entry['op']
+    if op == 'user':
+        # 用户记录是完整的标量字段，历史记录由 game 记录重建
+        data['users'][entry['id']] = entry['data']
+    elif op == 'game':
+        _append_game_record(data['users'], data['game_history'], data['history_tail'], entry)
+    elif op == 'stats':
+        data['global_stats'] = entry['data']
+    elif op == 'counter':
+        data['group_game_counters'][entry['id']] = entry['value']
+    elif op == 'round':
+        # 空闲的群组游戏没有需要恢复的内容
+        if entry['data']['state'] == GROUP_GAME_IDLE:
+            data['group_games'].pop(entry['id'], None)
+        else:
+            data['group_games'][entry['id']] = entry['data']
+    elif op == 'rebate':
+        data['rebate_records'][entry['id']] = entry['data']
+    elif op in ('hongbao', 'fixed_dice'):
+        # data 为 None 表示已删除
+        store = data['hongbao'] if op == 'hongbao' else data['group_fixed_dice']
+        if entry['data'] is None:
+            store.pop(entry['id'], None)
+        else:
+            store[entry['id']] = entry['data']
+    else:
+        logger.warning(f"未知的日志记录类型: {op}")
+
+def _replay_journal(data: Dict[str, Any], journal_file: str) -> int:
+    """重放日志中序号大于 data['journal_seq'] 的记录，返回重放条数"""
+    if not os.path.exists(journal_file):
+        return 0
+
+    replayed = 0
+    with open(journal_file, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = _loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时最后一行可能只写了一半，之后的内容不可信
+                logger.warning(f"日志记录不完整，停止重放: {line[:80]}")
+                break
+
+            # 已经包含在快照中的记录跳过
+            if entry['seq'] <= data['journal_seq']:
+                continue
+
+            _apply_journal_entry(data, entry)
+            data['journal_seq'] = entry['seq']
+            replayed += 1
+    return replayed
+
+def _numbered_files(path: str) -> List[Tuple[int, str]]:
+    """查找 <path>.<序号> 形式的文件，按序号升序返回 (序号, 路径)"""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        return []
+    prefix = os.path.basename(path) + '.'
+    found = []
+    for name in os.listdir(directory):
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isdigit():
+            found.append((int(suffix), os.path.join(directory, name)))
+    return sorted(found)
+
+def _rotated_journal_segments(journal_file: str, after_seq: int = -1) -> List[str]:
+    """已轮转的日志段，按序号排序；after_seq 用于跳过已完全包含在快照中的日志段"""
+    return [path for seq, path in _numbered_files(journal_file) if seq > after_seq]
+
+def _load_newest_snapshot(data_file: str) -> Dict[str, Any]:
+    """
+    按代从新到旧读取快照，跳过校验失败的代
+    没有分代快照时读取无编号的快照或旧版 JSON 文件；快照文件存在但全部损坏时抛出异常，避免以空数据启动
+    """
+    candidates = [path for _, path in reversed(_numbered_files(data_file))]
+    for path in (data_file, _legacy_data_file(data_file)):
+        if os.path.exists(path) and path not in candidates:
+            candidates.append(path)
+
+    for path in candidates:
+        try:
+            data = _read_snapshot(path)
+        except (ValueError, IOError) as e:
+            logger.error(f"快照损坏，尝试上一代: {path}: {e}")
+            continue
+        return data
+
+    if candidates:
+        raise RuntimeError(f"没有可用的快照: {', '.join(candidates)}")
+    return _empty_data()
+
+def _recover_data(data_file: str) -> Dict[str, Any]:
+    """读取最新的有效快照，并重放其后的所有日志段"""
+    started = time.perf_counter()
+    data = _load_newest_snapshot(data_file)
+    generation = data['journal_seq']
+
+    # 先重放已轮转但尚未合并的日志段，再重放当前日志
+    journal_file = _journal_file_for(data_file)
+    replayed = 0
+    for segment in _rotated_journal_segments(journal_file, generation) + [journal_file]:
+        replayed += _replay_journal(data, segment)
+    logger.info(f"数据恢复完成: 快照代 {generation}，重放 {replayed} 条日志记录，"
+                f"耗时 {time.perf_counter() - started:.2f} 秒")
+    return data
+
+def export_json(output_file: str = "data/user_data.export.json", data_file: str = DATA_FILE) -> None:
+    """将快照和日志导出为便于阅读的缩进 JSON（与旧版数据文件格式相同）"""
+    data = _recover_data(data_file)
+
+    # 把单独存放的历史记录放回用户记录中
+    history_fp = open(data['history_file'], 'rb') if data['history_file'] is not None else None
+    try:
+        for user_id_str, user in data['users'].items():
+            history = _read_history(history_fp, data['history_index'], user_id_str) if history_fp else []
+            history += [_history_record(entry['data']) for entry in data['history_tail'].get(user_id_str, [])]
+            user['history'] = history[-USER_HISTORY_LIMIT:]
+    finally:
+        if history_fp is not None:
+            history_fp.close()
+
+    exported = {key: data[key] for key in ('users', 'game_history', 'chat_messages', 'global_stats',
+                                            'group_game_counters', 'group_games', 'rebate_records',
+                                            'hongbao', 'group_fixed_dice', 'journal_seq')}
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(exported, f, ensure_ascii=False, indent=2)
+    logger.info(f"已导出 {len(data['users'])} 个用户到 {output_file}")
+
 class DataManager:
     """管理用户数据和游戏记录"""
 
     def __init__(self, data_file=DATA_FILE):
         self.data_file = data_file
-        self.lock = threading.RLock()
-        # 加载数据或创建新数据文件
+        self.journal_file = _journal_file_for(data_file)
+
+        # 分层锁，获取顺序见 USER_LOCK_STRIPES 处的说明
+        self._group_locks = {}
+        self._group_locks_lock = _make_lock("群组锁注册表")
+        self._hongbao_lock = _make_lock("红包锁")
+        self._user_locks = [_make_lock("用户锁") for _ in range(USER_LOCK_STRIPES)]
+        self._stats_lock = _make_lock("统计锁")
+        self._history_lock = _make_lock("历史文件锁")
+        # 全部锁：只用于落盘、加载、压缩等需要整个数据集一致视图的操作
+        self.lock = _LockSet(self._all_locks)
+
+        # 用户记录发布后不再修改（写时复制），读取无需加锁；每次发布递增版本号
+        self._user_versions = itertools.count(1)
+        self.users_version = 0
+        # 排行榜快照 {(metric, limit): (用户版本号, 生成时间, 前 limit 名)}，整体替换
+        self._leaderboards = {}
+
+        # 日志缓冲区：游戏记录直接追加，用户/统计等状态只标记为脏，落盘时合并写入
+        self._journal_seq = 0
+        self._journal_buffer = []
+        self._journal_io_lock = _make_lock("日志IO锁")
+        self._journal_event = threading.Event()
+        self._dirty_users = set()
+        self._dirty_groups = set()
+        self._dirty_games = set()
+        self._dirty_rebates = set()
+        self._dirty_hongbao = set()
+        self._dirty_fixed_dice = set()
+        self._dirty_stats = False
+
+        # 落盘统计
+        self.journal_bytes = 0
+        self.last_flush_duration = 0.0
+        self.last_flush_bytes = 0
+        self.last_recovery_duration = 0.0
+
+        # 用户历史按需从历史文件读取，最近访问的用户缓存在内存中
+        self._history_cache = OrderedDict()
+        self._history_fp = None
+
+        # 后台压缩线程
+        self._compact_lock = threading.Lock()
+        self._compact_thread = None
+
+        # 加载快照并重放日志
         self.load_data()
-
-        # 群组游戏状态
-        self.group_games = {}
-        
-        # 反水记录
-        self.rebate_records = {}
-        
-        # 红包信息存储
-        self.hongbao = {}
-        
-        # 每个群组的预设骰子点数 {chat_id: [dice1, dice2, dice3], ...}
-        self.group_fixed_dice = {}
+        self._last_expire_check = 0.0
+        self.expire_stale_entries()
 
         # 启动自动保存线程
         self.auto_save_thread = threading.Thread(target=self._auto_save, daemon=True)
         self.auto_save_thread.start()
 
+    def _all_locks(self) -> Iterator[threading.RLock]:
+        """按锁顺序逐个给出全部锁"""
+        # 先持有群组锁注册表，此后不会再创建新的群组锁
+        yield self._group_locks_lock
+        for _, lock in sorted(self._group_locks.items(), key=lambda item: int(item[0])):
+            yield lock
+        yield self._hongbao_lock
+        yield from self._user_locks
+        yield self._stats_lock
+        yield self._history_lock
+
+    def _group_lock(self, chat_id_str: str) -> threading.RLock:
+        """获取群组的锁，不存在时创建"""
+        lock = self._group_locks.get(chat_id_str)
+        if lock is None:
+            with self._group_locks_lock:
+                lock = self._group_locks.get(chat_id_str)
+                if lock is None:
+                    lock = self._group_locks[chat_id_str] = _make_lock("群组锁")
+        return lock
+
+    def _user_lock(self, user_id_str: str) -> threading.RLock:
+        """获取用户所在分段的锁"""
+        return self._user_locks[hash(user_id_str) % len(self._user_locks)]
+
     def load_data(self):
-        """从文件加载数据"""
+        """从快照文件加载数据，然后重放快照之后的日志"""
         with self.lock:
             # 确保 data 目录存在
             directory = os.path.dirname(self.data_file)
             if directory:
                 os.makedirs(directory, exist_ok=True)
 
-            # 如果文件不存在，创建默认结构
-            if not os.path.exists(self.data_file):
-                default_data = {
-                    'users': {},
-                    'game_history': [],
-                    'chat_messages': [],
-                    'global_stats': {
-                        'total_games': 0,
-                        'total_bets': 0,
-                        'total_winnings': 0,
-                        'biggest_win': {'user_id': None, 'amount': 0, 'date': None}
-                    }
-                }
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    json.dump(default_data, f, ensure_ascii=False, indent=2)
+            started = time.perf_counter()
+            data = _recover_data(self.data_file)
+            self.last_recovery_duration = time.perf_counter() - started
+            self.users = data['users']
+            self.game_history = data['game_history']
+            self.chat_messages = data['chat_messages']
+            self.global_stats = data['global_stats']
+            # 每个群组已分配的游戏编号 {group_id: count}
+            self.group_game_counters = data['group_game_counters']
+            # 群组游戏状态（包括进行中的投注），重启后由 resume_group_games 继续或退款
+            self.group_games = data['group_games']
+            # 反水记录 {user_id: {last_claimed, total_bets, amount}}
+            self.rebate_records = data['rebate_records']
+            # 红包信息存储 {hongbao_id: 红包信息}
+            self.hongbao = data['hongbao']
+            # 每个群组的预设骰子点数 {chat_id: {'dice': [dice1, dice2, dice3], 'set_at': 时间戳}}
+            self.group_fixed_dice = data['group_fixed_dice']
+            self._journal_seq = data['journal_seq']
+            # 快照之后的游戏记录在合并进历史文件前保留在内存中
+            self._history_pending = data['history_tail']
+            self._use_history_file(data['history_file'], data['history_index'])
+
+            self._journal_fp = open(self.journal_file, 'ab')
+            self.journal_bytes = os.path.getsize(self.journal_file)
+
+    @contextmanager
+    def _transaction(self, chat_id_str: Optional[str] = None, hongbao: bool = False):
+        """
+        写事务；chat_id_str / hongbao 指明事务中会修改的内存状态（该群组的游戏和预设点数 / 红包）
+        落盘时持有全部锁，JSON 后端在锁内做的修改总会在同一次落盘中写入日志，无需额外处理
+        """
+        yield None
 
-            try:
-                if os.path.exists(self.data_file):
-                    with open(self.data_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        self.users = data.get('users', {})
-                        self.game_history = data.get('game_history', [])
-                        self.chat_messages = data.get('chat_messages', [])
-                        self.global_stats = data.get('global_stats', {
-                            'total_games': 0,
-                            'total_bets': 0,
-                            'total_winnings': 0,
-                            'biggest_win': {'user_id': None, 'amount': 0, 'date': None}
-                        })
-                else:
-                    self.users = {}
-                    self.game_history = []
-                    self.chat_messages = []
-                    self.global_stats = {
-                        'total_games': 0,
-                        'total_bets': 0,
-                        'total_winnings': 0,
-                        'biggest_win': {'user_id': None, 'amount': 0, 'date': None}
-                    }
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"加载数据错误: {e}")
-                self.users = {}
-                self.game_history = []
-                self.chat_messages = []
-                self.global_stats = {
-                    'total_games': 0,
-                    'total_bets': 0,
-                    'total_winnings': 0,
-                    'biggest_win': {'user_id': None, 'amount': 0, 'date': None}
-                }
+    def _use_history_file(self, history_file: Optional[str], history_index: Dict[str, List[int]]) -> None:
+        """切换到新的历史文件并清空缓存（调用方需持有 self.lock）"""
+        if self._history_fp is not None:
+            self._history_fp.close()
+        self._history_fp = open(history_file, 'rb') if history_file is not None else None
+        self._history_index = history_index
+        self._history_cache.clear()
 
-    def save_data(self):
-        """保存数据到文件"""
-        with self.lock:
+    def _journal(self, op: str, **fields) -> Dict[str, Any]:
+        """
+        追加一条日志记录，调用方需持有统计锁
+        记录只进入内存缓冲区，由后台线程批量写入并 fsync，落盘时记录中会写入序号
+        """
+        entry = {'op': op, **fields}
+        self._journal_buffer.append(entry)
+
+        # 缓冲区较大时提前唤醒落盘线程
+        if len(self._journal_buffer) >= JOURNAL_BATCH_SIZE:
+            self._journal_event.set()
+        return entry
+
+    def flush_journal(self) -> None:
+        """
+        将脏数据和缓冲的日志记录写入日志文件并 fsync
+        只写自上次落盘以来变化的用户、群组计数器和全局统计，耗时与变更量成正比
+        """
+        # 持有 IO 锁直到写完，保证日志文件中的序号单调递增
+        with self._journal_io_lock:
+            started = time.perf_counter()
+            with self.lock:
+                # 状态记录写在游戏记录之前，保证重放时用户已存在
+                entries = []
+                for user_id_str in self._dirty_users:
+                    if user_id_str in self.users:
+                        # 用户记录发布后不再修改，无需复制
+                        entries.append({'op': 'user', 'id': user_id_str, 'data': self.users[user_id_str]})
+                for group_id_str in self._dirty_groups:
+                    entries.append({'op': 'counter', 'id': group_id_str,
+                                    'value': self.group_game_counters[group_id_str]})
+                if self._dirty_stats:
+                    entries.append({'op': 'stats', 'data': {
+                        **self.global_stats, 'biggest_win': dict(self.global_stats['biggest_win'])
+                    }})
+                for chat_id_str in self._dirty_games:
+                    if chat_id_str in self.group_games:
+                        entries.append({'op': 'round', 'id': chat_id_str,
+                                        'data': _copy_group_game(self.group_games[chat_id_str])})
+                # 反水记录和预设点数每次整体替换，不需要复制；已删除的红包和点数记为 None
+                for user_id_str in self._dirty_rebates:
+                    entries.append({'op': 'rebate', 'id': user_id_str, 'data': self.rebate_records[user_id_str]})
+                for hongbao_id in self._dirty_hongbao:
+                    hongbao_info = self.hongbao.get(hongbao_id)
+                    entries.append({'op': 'hongbao', 'id': hongbao_id,
+                                    'data': _copy_hongbao(hongbao_info) if hongbao_info is not None else None})
+                for chat_id_str in self._dirty_fixed_dice:
+                    entries.append({'op': 'fixed_dice', 'id': chat_id_str,
+                                    'data': self.group_fixed_dice.get(chat_id_str)})
+                entries.extend(self._journal_buffer)
+                self._journal_buffer = []
+                self._dirty_users.clear()
+                self._dirty_groups.clear()
+                self._dirty_games.clear()
+                self._dirty_rebates.clear()
+                self._dirty_hongbao.clear()
+                self._dirty_fixed_dice.clear()
+                self._dirty_stats = False
+
+                for entry in entries:
+                    self._journal_seq += 1
+                    entry['seq'] = self._journal_seq
+
+            if not entries:
+                return
+
+            # 记录已是副本，编码在锁外进行
+            chunk = b''.join(_dumps_compact(entry) + b'\n' for entry in entries)
             try:
-                data = {
-                    'users': self.users,
-                    'game_history': self.game_history,
-                    'chat_messages': self.chat_messages,
-                    'global_stats': self.global_stats
-                }
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                logger.info("数据已保存")
-            except IOError as e:
-                logger.error(f"保存数据错误: {e}")
+                self._journal_fp.write(chunk)
+                self._journal_fp.flush()
+                os.fsync(self._journal_fp.fileno())
+            except (IOError, OSError) as e:
+                logger.error(f"写入日志错误: {e}")
+                # 状态记录重新标记为脏（下次写最新值），游戏记录放回缓冲区
+                with self.lock:
+                    for entry in entries:
+                        if entry['op'] == 'user':
+                            self._dirty_users.add(entry['id'])
+                        elif entry['op'] == 'counter':
+                            self._dirty_groups.add(entry['id'])
+                        elif entry['op'] == 'stats':
+                            self._dirty_stats = True
+                        elif entry['op'] == 'round':
+                            self._dirty_games.add(entry['id'])
+                        elif entry['op'] == 'rebate':
+                            self._dirty_rebates.add(entry['id'])
+                        elif entry['op'] == 'hongbao':
+                            self._dirty_hongbao.add(entry['id'])
+                        elif entry['op'] == 'fixed_dice':
+                            self._dirty_fixed_dice.add(entry['id'])
+                    self._journal_buffer[:0] = [e for e in entries if e['op'] == 'game']
+                return
+
+            self.journal_bytes += len(chunk)
+            self.last_flush_bytes = len(chunk)
+            self.last_flush_duration = time.perf_counter() - started
+
+    def get_flush_stats(self) -> Dict[str, Any]:
+        """获取最近一次落盘的耗时和字节数，以及启动恢复耗时"""
+        return {
+            'last_flush_ms': self.last_flush_duration * 1000,
+            'last_flush_bytes': self.last_flush_bytes,
+            'journal_bytes': self.journal_bytes,
+            'recovery_ms': self.last_recovery_duration * 1000
+        }
+
+    def save_data(self, wait: bool = True) -> None:
+        """
+        压缩日志：轮转当前日志段，由后台线程把旧快照和已轮转的日志段合并成新快照
+        全局锁只在落盘脏数据时短暂持有，快照的解析、编码和写入都在锁外进行
+        wait 为 True 时等待快照写完（用于退出前保存）
+        """
+        with self._compact_lock:
+            if self._compact_thread is not None and self._compact_thread.is_alive():
+                if not wait:
+                    return
+                self._compact_thread.join()
+
+            with self._journal_io_lock:
+                self.flush_journal()
+                if self.journal_bytes > 0:
+                    # 日志段以其中最大的序号命名
+                    self._journal_fp.close()
+                    os.replace(self.journal_file, f"{self.journal_file}.{self._journal_seq}")
+                    self._journal_fp = open(self.journal_file, 'ab')
+                    self.journal_bytes = 0
+
+            # 只有出现比最新一代快照更新的日志段时才需要压缩
+            generations = _numbered_files(self.data_file)
+            newest = generations[-1][0] if generations else -1
+            if not _rotated_journal_segments(self.journal_file, newest):
+                return
+
+            self._compact_thread = threading.Thread(target=self._compact, daemon=True)
+            self._compact_thread.start()
+
+        if wait:
+            self._compact_thread.join()
+
+    def _compact(self) -> None:
+        """
+        将最新的有效快照和之后的日志段合并为新一代快照
+        只保留最近 SNAPSHOT_GENERATIONS 代快照，以及最旧一代之后的日志段，供回退时重放
+        """
+        started = time.perf_counter()
+        try:
+            data = _load_newest_snapshot(self.data_file)
+            for journal_file in _rotated_journal_segments(self.journal_file, data['journal_seq']):
+                _replay_journal(data, journal_file)
+            seq = data['journal_seq']
+            _write_snapshot(f"{self.data_file}.{seq}", data)
+
+            # 已合并进新历史文件的游戏记录不再需要保留在内存中
+            with self.lock:
+                self._use_history_file(data['history_file'], data['history_index'])
+                for user_id_str in list(self._history_pending):
+                    pending = [entry for entry in self._history_pending[user_id_str]
+                               if 'seq' not in entry or entry['seq'] > seq]
+                    if pending:
+                        self._history_pending[user_id_str] = pending
+                    else:
+                        del self._history_pending[user_id_str]
+
+            generations = _numbered_files(self.data_file)
+            for _, path in generations[:-SNAPSHOT_GENERATIONS]:
+                os.remove(path)
+                if os.path.exists(path + '.history'):
+                    os.remove(path + '.history')
+            oldest = generations[-SNAPSHOT_GENERATIONS:][0][0]
+            for seq, journal_file in _numbered_files(self.journal_file):
+                if seq <= oldest:
+                    os.remove(journal_file)
+            logger.info(f"数据已保存为第 {data['journal_seq']} 代快照，耗时 {time.perf_counter() - started:.2f} 秒")
+        except (ValueError, RuntimeError, IOError, OSError) as e:
+            # 日志段保留，下次压缩或启动时仍会重放
+            logger.error(f"保存数据错误: {e}")
 
     def _auto_save(self):
-        """自动定期保存数据"""
+        """定期落盘脏数据，日志超过阈值时压缩为快照"""
         while True:
-            time.sleep(300)  # 每5分钟保存一次
-            self.save_data()
+            self._journal_event.wait(JOURNAL_FLUSH_INTERVAL)
+            self._journal_event.clear()
+            # 单次失败不能让落盘线程退出，否则之后的数据都不会再持久化
+            try:
+                self.flush_journal()
+                if self.journal_bytes >= COMPACT_JOURNAL_BYTES:
+                    self.save_data(wait=False)
+                if time.time() - self._last_expire_check >= EXPIRE_CHECK_INTERVAL:
+                    self.expire_stale_entries()
+            except Exception:
+                logger.exception("自动落盘出错")
 
     def add_user(self, user_id: int, name: str) -> None:
         """添加新用户或更新用户名"""
         user_id_str = str(user_id)
-        with self.lock:
+        with self._user_lock(user_id_str):
             if user_id_str not in self.users:
                 # 检查是否为管理员ID
                 initial_balance = 10000 if user_id in ADMIN_IDS else 0
 
-                self.users[user_id_str] = {
+                user = {
                     'name': name,
                     'balance': initial_balance,
                     'total_bets': 0,
@@ -527,20 +1605,30 @@ class DataManager:
                     'joined_date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     'last_activity': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     'vip_level': 0,
-                    'daily_bonus_claimed': None,
-                    'history': []
+                    'daily_bonus_claimed': None
                 }
-                self.save_data()
             else:
                 # 更新用户名和最后活动时间
-                self.users[user_id_str]['name'] = name
-                self.users[user_id_str]['last_activity'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                user = {**self.users[user_id_str], 'name': name,
+                        'last_activity': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+
+            self._publish_user(user_id_str, user)
+
+    def _publish_user(self, user_id_str: str, user: Dict[str, Any]) -> None:
+        """
+        发布用户记录的新版本（调用方需持有用户锁）
+        写入方修改副本后整体替换，已发布的记录不再修改，读取方拿到的总是完整的一版
+        """
+        self.users[user_id_str] = user
+        self._dirty_users.add(user_id_str)
+        self.users_version = next(self._user_versions)
 
     def get_user(self, user_id: int) -> Dict[str, Any]:
-        """获取用户数据，如果用户不存在返回None"""
-        user_id_str = str(user_id)
-        with self.lock:
-            return self.users.get(user_id_str)
+        """
+        获取用户数据的只读快照，如果用户不存在返回None
+        不加锁：返回的记录不会再被修改，调用方也不能修改
+        """
+        return self.users.get(str(user_id))
 
     def update_balance(self, user_id: int, amount: int) -> Tuple[int, bool]:
         """
@@ -548,37 +1636,63 @@ class DataManager:
         返回：(新余额, 成功标志)
         """
         user_id_str = str(user_id)
-        with self.lock:
+        with self._user_lock(user_id_str):
             if user_id_str not in self.users:
                 return 0, False
             
-            new_balance = self.users[user_id_str]['balance'] + amount
+            user = dict(self.users[user_id_str])
+            new_balance = user['balance'] + amount
             if new_balance < 0:
-                return self.users[user_id_str]['balance'], False
+                return user['balance'], False
             
-            self.users[user_id_str]['balance'] = new_balance
+            user['balance'] = new_balance
             
             # 如果是正数增加，记录为总赢钱；负数减少，记录为总投注
             if amount > 0:
-                self.users[user_id_str]['total_winnings'] += amount
+                user['total_winnings'] += amount
             else:
-                self.users[user_id_str]['total_bets'] += abs(amount)
+                user['total_bets'] += abs(amount)
             
             # 检查是否需要更新VIP等级
-            self._update_vip_level(user_id_str)
+            user['vip_level'] = self._vip_level_for(user['total_bets'], user['vip_level'])
+            self._publish_user(user_id_str, user)
             
             return new_balance, True
 
-    def _update_vip_level(self, user_id_str: str) -> None:
-        """根据总投注额更新用户VIP等级"""
-        total_bets = self.users[user_id_str]['total_bets']
-        current_level = self.users[user_id_str]['vip_level']
-        
-        # 检查是否可以升级
+    def clear_balance(self, user_id: int) -> Optional[int]:
+        """
+        清除用户余额
+        返回：原余额，用户不存在时返回None
+        """
+        user_id_str = str(user_id)
+        with self._user_lock(user_id_str):
+            if user_id_str not in self.users:
+                return None
+            
+            old_balance = self.users[user_id_str]['balance']
+            self._publish_user(user_id_str, {**self.users[user_id_str], 'balance': 0})
+            return old_balance
+
+    def clear_all_balances(self) -> int:
+        """
+        清除所有用户的余额
+        返回：受影响的用户数量
+        """
+        with self.lock:
+            user_count = 0
+            for user_id_str, user in list(self.users.items()):
+                if user['balance'] > 0:
+                    self._publish_user(user_id_str, {**user, 'balance': 0})
+                    user_count += 1
+            return user_count
+
+    @staticmethod
+    def _vip_level_for(total_bets: int, current_level: int) -> int:
+        """根据总投注额计算VIP等级（只升不降）"""
         for level in sorted(VIP_LEVELS.keys(), reverse=True):
             if level > current_level and total_bets >= VIP_LEVELS[level]['requirement']:
-                self.users[user_id_str]['vip_level'] = level
-                break
+                return level
+        return current_level
 
     def add_game_record(self, user_id: int, game_type: str, bet_type: str, 
                        bet_value: Any, bet_amount: int, result: List[int], 
@@ -588,21 +1702,6 @@ class DataManager:
         user_id_str = str(user_id)
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
-        # 为群组游戏分配编号，确保真实走势
-        group_game_number = None
-        if is_group_game and group_id is not None:
-            group_id_str = str(group_id)
-            
-            # 查找这个群组已有多少局游戏
-            group_games_count = len([
-                game for game in self.game_history 
-                if game.get('is_group_game', False) and 
-                   game.get('group_id', '') == group_id_str
-            ])
-            
-            # 当前局编号 = 已有局数 + 1
-            group_game_number = group_games_count + 1
-        
         game_record = {
             'timestamp': timestamp,
             'game_type': game_type,
@@ -613,31 +1712,33 @@ class DataManager:
             'won': won,
             'winnings': winnings,
             'is_group_game': is_group_game,
-            'group_game_number': group_game_number  # 添加群组游戏编号
+            'group_game_number': None  # 群组游戏编号
         }
         
         if group_id:
             game_record['group_id'] = group_id
         
-        with self.lock:
-            # 添加到用户历史
+        with self._user_lock(user_id_str), self._stats_lock:
+            # 为群组游戏分配编号，确保真实走势
+            if is_group_game and group_id is not None:
+                group_id_str = str(group_id)
+                # 当前局编号 = 已有局数 + 1
+                game_record['group_game_number'] = self.group_game_counters.get(group_id_str, 0) + 1
+                self.group_game_counters[group_id_str] = game_record['group_game_number']
+                self._dirty_groups.add(group_id_str)
+            
             if user_id_str in self.users:
-                self.users[user_id_str]['games_played'] += 1
-                self.users[user_id_str]['history'].append(game_record)
-                # 仅保留最近50条记录
-                if len(self.users[user_id_str]['history']) > 50:
-                    self.users[user_id_str]['history'] = self.users[user_id_str]['history'][-50:]
+                user = self.users[user_id_str]
+                self._publish_user(user_id_str, {**user, 'games_played': user['games_played'] + 1})
             
-            # 添加到全局历史
-            self.game_history.append({
+            # 添加到用户历史和全局历史
+            history_entry = {
                 'user_id': user_id_str,
                 'user_name': self.users[user_id_str]['name'] if user_id_str in self.users else "未知用户",
                 **game_record
-            })
-            
-            # 仅保留最近1000条全局记录
-            if len(self.game_history) > 1000:
-                self.game_history = self.game_history[-1000:]
+            }
+            entry = self._journal('game', data=history_entry)
+            _append_game_record(self.users, self.game_history, self._history_pending, entry)
             
             # 更新全局统计
             self.global_stats['total_games'] += 1
@@ -653,37 +1754,57 @@ class DataManager:
                         'date': timestamp
                     }
 
+            self._dirty_stats = True
+
     def get_user_history(self, user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
         """获取用户的游戏历史"""
         user_id_str = str(user_id)
-        with self.lock:
+        # 用户的待合并历史只在持有该用户锁时追加
+        with self._user_lock(user_id_str), self._history_lock:
             if user_id_str not in self.users:
                 return []
             
-            history = self.users[user_id_str]['history']
+            history = self._cached_history(user_id_str) + [
+                _history_record(entry['data']) for entry in self._history_pending.get(user_id_str, [])
+            ]
             # 返回最近的n条记录
             return history[-limit:][::-1]  # 倒序返回
 
+    def _cached_history(self, user_id_str: str) -> List[Dict[str, Any]]:
+        """读取用户在历史文件中的记录，最近访问的用户缓存在内存中（调用方需持有历史文件锁）"""
+        history = self._history_cache.get(user_id_str)
+        if history is not None:
+            self._history_cache.move_to_end(user_id_str)
+            return history
+        
+        history = _read_history(self._history_fp, self._history_index, user_id_str) if self._history_fp else []
+        self._history_cache[user_id_str] = history
+        if len(self._history_cache) > HISTORY_CACHE_SIZE:
+            self._history_cache.popitem(last=False)
+        return history
+
     def get_leaderboard(self, metric: str = 'balance', limit: int = 10) -> List[Dict[str, Any]]:
         """
         获取排行榜
         metric：'balance', 'total_winnings', 'games_played'
         """
-        with self.lock:
-            # 根据指定指标排序用户
-            sorted_users = sorted(
-                [{'user_id': k, **v} for k, v in self.users.items()],
-                key=lambda x: x[metric],
-                reverse=True
-            )
-            
-            # 返回前n名
-            return sorted_users[:limit]
+        # 不加锁：用户记录发布后不再修改，复制用户列表是原子操作
+        # 排好序的快照整体替换，用户数据不变或距上次排序不足刷新间隔时直接使用
+        snapshot = self._leaderboards.get((metric, limit))
+        if snapshot is None or (snapshot[0] != self.users_version
+                                and time.monotonic() - snapshot[1] >= LEADERBOARD_REFRESH_INTERVAL):
+            version = self.users_version
+            # 只取前n名，不需要对全部用户排序
+            top_users = heapq.nlargest(limit, list(self.users.items()), key=lambda item: item[1][metric])
+            snapshot = (version, time.monotonic(), [{'user_id': k, **v} for k, v in top_users])
+            self._leaderboards[(metric, limit)] = snapshot
+        
+        return snapshot[2]
 
     def get_group_game(self, chat_id: int) -> Dict[str, Any]:
         """获取群组游戏状态，如果不存在则创建"""
         chat_id_str = str(chat_id)
-        with self.lock:
+        with self._group_lock(chat_id_str):
             if chat_id_str not in self.group_games:
                 self.group_games[chat_id_str] = {
                     'state': GROUP_GAME_IDLE,
@@ -697,8 +1818,44 @@ class DataManager:
     def update_group_game(self, chat_id: int, data: Dict[str, Any]) -> None:
         """更新群组游戏状态"""
         chat_id_str = str(chat_id)
-        with self.lock:
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
             self.group_games[chat_id_str] = data
+            self._save_group_game(chat_id_str)
+
+    def start_group_game(self, chat_id: int) -> Optional[float]:
+        """开始新一局投注，返回开始时间；已经在投注中时返回 None"""
+        chat_id_str = str(chat_id)
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
+            group_game = self.get_group_game(chat_id)
+            if group_game['state'] == GROUP_GAME_BETTING:
+                return None
+            group_game['state'] = GROUP_GAME_BETTING
+            group_game['bets'] = {}
+            group_game['start_time'] = time.time()
+            # 开始消息发送完成后再记录消息ID
+            group_game['message_id'] = None
+            self._save_group_game(chat_id_str)
+            return group_game['start_time']
+
+    def set_group_game_message(self, chat_id: int, start_time: float, message_id: int) -> bool:
+        """记录本局开始消息的ID，已经是新的一局时返回 False"""
+        chat_id_str = str(chat_id)
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
+            group_game = self.get_group_game(chat_id)
+            if group_game['start_time'] != start_time:
+                return False
+            group_game['message_id'] = message_id
+            self._save_group_game(chat_id_str)
+            return True
+
+    def _save_group_game(self, chat_id_str: str) -> None:
+        """标记群组游戏状态需要持久化（调用方需持有群组锁）"""
+        self._dirty_games.add(chat_id_str)
+
+    def get_active_group_games(self) -> Dict[int, Dict[str, Any]]:
+        """获取所有未处于空闲状态的群组游戏 {chat_id: 状态}"""
+        return {int(chat_id_str): group_game for chat_id_str, group_game in list(self.group_games.items())
+                if group_game['state'] != GROUP_GAME_IDLE}
 
     def add_bet_to_group_game(self, chat_id: int, user_id: int, 
                              bet_type: str, bet_value: Any, amount: int) -> bool:
@@ -706,43 +1863,65 @@ class DataManager:
         向群组游戏添加投注
         返回：是否成功
         """
+        _, success = self.add_bets_to_group_game(chat_id, user_id, [(bet_type, bet_value, amount)])
+        return success
+
+    def add_bets_to_group_game(self, chat_id: int, user_id: int,
+                               bets: List[Tuple[str, Any, int]]) -> Tuple[int, bool]:
+        """
+        一次添加一张投注单 [(bet_type, bet_value, amount), ...]
+        全部投注要么都成功，要么都不生效：只检查一次游戏状态，按总额扣一次款，投注单只保存一次
+        任何一注的类型未知或金额不是正数时整张投注单无效（负数金额会抵消其它投注的扣款）
+        返回：(扣款后的余额, 是否成功)；失败时为当前余额
+        """
         chat_id_str = str(chat_id)
         user_id_str = str(user_id)
-        
-        with self.lock:
-            if chat_id_str not in self.group_games:
-                return False
-            
-            if self.group_games[chat_id_str]['state'] != GROUP_GAME_BETTING:
-                return False
-            
-            # 检查用户余额
-            if user_id_str not in self.users:
-                return False
-            
-            if self.users[user_id_str]['balance'] < amount:
-                return False
+        total_amount = sum(amount for _, _, amount in bets)
+        valid = all(bet_type in BET_TYPES and isinstance(amount, int) and amount > 0
+                    for bet_type, _, amount in bets)
+        
+        # 扣款和投注在同一次落盘（SQLite 为同一事务）中持久化
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
+            group_game = self.group_games.get(chat_id_str)
+            if group_game is None or group_game['state'] != GROUP_GAME_BETTING or not bets or not valid:
+                user = self.get_user(user_id)
+                return (user['balance'] if user else 0), False
             
-            # 更新用户余额
-            self.users[user_id_str]['balance'] -= amount
-            self.users[user_id_str]['total_bets'] += amount
+            # 检查并扣除用户余额
+            balance, success = self._debit_bet(user_id_str, total_amount)
+            if not success:
+                return balance, False
             
             # 添加投注
-            if user_id_str not in self.group_games[chat_id_str]['bets']:
-                self.group_games[chat_id_str]['bets'][user_id_str] = []
+            group_game['bets'].setdefault(user_id_str, []).extend(
+                {'bet_type': bet_type, 'bet_value': bet_value, 'amount': amount}
+                for bet_type, bet_value, amount in bets
+            )
+            self._save_group_game(chat_id_str)
             
-            self.group_games[chat_id_str]['bets'][user_id_str].append({
-                'bet_type': bet_type,
-                'bet_value': bet_value,
-                'amount': amount
-            })
+            return balance, True
+
+    def _debit_bet(self, user_id_str: str, amount: int) -> Tuple[int, bool]:
+        """
+        扣除投注金额并计入总投注（调用方需持有群组锁）
+        返回：(扣款后的余额, 成功标志)；余额不足时为当前余额和False
+        """
+        with self._user_lock(user_id_str):
+            if user_id_str not in self.users:
+                return 0, False
             
-            return True
+            user = self.users[user_id_str]
+            if user['balance'] < amount:
+                return user['balance'], False
+            
+            self._publish_user(user_id_str, {**user, 'balance': user['balance'] - amount,
+                                             'total_bets': user['total_bets'] + amount})
+            return user['balance'] - amount, True
 
     def reset_group_game(self, chat_id: int) -> None:
         """重置群组游戏状态"""
         chat_id_str = str(chat_id)
-        with self.lock:
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
             if chat_id_str in self.group_games:
                 self.group_games[chat_id_str] = {
                     'state': GROUP_GAME_IDLE,
@@ -751,32 +1930,208 @@ class DataManager:
                     'start_time': None,
                     'message_id': None
                 }
+                self._save_group_game(chat_id_str)
+
+    def settle_group_game(self, chat_id: int, dice_result: List[int], result: Dict[str, Any]) -> Dict[str, int]:
+        """
+        结算群组游戏的所有投注：派奖、写游戏记录并标记为已结算
+        全部在持有群组锁时完成，重启后不会重复结算或漏结算；各用户的锁逐个获取
+        返回：{user_id_str: 赢得金额}（只包含存在的用户）
+        """
+        chat_id_str = str(chat_id)
+        winnings_by_user = {}
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
+            group_game = self.group_games[chat_id_str]
+            for user_id_str, bets in group_game['bets'].items():
+                user_id = int(user_id_str)
+                if not self.get_user(user_id):
+                    continue
+                
+                user_total_win = 0
+                for bet in bets:
+                    won, ratio = DiceGame.evaluate_bet(bet['bet_type'], bet['bet_value'], result)
+                    winnings = bet['amount'] * ratio if won else 0
+                    if won:
+                        user_total_win += winnings
+                        self.update_balance(user_id, winnings)
+                    
+                    self.add_game_record(
+                        user_id=user_id,
+                        game_type="group",
+                        bet_type=bet['bet_type'],
+                        bet_value=bet['bet_value'],
+                        bet_amount=bet['amount'],
+                        result=dice_result,
+                        won=won,
+                        winnings=winnings,
+                        is_group_game=True,
+                        group_id=chat_id
+                    )
+                winnings_by_user[user_id_str] = user_total_win
+            
+            group_game['settled'] = True
+            self._save_group_game(chat_id_str)
+        return winnings_by_user
+
+    def refund_group_game(self, chat_id: int) -> int:
+        """
+        退还未结算的群组游戏的所有投注并重置游戏
+        返回：退还的总金额
+        """
+        chat_id_str = str(chat_id)
+        refunded = 0
+        with self._group_lock(chat_id_str), self._transaction(chat_id_str):
+            group_game = self.group_games.get(chat_id_str)
+            if group_game is None or group_game.get('settled'):
+                return 0
+            for user_id_str, bets in group_game['bets'].items():
+                amount = sum(bet['amount'] for bet in bets)
+                if self._refund_bet(user_id_str, amount):
+                    refunded += amount
+            self.reset_group_game(chat_id)
+        return refunded
+
+    def _refund_bet(self, user_id_str: str, amount: int) -> bool:
+        """退还投注金额并从总投注中扣除，与 _debit_bet 相反（调用方需持有群组锁）"""
+        with self._user_lock(user_id_str):
+            if user_id_str not in self.users:
+                return False
+            
+            user = self.users[user_id_str]
+            self._publish_user(user_id_str, {**user, 'balance': user['balance'] + amount,
+                                             'total_bets': user['total_bets'] - amount})
+            return True
     
     def set_fixed_dice(self, chat_id: int, dice_values: List[int]) -> bool:
         """设置特定群组的固定骰子点数"""
-        with self.lock:
+        with self._group_lock(str(chat_id)):
             # 验证骰子点数是否有效
             if len(dice_values) != 3 or not all(1 <= d <= 6 for d in dice_values):
                 return False
             
-            self.group_fixed_dice[str(chat_id)] = dice_values
+            with self._transaction(str(chat_id)):
+                self.group_fixed_dice[str(chat_id)] = {'dice': dice_values, 'set_at': time.time()}
+                self._save_fixed_dice(str(chat_id))
             return True
             
     def get_fixed_dice(self, chat_id: int) -> Optional[List[int]]:
         """获取特定群组的固定骰子点数"""
-        with self.lock:
-            return self.group_fixed_dice.get(str(chat_id))
+        fixed_dice = self.group_fixed_dice.get(str(chat_id))
+        return fixed_dice['dice'] if fixed_dice is not None else None
             
     def clear_fixed_dice(self, chat_id: int) -> None:
         """清除特定群组的固定骰子点数"""
-        with self.lock:
+        with self._group_lock(str(chat_id)), self._transaction(str(chat_id)):
             if str(chat_id) in self.group_fixed_dice:
                 del self.group_fixed_dice[str(chat_id)]
-                
+                self._save_fixed_dice(str(chat_id))
+
+    def _save_fixed_dice(self, chat_id_str: str) -> None:
+        """标记预设骰子点数需要持久化（调用方需持有群组锁）"""
+        self._dirty_fixed_dice.add(chat_id_str)
+
+    def get_hongbao(self, hongbao_id: str) -> Optional[Dict[str, Any]]:
+        """获取红包信息，不存在时返回None"""
+        return self.hongbao.get(hongbao_id)
+
+    def put_hongbao(self, hongbao_id: str, hongbao_info: Dict[str, Any]) -> None:
+        """保存新红包或更新红包信息"""
+        with self._hongbao_lock, self._transaction(hongbao=True):
+            self.hongbao[hongbao_id] = hongbao_info
+            self._save_hongbao(hongbao_id)
+
+    def claim_private_hongbao(self, hongbao_id: str, user_id: int) -> Tuple[int, bool]:
+        """
+        领取私人红包，加款和删除红包在同一临界区内完成
+        返回：(新余额, 是否成功)
+        """
+        with self._hongbao_lock, self._transaction(hongbao=True):
+            hongbao_info = self.hongbao.get(hongbao_id)
+            if hongbao_info is None or hongbao_info.get('is_claimed', False) or user_id != hongbao_info['target_id']:
+                return 0, False
+            
+            new_balance, success = self.update_balance(user_id, hongbao_info['amount'])
+            if success:
+                hongbao_info['is_claimed'] = True
+                hongbao_info['claimed_at'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                # 删除红包信息以节省内存
+                del self.hongbao[hongbao_id]
+                self._save_hongbao(hongbao_id)
+            return new_balance, success
+
+    def grab_group_hongbao(self, hongbao_id: str, user_id: int, user_name: str) -> Tuple[int, bool]:
+        """
+        抢群组红包，分配金额、加款和更新领取记录在同一临界区内完成
+        返回：(抢到的金额, 是否成功)
+        """
+        with self._hongbao_lock, self._transaction(hongbao=True):
+            hongbao_info = self.hongbao.get(hongbao_id)
+            if hongbao_info is None or hongbao_info['remaining_count'] <= 0:
+                return 0, False
+            if any(receiver['user_id'] == user_id for receiver in hongbao_info['receivers']):
+                return 0, False
+            
+            amount = hongbao_info['amounts'][hongbao_info['total_count'] - hongbao_info['remaining_count']]
+            new_balance, success = self.update_balance(user_id, amount)
+            if not success:
+                return 0, False
+            
+            hongbao_info['remaining_count'] -= 1
+            hongbao_info['remaining_amount'] -= amount
+            hongbao_info['receivers'].append({
+                "user_id": user_id,
+                "user_name": user_name,
+                "amount": amount,
+                "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            })
+            if hongbao_info['remaining_count'] == 0:
+                # 红包已被抢完，删除红包信息以节省内存
+                del self.hongbao[hongbao_id]
+            self._save_hongbao(hongbao_id)
+            return amount, True
+
+    def _save_hongbao(self, hongbao_id: str) -> None:
+        """标记红包信息需要持久化（调用方需持有红包锁）"""
+        self._dirty_hongbao.add(hongbao_id)
+
+    def expire_stale_entries(self) -> None:
+        """
+        清理过期数据：超时未领完的红包把剩余金额退还给发送者，过期的预设骰子点数直接删除
+        反水记录是用户领取反水的基准，不会过期，数量不超过用户数
+        """
+        now = time.time()
+        self._last_expire_check = now
+        with self._hongbao_lock, self._transaction(hongbao=True):
+            for hongbao_id, hongbao_info in list(self.hongbao.items()):
+                try:
+                    created_at = datetime.datetime.strptime(hongbao_info['created_at'], "%Y-%m-%d %H:%M:%S").timestamp()
+                except (KeyError, TypeError, ValueError):
+                    # 创建时间缺失或格式错误的红包无法判断是否过期，跳过，不影响其它数据的清理
+                    logger.warning(f"红包 {hongbao_id} 的创建时间无效: {hongbao_info.get('created_at')!r}，跳过过期检查")
+                    continue
+                if now - created_at < HONGBAO_EXPIRE_SECONDS:
+                    continue
+                refund = hongbao_info['remaining_amount'] if 'remaining_amount' in hongbao_info else hongbao_info['amount']
+                if refund > 0:
+                    self.update_balance(hongbao_info['sender_id'], refund)
+                del self.hongbao[hongbao_id]
+                self._save_hongbao(hongbao_id)
+                logger.info(f"红包 {hongbao_id} 已过期，退还 {refund} 金币给 {hongbao_info['sender_id']}")
+        
+        # 群组锁排在红包锁之前，释放红包锁后再逐个获取
+        for chat_id_str, fixed_dice in list(self.group_fixed_dice.items()):
+            if now - fixed_dice['set_at'] < FIXED_DICE_EXPIRE_SECONDS:
+                continue
+            with self._group_lock(chat_id_str), self._transaction(chat_id_str):
+                fixed_dice = self.group_fixed_dice.get(chat_id_str)
+                if fixed_dice is not None and now - fixed_dice['set_at'] >= FIXED_DICE_EXPIRE_SECONDS:
+                    del self.group_fixed_dice[chat_id_str]
+                    self._save_fixed_dice(chat_id_str)
+
     def get_group_history(self, chat_id: int, limit: int = 30) -> List[Dict[str, Any]]:
         """获取指定群组的游戏历史"""
         chat_id_str = str(chat_id)
-        with self.lock:
+        with self._stats_lock:
             # 筛选指定群组的游戏记录
             group_games = [game for game in self.game_history 
                            if game.get('is_group_game') and str(game.get('group_id')) == chat_id_str]
@@ -798,6 +2153,28 @@ class DataManager:
             
             return group_games[:limit]
 
+    def count_group_games(self, chat_id: int) -> int:
+        """获取指定群组的游戏记录数"""
+        return self.group_game_counters.get(str(chat_id), 0)
+
+    def get_recent_history(self, limit: int = 30) -> List[Dict[str, Any]]:
+        """获取最近的全局游戏记录（从旧到新）"""
+        with self._stats_lock:
+            return self.game_history[-limit:]
+
+    def count_games(self) -> int:
+        """获取全局游戏记录数"""
+        return len(self.game_history)
+
+    def count_users(self) -> int:
+        """获取用户总数"""
+        return len(self.users)
+
+    def get_global_stats(self) -> Dict[str, Any]:
+        """获取全局统计信息的副本"""
+        with self._stats_lock:
+            return {**self.global_stats, 'biggest_win': dict(self.global_stats['biggest_win'])}
+
     def is_banned(self, user_id: int) -> bool:
         """检查用户是否被封禁"""
         return user_id in BANNED_USERS
@@ -820,14 +2197,14 @@ class DataManager:
         返回：应返还的金币数量
         """
         user_id_str = str(user_id)
-        with self.lock:
+        with self._user_lock(user_id_str):
             if user_id_str not in self.users:
                 return 0
                 
             # 检查用户是否已经领取过反水
-            if user_id in self.rebate_records:
-                last_claimed = self.rebate_records[user_id]["last_claimed"]
-                last_total_bets = self.rebate_records[user_id]["total_bets"]
+            if user_id_str in self.rebate_records:
+                last_claimed = self.rebate_records[user_id_str]["last_claimed"]
+                last_total_bets = self.rebate_records[user_id_str]["total_bets"]
                 
                 # 获取当前投注总额
                 current_total_bets = self.users[user_id_str]["total_bets"]
@@ -848,27 +2225,714 @@ class DataManager:
                 
     def claim_rebate(self, user_id: int) -> Tuple[int, bool]:
         """
-        用户领取反水
+        用户领取反水，计算、加款和记录在同一临界区内完成
         返回：(反水金额, 是否成功)
         """
-        rebate_amount = self.calculate_rebate(user_id)
-        
-        if rebate_amount <= 0:
-            return 0, False
+        with self._user_lock(str(user_id)):
+            rebate_amount = self.calculate_rebate(user_id)
             
-        # 更新用户余额
-        new_balance, success = self.update_balance(user_id, rebate_amount)
+            if rebate_amount <= 0:
+                return 0, False
+                
+            # 更新用户余额
+            new_balance, success = self.update_balance(user_id, rebate_amount)
+            
+            if success:
+                # 记录此次反水
+                user_id_str = str(user_id)
+                self.rebate_records[user_id_str] = {
+                    "last_claimed": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "total_bets": self.users[user_id_str]["total_bets"],
+                    "amount": rebate_amount
+                }
+                self._dirty_rebates.add(user_id_str)
+                
+            return rebate_amount, success
+
+class SqliteDataManager(DataManager):
+    """
+    SQLite 存储后端（WAL 模式）
+    用户、游戏记录和反水记录按行读写，启动时无需把整个数据集加载到内存
+    群组游戏、红包和预设点数在内存中读写，每次变更同时写入对应的表
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            name TEXT,
+            balance INTEGER NOT NULL DEFAULT 0,
+            total_bets INTEGER NOT NULL DEFAULT 0,
+            total_winnings INTEGER NOT NULL DEFAULT 0,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            joined_date TEXT,
+            last_activity TEXT,
+            vip_level INTEGER NOT NULL DEFAULT 0,
+            daily_bonus_claimed TEXT
+        );
+        CREATE TABLE IF NOT EXISTS game_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            user_name TEXT,
+            timestamp TEXT,
+            game_type TEXT,
+            bet_type TEXT,
+            bet_value TEXT,
+            bet_amount INTEGER,
+            result TEXT,
+            won INTEGER,
+            winnings INTEGER,
+            is_group_game INTEGER,
+            group_id INTEGER,
+            group_game_number INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_game_records_user ON game_records (user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_game_records_group ON game_records (group_id, group_game_number);
+        CREATE TABLE IF NOT EXISTS global_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_games INTEGER NOT NULL DEFAULT 0,
+            total_bets INTEGER NOT NULL DEFAULT 0,
+            total_winnings INTEGER NOT NULL DEFAULT 0,
+            biggest_win_user_id TEXT,
+            biggest_win_amount INTEGER NOT NULL DEFAULT 0,
+            biggest_win_date TEXT
+        );
+        INSERT OR IGNORE INTO global_stats (id) VALUES (1);
+        CREATE TABLE IF NOT EXISTS rebate_records (
+            user_id TEXT PRIMARY KEY,
+            last_claimed TEXT,
+            total_bets INTEGER NOT NULL,
+            amount INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS group_games (
+            chat_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS hongbao (
+            hongbao_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS fixed_dice (
+            chat_id TEXT PRIMARY KEY,
+            dice TEXT NOT NULL,
+            set_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS group_game_counters (
+            group_id INTEGER PRIMARY KEY,
+            games INTEGER NOT NULL
+        );
+    """
+
+    # 排行榜允许的排序字段
+    LEADERBOARD_METRICS = ('balance', 'total_winnings', 'games_played', 'total_bets')
+
+    def __init__(self, data_file=SQLITE_FILE):
+        # 多个线程共用一个写连接，语句和事务由连接锁串行执行（叶子锁）
+        self._conn_lock = _make_lock("SQLite连接锁")
+        # 余额和排行榜查询使用每个线程自己的只读连接，不获取连接锁
+        # WAL 模式下读连接看到的是最近一次提交的快照，不会与写事务互相等待
+        self._read_local = threading.local()
+        super().__init__(data_file)
+
+    def _read_conn(self) -> sqlite3.Connection:
+        """当前线程的只读连接，首次使用时打开"""
+        conn = getattr(self._read_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.data_file, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=1")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._read_local.conn = conn
+        return conn
+
+    def load_data(self):
+        """打开数据库并创建表结构"""
+        with self.lock:
+            directory = os.path.dirname(self.data_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            # 自动提交模式，事务由 _transaction 显式控制
+            self.conn = sqlite3.connect(self.data_file, check_same_thread=False, isolation_level=None)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA busy_timeout=5000")
+            has_counters = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'group_game_counters'"
+            ).fetchone() is not None
+            self.conn.executescript(self.SCHEMA)
+            if not has_counters:
+                # 旧数据库没有计数表，按已有记录的最大编号初始化一次
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO group_game_counters (group_id, games) "
+                    "SELECT group_id, MAX(group_game_number) FROM game_records "
+                    "WHERE group_id IS NOT NULL AND group_game_number IS NOT NULL GROUP BY group_id"
+                )
+
+            self.group_games = {
+                row['chat_id']: json.loads(row['data'])
+                for row in self.conn.execute("SELECT chat_id, data FROM group_games")
+            }
+            self.hongbao = self._load_hongbao()
+            self.group_fixed_dice = {
+                row['chat_id']: {'dice': json.loads(row['dice']), 'set_at': row['set_at']}
+                for row in self.conn.execute("SELECT chat_id, dice, set_at FROM fixed_dice")
+            }
+
+    @contextmanager
+    def _transaction(self, chat_id_str: Optional[str] = None, hongbao: bool = False):
+        """
+        写事务，持有连接锁直到提交；嵌套调用并入外层事务
+        chat_id_str / hongbao 指明事务中会修改的内存状态（该群组的游戏和预设点数 / 红包），
+        回滚时按数据库重新加载这些状态，内存与数据库保持一致
+        """
+        with self._conn_lock:
+            if self.conn.in_transaction:
+                self._remember_memory(chat_id_str, hongbao)
+                yield self.conn
+                return
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._undo = {'chats': set(), 'hongbao': False}
+            self._remember_memory(chat_id_str, hongbao)
+            try:
+                yield self.conn
+                self.conn.execute("COMMIT")
+            except BaseException:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                self._restore_memory()
+                raise
+            finally:
+                self._undo = None
+
+    def _remember_memory(self, chat_id_str: Optional[str], hongbao: bool) -> None:
+        """记下事务将要修改的内存状态（调用方需持有连接锁且已开始事务）"""
+        if chat_id_str is not None:
+            self._undo['chats'].add(chat_id_str)
+        if hongbao:
+            self._undo['hongbao'] = True
+
+    def _restore_memory(self) -> None:
+        """
+        事务回滚后按数据库重新加载记下的内存状态（调用方需持有连接锁）
+        调用方持有这些状态对应的群组锁或红包锁，其它线程不会同时修改
+        """
+        for chat_id_str in self._undo['chats']:
+            row = self.conn.execute("SELECT data FROM group_games WHERE chat_id = ?", (chat_id_str,)).fetchone()
+            if row is not None:
+                self.group_games[chat_id_str] = json.loads(row['data'])
+            else:
+                # 空闲状态不写入数据库
+                self.group_games.pop(chat_id_str, None)
+            row = self.conn.execute("SELECT dice, set_at FROM fixed_dice WHERE chat_id = ?", (chat_id_str,)).fetchone()
+            if row is not None:
+                self.group_fixed_dice[chat_id_str] = {'dice': json.loads(row['dice']), 'set_at': row['set_at']}
+            else:
+                self.group_fixed_dice.pop(chat_id_str, None)
+        if self._undo['hongbao']:
+            self.hongbao = self._load_hongbao()
+
+    def _load_hongbao(self) -> Dict[str, Dict[str, Any]]:
+        """从数据库读取红包信息"""
+        return {
+            row['hongbao_id']: json.loads(row['data'])
+            for row in self.conn.execute("SELECT hongbao_id, data FROM hongbao")
+        }
+
+    def _auto_save(self):
+        """SQLite 每次写入即落盘，只需定期执行 WAL 检查点和清理过期数据"""
+        while True:
+            time.sleep(SQLITE_CHECKPOINT_INTERVAL)
+            # 单次失败不能让后台线程退出，否则之后不再执行检查点和清理
+            try:
+                self.save_data()
+                self.expire_stale_entries()
+            except Exception:
+                logger.exception("SQLite 检查点或清理过期数据出错")
+
+    def save_data(self):
+        """将 WAL 合并回主数据库文件"""
+        with self._conn_lock:
+            try:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                logger.info("数据已保存")
+            except sqlite3.Error as e:
+                logger.error(f"保存数据错误: {e}")
+
+    def flush_journal(self) -> None:
+        """SQLite 后端没有单独的日志缓冲区"""
+
+    def _save_group_game(self, chat_id_str: str) -> None:
+        """写入群组游戏状态，空闲状态直接删除（调用方需持有群组锁）"""
+        group_game = self.group_games[chat_id_str]
+        with self._transaction() as conn:
+            if group_game['state'] == GROUP_GAME_IDLE:
+                conn.execute("DELETE FROM group_games WHERE chat_id = ?", (chat_id_str,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO group_games (chat_id, data) VALUES (?, ?)",
+                    (chat_id_str, json.dumps(group_game, ensure_ascii=False))
+                )
+
+    def _save_hongbao(self, hongbao_id: str) -> None:
+        """写入红包信息，已删除的红包删除对应行（调用方需持有红包锁）"""
+        hongbao_info = self.hongbao.get(hongbao_id)
+        with self._transaction() as conn:
+            if hongbao_info is None:
+                conn.execute("DELETE FROM hongbao WHERE hongbao_id = ?", (hongbao_id,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO hongbao (hongbao_id, data) VALUES (?, ?)",
+                    (hongbao_id, json.dumps(hongbao_info, ensure_ascii=False))
+                )
+
+    def _save_fixed_dice(self, chat_id_str: str) -> None:
+        """写入预设骰子点数，已清除的删除对应行（调用方需持有群组锁）"""
+        fixed_dice = self.group_fixed_dice.get(chat_id_str)
+        with self._transaction() as conn:
+            if fixed_dice is None:
+                conn.execute("DELETE FROM fixed_dice WHERE chat_id = ?", (chat_id_str,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO fixed_dice (chat_id, dice, set_at) VALUES (?, ?, ?)",
+                    (chat_id_str, json.dumps(fixed_dice['dice']), fixed_dice['set_at'])
+                )
+
+    @staticmethod
+    def _game_row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        """将游戏记录行转换为与JSON模式相同的字典格式"""
+        record = {
+            'user_id': row['user_id'],
+            'user_name': row['user_name'],
+            'timestamp': row['timestamp'],
+            'game_type': row['game_type'],
+            'bet_type': row['bet_type'],
+            'bet_value': json.loads(row['bet_value']),
+            'bet_amount': row['bet_amount'],
+            'result': json.loads(row['result']),
+            'won': bool(row['won']),
+            'winnings': row['winnings'],
+            'is_group_game': bool(row['is_group_game']),
+            'group_game_number': row['group_game_number']
+        }
+        if row['group_id'] is not None:
+            record['group_id'] = row['group_id']
+        return record
+
+    def add_user(self, user_id: int, name: str) -> None:
+        """添加新用户或更新用户名"""
+        user_id_str = str(user_id)
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        initial_balance = 10000 if user_id in ADMIN_IDS else 0
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (user_id, name, balance, joined_date, last_activity) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, last_activity = excluded.last_activity",
+                (user_id_str, name, initial_balance, now, now)
+            )
+
+    def get_user(self, user_id: int) -> Dict[str, Any]:
+        """获取用户数据（最近一次提交的版本），如果用户不存在返回None"""
+        row = self._read_conn().execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        del user['user_id']
+        return user
+
+    def update_balance(self, user_id: int, amount: int) -> Tuple[int, bool]:
+        """
+        更新用户余额
+        返回：(新余额, 成功标志)
+        """
+        user_id_str = str(user_id)
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT balance, total_bets, vip_level FROM users WHERE user_id = ?", (user_id_str,)
+            ).fetchone()
+            if row is None:
+                return 0, False
+            
+            new_balance = row['balance'] + amount
+            if new_balance < 0:
+                return row['balance'], False
+            
+            # 正数记为总赢钱，负数记为总投注
+            total_bets = row['total_bets'] + (abs(amount) if amount <= 0 else 0)
+            conn.execute(
+                "UPDATE users SET balance = ?, total_bets = ?, "
+                "total_winnings = total_winnings + ?, vip_level = ? WHERE user_id = ?",
+                (new_balance, total_bets, amount if amount > 0 else 0,
+                 self._vip_level_for(total_bets, row['vip_level']), user_id_str)
+            )
+            return new_balance, True
+
+    def clear_balance(self, user_id: int) -> Optional[int]:
+        """
+        清除用户余额
+        返回：原余额，用户不存在时返回None
+        """
+        user_id_str = str(user_id)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id_str,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE users SET balance = 0 WHERE user_id = ?", (user_id_str,))
+            return row['balance']
+
+    def clear_all_balances(self) -> int:
+        """
+        清除所有用户的余额
+        返回：受影响的用户数量
+        """
+        with self._transaction() as conn:
+            return conn.execute("UPDATE users SET balance = 0 WHERE balance > 0").rowcount
+
+    def _debit_bet(self, user_id_str: str, amount: int) -> Tuple[int, bool]:
+        """
+        扣除投注金额并计入总投注（调用方需持有群组锁）
+        返回：(扣款后的余额, 成功标志)；余额不足时为当前余额和False
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET balance = balance - ?, total_bets = total_bets + ? "
+                "WHERE user_id = ? AND balance >= ?",
+                (amount, amount, user_id_str, amount)
+            )
+            row = conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id_str,)).fetchone()
+            return (row['balance'] if row is not None else 0), cursor.rowcount == 1
+
+    def _refund_bet(self, user_id_str: str, amount: int) -> bool:
+        """退还投注金额并从总投注中扣除，与 _debit_bet 相反（调用方需持有群组锁）"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET balance = balance + ?, total_bets = total_bets - ? WHERE user_id = ?",
+                (amount, amount, user_id_str)
+            )
+            return cursor.rowcount == 1
+
+    def add_game_record(self, user_id: int, game_type: str, bet_type: str, 
+                       bet_value: Any, bet_amount: int, result: List[int], 
+                       won: bool, winnings: int, is_group_game: bool = False, 
+                       group_id: Optional[int] = None) -> None:
+        """添加游戏记录"""
+        user_id_str = str(user_id)
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
-        if success:
-            # 记录此次反水
-            user_id_str = str(user_id)
-            self.rebate_records[user_id] = {
-                "last_claimed": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "total_bets": self.users[user_id_str]["total_bets"],
-                "amount": rebate_amount
+        with self._transaction() as conn:
+            # 为群组游戏分配编号：持久化的计数器在同一事务中加一，记录被删除后编号也不会重复
+            group_game_number = None
+            if is_group_game and group_id is not None:
+                conn.execute(
+                    "INSERT INTO group_game_counters (group_id, games) VALUES (?, 1) "
+                    "ON CONFLICT (group_id) DO UPDATE SET games = games + 1", (group_id,)
+                )
+                group_game_number = conn.execute(
+                    "SELECT games FROM group_game_counters WHERE group_id = ?", (group_id,)
+                ).fetchone()[0]
+            
+            row = conn.execute("SELECT name FROM users WHERE user_id = ?", (user_id_str,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE users SET games_played = games_played + 1 WHERE user_id = ?", (user_id_str,))
+            
+            conn.execute(
+                "INSERT INTO game_records (user_id, user_name, timestamp, game_type, bet_type, bet_value, "
+                "bet_amount, result, won, winnings, is_group_game, group_id, group_game_number) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id_str, row['name'] if row is not None else "未知用户", timestamp, game_type,
+                 bet_type, json.dumps(bet_value, ensure_ascii=False), bet_amount, json.dumps(result),
+                 int(won), winnings, int(is_group_game), group_id or None, group_game_number)
+            )
+            
+            # 更新全局统计
+            conn.execute(
+                "UPDATE global_stats SET total_games = total_games + 1, total_bets = total_bets + ?, "
+                "total_winnings = total_winnings + ? WHERE id = 1",
+                (bet_amount, winnings if won else 0)
+            )
+            if won:
+                conn.execute(
+                    "UPDATE global_stats SET biggest_win_user_id = ?, biggest_win_amount = ?, "
+                    "biggest_win_date = ? WHERE id = 1 AND biggest_win_amount < ?",
+                    (user_id_str, winnings, timestamp, winnings)
+                )
+
+    def get_user_history(self, user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+        """获取用户的游戏历史（最新的在前）"""
+        with self._conn_lock:
+            rows = self.conn.execute(
+                "SELECT * FROM game_records WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (str(user_id), limit)
+            ).fetchall()
+        history = []
+        for row in rows:
+            record = self._game_row_to_dict(row)
+            del record['user_id'], record['user_name']
+            history.append(record)
+        return history
+
+    def get_leaderboard(self, metric: str = 'balance', limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        获取排行榜
+        metric：'balance', 'total_winnings', 'games_played'
+        """
+        if metric not in self.LEADERBOARD_METRICS:
+            raise KeyError(metric)
+        rows = self._read_conn().execute(
+            f"SELECT * FROM users ORDER BY {metric} DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_group_history(self, chat_id: int, limit: int = 30) -> List[Dict[str, Any]]:
+        """获取指定群组的游戏历史（按游戏编号倒序）"""
+        with self._conn_lock:
+            rows = self.conn.execute(
+                "SELECT * FROM game_records WHERE is_group_game = 1 AND group_id = ? "
+                "ORDER BY group_game_number DESC LIMIT ?",
+                (int(chat_id), limit)
+            ).fetchall()
+        return [self._game_row_to_dict(row) for row in rows]
+
+    def count_group_games(self, chat_id: int) -> int:
+        """获取指定群组的游戏记录数"""
+        row = self._read_conn().execute(
+            "SELECT games FROM group_game_counters WHERE group_id = ?", (int(chat_id),)
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def get_recent_history(self, limit: int = 30) -> List[Dict[str, Any]]:
+        """获取最近的全局游戏记录（从旧到新）"""
+        with self._conn_lock:
+            rows = self.conn.execute(
+                "SELECT * FROM game_records ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._game_row_to_dict(row) for row in reversed(rows)]
+
+    def count_games(self) -> int:
+        """获取全局游戏记录数"""
+        with self._conn_lock:
+            return self.conn.execute("SELECT COUNT(*) FROM game_records").fetchone()[0]
+
+    def count_users(self) -> int:
+        """获取用户总数"""
+        with self._conn_lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def get_global_stats(self) -> Dict[str, Any]:
+        """获取全局统计信息"""
+        with self._conn_lock:
+            row = self.conn.execute("SELECT * FROM global_stats WHERE id = 1").fetchone()
+        return {
+            'total_games': row['total_games'],
+            'total_bets': row['total_bets'],
+            'total_winnings': row['total_winnings'],
+            'biggest_win': {
+                'user_id': row['biggest_win_user_id'],
+                'amount': row['biggest_win_amount'],
+                'date': row['biggest_win_date']
             }
+        }
+
+    def calculate_rebate(self, user_id: int) -> int:
+        """
+        计算用户的反水金额
+        每投注100金币，可以获得1金币的反水
+        """
+        with self._conn_lock:
+            row = self.conn.execute(
+                "SELECT u.total_bets AS total_bets, r.total_bets AS last_total_bets "
+                "FROM users u LEFT JOIN rebate_records r ON r.user_id = u.user_id WHERE u.user_id = ?",
+                (str(user_id),)
+            ).fetchone()
+        if row is None:
+            return 0
+        return (row['total_bets'] - (row['last_total_bets'] or 0)) // 100
+
+    def claim_rebate(self, user_id: int) -> Tuple[int, bool]:
+        """
+        用户领取反水，计算、加款和记录在同一事务中完成
+        返回：(反水金额, 是否成功)
+        """
+        user_id_str = str(user_id)
+        with self._transaction() as conn:
+            rebate_amount = self.calculate_rebate(user_id)
+            if rebate_amount <= 0:
+                return 0, False
             
-        return rebate_amount, success
+            conn.execute(
+                "UPDATE users SET balance = balance + ?, total_winnings = total_winnings + ? WHERE user_id = ?",
+                (rebate_amount, rebate_amount, user_id_str)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO rebate_records (user_id, last_claimed, total_bets, amount) "
+                "SELECT user_id, ?, total_bets, ? FROM users WHERE user_id = ?",
+                (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), rebate_amount, user_id_str)
+            )
+            return rebate_amount, True
+
+def shard_for_chat(chat_id: Optional[int], shard_count: int) -> int:
+    """会话所属的分片（工作进程）编号"""
+    return chat_id % shard_count if chat_id is not None else 0
+
+class ShardedSqliteDataManager(SqliteDataManager):
+    """
+    sharded 模式下工作进程的数据管理器
+    每个进程只在内存中保存自己分片的群组游戏和红包（红包ID以会话ID开头，只在所属会话中领取）
+    用户余额、游戏记录、反水、预设点数和封禁名单在多个进程间共享，每次都读写数据库
+    跨进程的写入由 SQLite 的 BEGIN IMMEDIATE 串行化，扣款使用带余额条件的 UPDATE，同一用户在不同群组下注不会透支
+    """
+
+    def __init__(self, data_file=SQLITE_FILE, shard_index: int = 0, shard_count: int = 1):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        super().__init__(data_file)
+
+    def owns_chat(self, chat_id: int) -> bool:
+        """会话是否属于本分片"""
+        return shard_for_chat(chat_id, self.shard_count) == self.shard_index
+
+    def load_data(self):
+        """打开数据库，只保留本分片的群组游戏和红包"""
+        super().load_data()
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS banned_users (user_id INTEGER PRIMARY KEY)")
+            self.group_games = {
+                chat_id_str: group_game for chat_id_str, group_game in self.group_games.items()
+                if self.owns_chat(int(chat_id_str))
+            }
+            # 预设点数可能由其它分片（管理员私聊）设置，不在内存中保存
+            self.group_fixed_dice = {}
+
+    def _load_hongbao(self) -> Dict[str, Dict[str, Any]]:
+        """从数据库读取本分片的红包信息"""
+        return {
+            hongbao_id: hongbao_info for hongbao_id, hongbao_info in super()._load_hongbao().items()
+            if self.owns_chat(int(hongbao_id.split("_", 1)[0]))
+        }
+
+    def set_fixed_dice(self, chat_id: int, dice_values: List[int]) -> bool:
+        """设置特定群组的固定骰子点数"""
+        if len(dice_values) != 3 or not all(1 <= d <= 6 for d in dice_values):
+            return False
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO fixed_dice (chat_id, dice, set_at) VALUES (?, ?, ?)",
+                (str(chat_id), json.dumps(dice_values), time.time())
+            )
+        return True
+
+    def get_fixed_dice(self, chat_id: int) -> Optional[List[int]]:
+        """获取特定群组的固定骰子点数"""
+        row = self._read_conn().execute("SELECT dice FROM fixed_dice WHERE chat_id = ?", (str(chat_id),)).fetchone()
+        return json.loads(row['dice']) if row is not None else None
+
+    def clear_fixed_dice(self, chat_id: int) -> None:
+        """清除特定群组的固定骰子点数"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM fixed_dice WHERE chat_id = ?", (str(chat_id),))
+
+    def expire_stale_entries(self) -> None:
+        """清理本分片过期的红包，以及所有过期的预设骰子点数（重复删除无影响）"""
+        super().expire_stale_entries()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM fixed_dice WHERE set_at <= ?", (time.time() - FIXED_DICE_EXPIRE_SECONDS,))
+
+    def is_banned(self, user_id: int) -> bool:
+        """检查用户是否被封禁"""
+        return self._read_conn().execute(
+            "SELECT 1 FROM banned_users WHERE user_id = ?", (user_id,)
+        ).fetchone() is not None
+
+    def ban_user(self, user_id: int) -> None:
+        """封禁用户"""
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
+
+    def unban_user(self, user_id: int) -> bool:
+        """解除用户封禁，返回是否成功"""
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM banned_users WHERE user_id = ?", (user_id,)).rowcount == 1
+
+def create_data_manager(backend: str = STORAGE_BACKEND) -> DataManager:
+    """根据配置创建数据管理器"""
+    if backend == "sqlite":
+        return SqliteDataManager()
+    if backend != "json":
+        logger.warning(f"未知的存储后端 {backend}，使用 JSON")
+    return DataManager()
+
+def migrate_json_to_sqlite(data_file: str = DATA_FILE, db_file: str = SQLITE_FILE) -> None:
+    """将 JSON 快照和日志中的数据一次性迁移到 SQLite 数据库"""
+    source = DataManager(data_file)
+    target = SqliteDataManager(db_file)
+
+    with source.lock, target.lock, target._transaction() as conn:
+        for user_id_str, user in source.users.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, name, balance, total_bets, total_winnings, "
+                "games_played, joined_date, last_activity, vip_level, daily_bonus_claimed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id_str, user['name'], user['balance'], user['total_bets'], user['total_winnings'],
+                 user['games_played'], user['joined_date'], user['last_activity'], user['vip_level'],
+                 user.get('daily_bonus_claimed'))
+            )
+
+        # 全局历史只保留最近1000条，用户历史中更早的记录也一并迁移
+        records = list(source.game_history)
+        seen = {(r['user_id'], r['timestamp'], r['bet_type'], r['bet_amount']) for r in records}
+        for user_id_str, user in source.users.items():
+            for record in source.get_user_history(int(user_id_str), USER_HISTORY_LIMIT):
+                key = (user_id_str, record['timestamp'], record['bet_type'], record['bet_amount'])
+                if key not in seen:
+                    records.append({'user_id': user_id_str, 'user_name': user['name'], **record})
+        records.sort(key=lambda r: r['timestamp'])
+
+        for record in records:
+            conn.execute(
+                "INSERT INTO game_records (user_id, user_name, timestamp, game_type, bet_type, bet_value, "
+                "bet_amount, result, won, winnings, is_group_game, group_id, group_game_number) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record['user_id'], record.get('user_name'), record['timestamp'], record['game_type'],
+                 record['bet_type'], json.dumps(record['bet_value'], ensure_ascii=False),
+                 record['bet_amount'], json.dumps(record['result']), int(record['won']),
+                 record['winnings'], int(record.get('is_group_game', False)),
+                 record.get('group_id'), record.get('group_game_number'))
+            )
+
+        # 群组游戏编号接着 JSON 中的计数继续，不从 1 重新开始
+        for group_id_str, games in source.group_game_counters.items():
+            conn.execute(
+                "INSERT INTO group_game_counters (group_id, games) VALUES (?, ?) "
+                "ON CONFLICT (group_id) DO UPDATE SET games = MAX(games, excluded.games)",
+                (int(group_id_str), games)
+            )
+
+        for chat_id_str, group_game in source.group_games.items():
+            target.group_games[chat_id_str] = group_game
+            target._save_group_game(chat_id_str)
+        for hongbao_id, hongbao_info in source.hongbao.items():
+            target.hongbao[hongbao_id] = hongbao_info
+            target._save_hongbao(hongbao_id)
+        for chat_id_str, fixed_dice in source.group_fixed_dice.items():
+            target.group_fixed_dice[chat_id_str] = fixed_dice
+            target._save_fixed_dice(chat_id_str)
+        for user_id_str, rebate_record in source.rebate_records.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO rebate_records (user_id, last_claimed, total_bets, amount) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id_str, rebate_record['last_claimed'], rebate_record['total_bets'], rebate_record['amount'])
+            )
+
+        stats = source.global_stats
+        conn.execute(
+            "UPDATE global_stats SET total_games = ?, total_bets = ?, total_winnings = ?, "
+            "biggest_win_user_id = ?, biggest_win_amount = ?, biggest_win_date = ? WHERE id = 1",
+            (stats['total_games'], stats['total_bets'], stats['total_winnings'],
+             stats['biggest_win']['user_id'], stats['biggest_win']['amount'], stats['biggest_win']['date'])
+        )
+
+    logger.info(f"迁移完成: {len(source.users)} 个用户, {len(records)} 条游戏记录 -> {db_file}")
 
 # ============== 游戏逻辑 ==============
 
@@ -1041,6 +3105,193 @@ class DiceGame:
 
 # ============== Telegram API 函数 ==============
 
+class _TokenBucket:
+    """令牌桶：按 rate 每秒补充令牌，最多 capacity 个；blocked_until 之前不发放令牌（收到 429 后设置）"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: int, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        """预订一个令牌，返回需要等待的秒数；令牌不足时记为负数，由之后补充的令牌抵消"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+class RateLimiter:
+    """
+    Telegram 发送频率限制：每个聊天一个令牌桶，另有一个全局令牌桶
+    超出频率的请求预订令牌后由出站线程池延后发送（不占用线程等待），而不是被 Telegram 拒绝后丢弃
+    """
+
+    # 统计排队等待时间时保留的最近次数
+    WAIT_WINDOW = 1000
+    # 聊天令牌桶超过此数量时清理空闲的桶
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float = API_GLOBAL_RATE, global_burst: int = API_GLOBAL_BURST):
+        now = time.monotonic()
+        self._lock = threading.Lock()
+        self._global = _TokenBucket(global_rate, global_burst, now)
+        self._chats = {}
+        self._deferred = 0
+        self._throttled = 0
+        self._waits = deque(maxlen=self.WAIT_WINDOW)
+
+    def _chat_bucket(self, chat_id: int, now: float) -> _TokenBucket:
+        """获取聊天的令牌桶（调用方需持有 self._lock）；群组ID为负数"""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                # 桶已补满且没有被暂停的聊天与新建的桶没有区别，可以丢弃
+                self._chats = {
+                    key: b for key, b in self._chats.items()
+                    if b.blocked_until > now or b.tokens + (now - b.updated) * b.rate < b.capacity
+                }
+            if chat_id < 0:
+                bucket = _TokenBucket(API_GROUP_CHAT_RATE, API_GROUP_CHAT_BURST, now)
+            else:
+                bucket = _TokenBucket(API_PRIVATE_CHAT_RATE, API_PRIVATE_CHAT_BURST, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def reserve(self, chat_id: Optional[int] = None) -> float:
+        """
+        预订向聊天发送一个请求的令牌（chat_id 为 None 时只受全局限制），返回还需等待的秒数
+        不等待，由调用方在这段时间之后发送
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._global.reserve(now)
+            if chat_id is not None:
+                wait = max(wait, self._chat_bucket(int(chat_id), now).reserve(now))
+            self._waits.append(wait)
+            if wait > 0:
+                self._deferred += 1
+        return wait
+
+    def penalize(self, chat_id: Optional[int], retry_after: float) -> None:
+        """收到 429 后在 retry_after 秒内暂停向该聊天发送（chat_id 为 None 时暂停全部发送）"""
+        with self._lock:
+            now = time.monotonic()
+            self._throttled += 1
+            bucket = self._chat_bucket(int(chat_id), now) if chat_id is not None else self._global
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def get_stats(self) -> Dict[str, float]:
+        """获取被延后发送的请求数、收到 429 的次数，以及排队等待时间（毫秒）"""
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = {'deferred': self._deferred, 'throttled': self._throttled, 'chats': len(self._chats)}
+        stats['wait_p50_ms'] = waits[len(waits) // 2] * 1000 if waits else 0.0
+        stats['wait_p99_ms'] = waits[min(len(waits) - 1, int(len(waits) * 0.99))] * 1000 if waits else 0.0
+        stats['wait_max_ms'] = waits[-1] * 1000 if waits else 0.0
+        return stats
+
+class RoundMessageCounter:
+    """
+    统计每个群组每局发送的 Telegram 请求数
+    请求提交到出站队列时计数（重试不重复计数），新一局开始时结束上一局的统计
+    """
+
+    def __init__(self, history: int = 100):
+        self._lock = _make_lock("RoundMessageCounter._lock")
+        self._current = {}  # {chat_id: 本局已发送的请求数}
+        self._rounds = deque(maxlen=history)  # 最近各局的请求数
+
+    def count(self, chat_id: int) -> None:
+        """记录向该群组发送了一个请求"""
+        with self._lock:
+            self._current[chat_id] = self._current.get(chat_id, 0) + 1
+
+    def finish_round(self, chat_id: int) -> int:
+        """结束该群组当前一局的统计，返回本局发送的请求数（第一局开始前没有请求，不计入）"""
+        with self._lock:
+            sent = self._current.pop(chat_id, 0)
+            if sent == 0:
+                return 0
+            self._rounds.append(sent)
+        logger.info(f"群组 {chat_id} 上一局共发送 {sent} 个请求")
+        return sent
+
+    def get_stats(self) -> Dict[str, float]:
+        """获取最近各局的局数、平均和最多请求数"""
+        with self._lock:
+            rounds = list(self._rounds)
+        return {
+            'rounds': len(rounds),
+            'avg': sum(rounds) / len(rounds) if rounds else 0.0,
+            'max': max(rounds) if rounds else 0,
+        }
+
+# 群组每局发送的请求数
+ROUND_MESSAGES = RoundMessageCounter()
+
+class TelegramRetryAfter(Exception):
+    """Telegram 返回 429，retry_after 秒后才能重试；由出站线程池延后重试"""
+
+    def __init__(self, retry_after: float, result: Dict[str, Any]):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.result = result
+
+class TelegramApiClient:
+    """
+    共用的 Telegram API 客户端
+    连接池复用 TCP/TLS 连接（keep-alive），所有请求都带连接和读取超时，不会无限等待
+    指定 rate_limiter 时 POST 请求都经出站线程池发送：频率限制和 429 重试在线程池中延后执行，
+    发送线程不等待；不在出站线程中的调用方等待结果
+    """
+
+    def __init__(self, pool_size: int = API_POOL_SIZE, connect_timeout: float = API_CONNECT_TIMEOUT,
+                 read_timeout: float = API_READ_TIMEOUT, rate_limiter: Optional[RateLimiter] = None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, method: str, data: Dict[str, Any] = None, files: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        调用 API 方法（POST），返回解析后的 JSON 响应
+        开启频率限制时，在出站线程中收到 429 抛出 TelegramRetryAfter，由出站线程池延后重试
+        """
+        chat_id = data.get("chat_id") if data else None
+        if self.rate_limiter is not None and not TELEGRAM_OUTBOX.in_worker():
+            # 交给出站线程池按频率限制发送，等待结果
+            return TELEGRAM_OUTBOX.submit(chat_id, self.post, method, data, files).result()
+
+        if files:
+            # 429 后重试时上一次发送已经把文件读到末尾，每次发送前回到开头
+            for value in files.values():
+                file_obj = value[1] if isinstance(value, tuple) else value
+                if hasattr(file_obj, "seek"):
+                    file_obj.seek(0)
+
+        result = self.session.post(f"{API_URL}/{method}", data=data, files=files,
+                                   timeout=(self.connect_timeout, self.read_timeout)).json()
+        if result.get("error_code") == 429 and self.rate_limiter is not None:
+            raise TelegramRetryAfter((result.get("parameters") or {}).get("retry_after", 1), result)
+        return result
+
+    def get(self, method: str, params: Dict[str, Any] = None, read_timeout: float = None) -> Dict[str, Any]:
+        """调用 API 方法（GET），返回解析后的 JSON 响应"""
+        response = self.session.get(f"{API_URL}/{method}", params=params,
+                                    timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+        return response.json()
+
+# 所有 Telegram API 请求共用一个客户端和频率限制
+TELEGRAM_API = TelegramApiClient(rate_limiter=RateLimiter())
+
 def send_message(chat_id: int, text: str, parse_mode: str = "Markdown", 
                 reply_markup: Dict = None, reply_to_message_id: int = None) -> Dict[str, Any]:
     """发送消息到Telegram"""
@@ -1057,11 +3308,12 @@ def send_message(chat_id: int, text: str, parse_mode: str = "Markdown",
         payload["reply_to_message_id"] = reply_to_message_id
     
     try:
-        response = requests.post(f"{API_URL}/sendMessage", data=payload)
-        result = response.json()
+        result = TELEGRAM_API.post("sendMessage", data=payload)
         if not result.get("ok"):
             logger.error(f"发送消息失败: {result}")
         return result
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
         logger.error(f"发送消息异常: {e}")
         return {}
@@ -1092,8 +3344,7 @@ def edit_message_text(chat_id: int, message_id: int, text: str,
         if reply_markup:
             payload["reply_markup"] = json.dumps(reply_markup)
         
-        response = requests.post(f"{API_URL}/editMessageText", data=payload)
-        result = response.json()
+        result = TELEGRAM_API.post("editMessageText", data=payload)
         
         if not result.get("ok"):
             logger.error(f"编辑消息失败: {result}")
@@ -1102,6 +3353,8 @@ def edit_message_text(chat_id: int, message_id: int, text: str,
                 logger.info("尝试发送新消息而不是编辑")
                 return send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
         return result
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
         logger.error(f"编辑消息异常: {e}")
         # Fallback to sending new message
@@ -1124,11 +3377,12 @@ def answer_callback_query(callback_query_id: str, text: str = None,
         payload["show_alert"] = "true"
     
     try:
-        response = requests.post(f"{API_URL}/answerCallbackQuery", data=payload)
-        result = response.json()
+        result = TELEGRAM_API.post("answerCallbackQuery", data=payload)
         if not result.get("ok"):
             logger.error(f"回答回调查询失败: {result}")
         return result
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
         logger.error(f"回答回调查询异常: {e}")
         return {}
@@ -1145,11 +3399,12 @@ def send_dice(chat_id: int, emoji: str = "🎲",
         payload["reply_to_message_id"] = reply_to_message_id
     
     try:
-        response = requests.post(f"{API_URL}/sendDice", data=payload)
-        result = response.json()
+        result = TELEGRAM_API.post("sendDice", data=payload)
         if not result.get("ok"):
             logger.error(f"发送骰子失败: {result}")
         return result
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
         logger.error(f"发送骰子异常: {e}")
         return {}
@@ -1164,8 +3419,8 @@ def get_updates(offset: int = None, timeout: int = 60) -> List[Dict[str, Any]]:
         params["offset"] = offset
     
     try:
-        response = requests.get(f"{API_URL}/getUpdates", params=params)
-        result = response.json()
+        # 长轮询期间服务端最多等待 timeout 秒，读取超时要比它长
+        result = TELEGRAM_API.get("getUpdates", params=params, read_timeout=timeout + API_READ_TIMEOUT)
         if result.get("ok"):
             return result.get("result", [])
         logger.error(f"获取更新错误: {result}")
@@ -1174,6 +3429,34 @@ def get_updates(offset: int = None, timeout: int = 60) -> List[Dict[str, Any]]:
         logger.error(f"获取更新错误: {e}")
         return []
 
+def delete_webhook() -> Dict[str, Any]:
+    """删除 webhook，恢复 getUpdates（未设置 webhook 时也返回成功）"""
+    try:
+        result = TELEGRAM_API.post("deleteWebhook")
+        if not result.get("ok"):
+            logger.error(f"删除 webhook 失败: {result}")
+        return result
+    except Exception as e:
+        logger.error(f"删除 webhook 异常: {e}")
+        return {}
+
+def set_webhook(url: str, secret_token: str, max_connections: int = WEBHOOK_MAX_CONNECTIONS) -> Dict[str, Any]:
+    """注册 webhook，之后 Telegram 把更新推送到 url（注册期间 getUpdates 不可用）"""
+    payload = {
+        "url": url,
+        "secret_token": secret_token,
+        "max_connections": max_connections
+    }
+    
+    try:
+        result = TELEGRAM_API.post("setWebhook", data=payload)
+        if not result.get("ok"):
+            logger.error(f"设置 webhook 失败: {result}")
+        return result
+    except Exception as e:
+        logger.error(f"设置 webhook 异常: {e}")
+        return {}
+
 def send_photo(chat_id: int, photo_data: bytes, caption: str = None, 
                parse_mode: str = "Markdown") -> Dict[str, Any]:
     """发送图片到Telegram"""
@@ -1188,11 +3471,12 @@ def send_photo(chat_id: int, photo_data: bytes, caption: str = None,
         payload["parse_mode"] = parse_mode
     
     try:
-        response = requests.post(f"{API_URL}/sendPhoto", data=payload, files=files)
-        result = response.json()
+        result = TELEGRAM_API.post("sendPhoto", data=payload, files=files)
         if not result.get("ok"):
             logger.error(f"发送图片失败: {result}")
         return result
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
         logger.error(f"发送图片异常: {e}")
         return {}
@@ -1215,11 +3499,12 @@ def send_animation(chat_id: int, animation_path: str, caption: str = None,
             if reply_markup:
                 payload["reply_markup"] = json.dumps(reply_markup)
             
-            response = requests.post(f"{API_URL}/sendAnimation", data=payload, files=files)
-            result = response.json()
+            result = TELEGRAM_API.post("sendAnimation", data=payload, files=files)
             if not result.get("ok"):
                 logger.error(f"发送动画失败: {result}")
             return result
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
         logger.error(f"发送动画异常: {e}")
         return {}
@@ -1462,8 +3747,8 @@ def handle_play_command(message: Dict[str, Any], data_manager: DataManager) -> N
     is_group = chat_id < 0
     
     if is_group:
-        # 如果是群聊，开始群组游戏
-        handle_start_group_game(message, data_manager)
+        # 如果是群聊，在群组邮箱中开始群组游戏
+        GROUP_MAILBOXES.post(chat_id, handle_start_group_game, message, data_manager)
         return
     
     # 私人游戏
@@ -1526,78 +3811,378 @@ def handle_play_command(message: Dict[str, Any], data_manager: DataManager) -> N
     if result.get("ok"):
         USER_STATES[user_id]["message_id"] = result["result"]["message_id"]
 
+class _ScheduledTimer:
+    """调度器中的一个定时任务，可用于取消"""
+    __slots__ = ('due', 'fn', 'args', 'cancelled', 'fired')
+
+    def __init__(self, due: float, fn, args: tuple):
+        self.due = due
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+class TimerScheduler:
+    """
+    单线程定时调度器（最小堆）
+    所有群组的倒计时、摇骰子期限、掷骰间隔和自动开局都由同一个线程按时触发
+    回调在调度线程中执行，应尽快返回（通常只是投递到群组邮箱）
+    """
+
+    # 统计调度延迟时保留的最近触发次数
+    LAG_WINDOW = 1000
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # [(到期时间, 序号, 定时任务)]，取消的任务在到期或堆压缩时移除
+        self._heap = []
+        self._seq = 0
+        self._cancelled = 0
+        self._thread = None
+        # 调度延迟：实际触发时间与计划时间之差（秒）
+        self._fired = 0
+        self._lags = deque(maxlen=self.LAG_WINDOW)
+        self._max_lag = 0.0
+
+    def schedule(self, delay: float, fn, *args) -> _ScheduledTimer:
+        """delay 秒后在调度线程中调用 fn(*args)，返回可用于取消的定时任务"""
+        timer = _ScheduledTimer(time.monotonic() + max(0.0, delay), fn, args)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._seq += 1
+            heapq.heappush(self._heap, (timer.due, self._seq, timer))
+            # 只有新任务成为最早到期的任务时才需要唤醒调度线程
+            if self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def cancel(self, timer: _ScheduledTimer) -> bool:
+        """取消定时任务，返回是否在触发前取消成功"""
+        with self._cond:
+            if timer.cancelled or timer.fired:
+                return False
+            timer.cancelled = True
+            self._cancelled += 1
+            # 取消的任务过多时压缩堆，避免长时间占用内存
+            if self._cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+            return True
+
+    def get_stats(self) -> Dict[str, float]:
+        """获取待触发任务数、已触发次数和调度延迟（毫秒，最近 LAG_WINDOW 次）"""
+        with self._cond:
+            lags = sorted(self._lags)
+            return {
+                'pending': len(self._heap) - self._cancelled,
+                'fired': self._fired,
+                'lag_p50_ms': lags[len(lags) // 2] * 1000 if lags else 0.0,
+                'lag_p99_ms': lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000 if lags else 0.0,
+                'lag_max_ms': self._max_lag * 1000
+            }
+
+    def _run(self) -> None:
+        """调度线程：等待最早到期的任务并触发"""
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, timer = heapq.heappop(self._heap)
+                if timer.cancelled:
+                    self._cancelled -= 1
+                    continue
+                timer.fired = True
+                lag = time.monotonic() - timer.due
+                self._fired += 1
+                self._lags.append(lag)
+                self._max_lag = max(self._max_lag, lag)
+            try:
+                timer.fn(*timer.args)
+            except Exception as e:
+                logger.error(f"定时任务 {timer.fn.__name__} 出错: {e}", exc_info=True)
+
+class ChatMailboxes:
+    """
+    每个群组（或私聊会话）一个串行邮箱，由固定数量的工作线程处理
+    同一群组的下注、摇骰子、倒计时和结算按投递顺序逐个执行，不同群组并行执行
+    延迟任务由共用的定时调度器到期后投递，可按群组取消
+    """
+
+    def __init__(self, workers: int = GROUP_WORKER_THREADS, scheduler: Optional[TimerScheduler] = None,
+                 max_pending: int = 0):
+        self._workers = workers
+        self.scheduler = scheduler or TimerScheduler()
+        self._lock = threading.Lock()
+        # 待处理任务总数达到 max_pending 时 post 阻塞，直到工作线程处理掉一部分（0 表示不限制）
+        # 只能用于不会从工作线程或调度线程中投递的邮箱，否则会自己等自己
+        self._max_pending = max_pending
+        self._not_full = threading.Condition(self._lock)
+        self._pending = 0
+        self._blocked_posts = 0
+        self._blocked_seconds = 0.0
+        # 有待处理或正在处理任务的群组 {chat_id: deque[(函数, 参数)]}
+        self._mailboxes = {}
+        # 有待处理任务、且没有工作线程正在处理的群组
+        self._ready = queue.Queue()
+        # 每个群组尚未触发的延迟任务 {chat_id: [定时任务]}
+        self._chat_timers = {}
+        self._started = False
+        # 工作线程的线程局部状态：是否是本邮箱的工作线程，以及当前任务要求的延后重试
+        self._local = threading.local()
+
+    def _start(self) -> None:
+        """首次投递时启动工作线程（调用方需持有 self._lock）"""
+        if self._started:
+            return
+        self._started = True
+        for _ in range(self._workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def post(self, chat_id: int, fn, *args) -> None:
+        """向群组邮箱投递一个任务"""
+        with self._lock:
+            self._start()
+            if self._max_pending and self._pending >= self._max_pending:
+                self._blocked_posts += 1
+                started = time.monotonic()
+                while self._pending >= self._max_pending:
+                    self._not_full.wait()
+                self._blocked_seconds += time.monotonic() - started
+            self._pending += 1
+            mailbox = self._mailboxes.get(chat_id)
+            if mailbox is None:
+                self._mailboxes[chat_id] = deque([(fn, args)])
+                self._ready.put(chat_id)
+            else:
+                # 正在处理中的群组由工作线程处理完当前任务后重新排队
+                mailbox.append((fn, args))
+
+    def in_worker(self) -> bool:
+        """当前线程是否是本邮箱的工作线程"""
+        return getattr(self._local, 'worker', False)
+
+    def retry_later(self, delay: float, fn, *args) -> None:
+        """
+        在工作线程中调用：当前任务返回后把 fn(*args) 放回本群组邮箱的队首，delay 秒后再处理
+        期间该群组的后续任务排在它后面（保持顺序），工作线程不等待，继续处理其它群组
+        """
+        self._local.retry = (delay, fn, args)
+
+    def post_later(self, delay: float, chat_id: int, fn, *args) -> _ScheduledTimer:
+        """delay 秒后向群组邮箱投递一个任务，返回可用于取消的定时任务"""
+        timer = self.scheduler.schedule(delay, self.post, chat_id, fn, *args)
+        with self._lock:
+            timers = [t for t in self._chat_timers.get(chat_id, []) if not (t.fired or t.cancelled)]
+            timers.append(timer)
+            self._chat_timers[chat_id] = timers
+        return timer
+
+    def cancel_timers(self, chat_id: int) -> int:
+        """取消群组所有尚未触发的延迟任务，返回取消的数量"""
+        with self._lock:
+            timers = self._chat_timers.pop(chat_id, [])
+        return sum(1 for timer in timers if self.scheduler.cancel(timer))
+
+    def get_stats(self) -> Dict[str, float]:
+        """获取待处理的群组数、任务数、最深的邮箱、背压阻塞统计，以及定时调度器的统计"""
+        with self._lock:
+            depths = [len(mailbox) for mailbox in self._mailboxes.values()]
+            stats = {
+                'chats': len(depths),
+                'tasks': sum(depths),
+                'max_depth': max(depths, default=0),
+                'blocked_posts': self._blocked_posts,
+                'blocked_ms': self._blocked_seconds * 1000
+            }
+        stats.update(self.scheduler.get_stats())
+        return stats
+
+    def get_depths(self, limit: int = 5) -> List[Tuple[int, int]]:
+        """获取积压最多的邮箱 [(chat_id, 待处理任务数)]"""
+        with self._lock:
+            depths = [(chat_id, len(mailbox)) for chat_id, mailbox in self._mailboxes.items()]
+        depths.sort(key=lambda item: item[1], reverse=True)
+        return depths[:limit]
+
+    def _work(self) -> None:
+        """工作线程：每次取一个群组执行一个任务，然后把群组重新排到队尾，各群组轮流执行"""
+        self._local.worker = True
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                fn, args = self._mailboxes[chat_id].popleft()
+            self._local.retry = None
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"群组 {chat_id} 执行 {fn.__name__} 出错: {e}", exc_info=True)
+            retry = self._local.retry
+            with self._lock:
+                if retry is not None:
+                    # 任务仍然待处理，群组暂不排队，到期后由调度器重新排队
+                    delay, retry_fn, retry_args = retry
+                    self._mailboxes[chat_id].appendleft((retry_fn, retry_args))
+                    self.scheduler.schedule(delay, self._ready.put, chat_id)
+                    continue
+                self._pending -= 1
+                if self._max_pending:
+                    self._not_full.notify()
+                if self._mailboxes[chat_id]:
+                    self._ready.put(chat_id)
+                else:
+                    del self._mailboxes[chat_id]
+
+# 所有群组游戏事件都通过群组邮箱处理
+GROUP_MAILBOXES = ChatMailboxes()
+
+# threaded 模式下 Telegram 更新按会话分发到工作线程，积压过多时主循环暂停拉取
+UPDATE_DISPATCHER = ChatMailboxes(UPDATE_WORKER_THREADS, max_pending=UPDATE_QUEUE_LIMIT)
+
+class TelegramOutbox:
+    """
+    出站 Telegram 请求的有界工作线程池
+    提交后立即返回 Future，游戏逻辑不必等待网络往返；需要 message_id 等返回值时再等待 Future
+    同一聊天的请求按提交顺序逐个发送，保证消息在聊天中的顺序
+    超出频率限制或收到 429 的请求连同该聊天后续的请求一起延后，由定时调度器到期后继续，
+    工作线程不等待，继续发送其它聊天的请求
+    """
+
+    # 统计每种请求延迟时保留的最近次数
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, workers: int = OUTBOUND_WORKER_THREADS, max_pending: int = OUTBOUND_QUEUE_LIMIT):
+        self._mailboxes = ChatMailboxes(workers, max_pending=max_pending)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # 每种请求最近的耗时（秒） {方法名: deque}
+        self._latencies = {}
+
+    def submit(self, chat_id: int, fn, *args, **kwargs) -> Future:
+        """提交一个请求 fn(*args, **kwargs)，按 chat_id 排队，返回结果的 Future"""
+        future = Future()
+        if chat_id is not None and int(chat_id) < 0:
+            ROUND_MESSAGES.count(int(chat_id))
+        self._mailboxes.post(chat_id, self._call, chat_id, future, fn, args, kwargs)
+        return future
+
+    def in_worker(self) -> bool:
+        """当前线程是否是出站工作线程"""
+        return self._mailboxes.in_worker()
+
+    def _call(self, chat_id: Optional[int], future: Future, fn, args: tuple, kwargs: Dict[str, Any],
+              retries: int = 0, reserved: bool = False) -> None:
+        """在工作线程中执行请求并设置 Future 的结果；需要等待时放回队首延后执行"""
+        if not future.running() and not future.set_running_or_notify_cancel():
+            return
+        rate_limiter = TELEGRAM_API.rate_limiter
+        if rate_limiter is not None and not reserved:
+            wait = rate_limiter.reserve(chat_id)
+            if wait > 0:
+                # 令牌已预订，到时直接发送
+                self._mailboxes.retry_later(wait, self._call, chat_id, future, fn, args, kwargs, retries, True)
+                return
+        with self._lock:
+            self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except TelegramRetryAfter as e:
+            if rate_limiter is None or retries >= API_MAX_RETRIES:
+                future.set_result(e.result)
+            else:
+                logger.warning(f"{fn.__name__} 触发频率限制（聊天 {chat_id}），{e.retry_after} 秒后重试")
+                rate_limiter.penalize(chat_id, e.retry_after)
+                self._mailboxes.retry_later(e.retry_after, self._call, chat_id, future, fn, args, kwargs,
+                                            retries + 1, False)
+        except Exception as e:
+            logger.error(f"发送 {fn.__name__} 出错: {e}")
+            future.set_exception(e)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._in_flight -= 1
+                latencies = self._latencies.get(fn.__name__)
+                if latencies is None:
+                    latencies = self._latencies[fn.__name__] = deque(maxlen=self.LATENCY_WINDOW)
+                latencies.append(elapsed)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取排队的请求数、正在发送的请求数，以及每种请求的延迟（毫秒）"""
+        mailbox_stats = self._mailboxes.get_stats()
+        with self._lock:
+            latencies = {method: sorted(values) for method, values in self._latencies.items()}
+            in_flight = self._in_flight
+        return {
+            'queued': mailbox_stats['tasks'],
+            'in_flight': in_flight,
+            'blocked_posts': mailbox_stats['blocked_posts'],
+            'methods': {
+                method: {
+                    'count': len(values),
+                    'p50_ms': values[len(values) // 2] * 1000,
+                    'p99_ms': values[min(len(values) - 1, int(len(values) * 0.99))] * 1000
+                }
+                for method, values in latencies.items()
+            }
+        }
+
+# 游戏逻辑发出的 Telegram 请求都通过出站线程池发送
+TELEGRAM_OUTBOX = TelegramOutbox()
+
+def send_message_nowait(chat_id: int, text: str, parse_mode: str = "Markdown",
+                        reply_markup: Dict = None, reply_to_message_id: int = None) -> Future:
+    """发送消息但不等待，返回 send_message 结果的 Future"""
+    return TELEGRAM_OUTBOX.submit(chat_id, send_message, chat_id, text, parse_mode, reply_markup, reply_to_message_id)
+
+def edit_message_text_nowait(chat_id: int, message_id: int, text: str,
+                             parse_mode: str = "Markdown", reply_markup: Dict = None) -> Future:
+    """编辑消息但不等待，返回 edit_message_text 结果的 Future"""
+    return TELEGRAM_OUTBOX.submit(chat_id, edit_message_text, chat_id, message_id, text, parse_mode, reply_markup)
+
 def handle_start_group_game(message: Dict[str, Any], data_manager: DataManager) -> None:
-    """开始群组游戏"""
+    """开始群组游戏（在群组邮箱中执行）"""
     chat_id = message["chat"]["id"]
     
-    # 获取群组游戏状态
-    group_game = data_manager.get_group_game(chat_id)
-    
-    # 如果已经有游戏在进行中，不要重新开始
-    if group_game['state'] == GROUP_GAME_BETTING:
+    # 开始新游戏，如果已经有游戏在进行中，不要重新开始
+    start_time = data_manager.start_group_game(chat_id)
+    if start_time is None:
         return
     
-    # 开始新游戏
-    group_game['state'] = GROUP_GAME_BETTING
-    group_game['bets'] = {}
-    group_game['start_time'] = time.time()
+    # 上一局的消息都已提交到出站队列，结束上一局的请求统计
+    ROUND_MESSAGES.finish_round(chat_id)
     
-    # 发送游戏开始消息
+    # 发送游戏开始消息，排在上一局结果之后发送；不等待发送完成，
+    # 发送完成后回到群组邮箱记录消息ID并开始倒计时
     start_message = GROUP_GAME_START_MESSAGE.format(wait_time=GROUP_GAME_WAIT_TIME)
-    result = send_message(chat_id, start_message)
-    
+    send_message_nowait(chat_id, start_message).add_done_callback(
+        lambda future: GROUP_MAILBOXES.post(chat_id, record_start_message, chat_id, data_manager,
+                                            start_time, future)
+    )
+
+def record_start_message(chat_id: int, data_manager: DataManager, start_time: float,
+                         start_future: Future) -> None:
+    """记录开始消息的ID，倒计时编辑这条消息（在群组邮箱中执行）"""
+    result = start_future.result() if start_future.exception() is None else {}
     if result.get("ok"):
-        group_game['message_id'] = result["result"]["message_id"]
-    
-    # 更新群组游戏状态
-    data_manager.update_group_game(chat_id, group_game)
+        data_manager.set_group_game_message(chat_id, start_time, result["result"]["message_id"])
     
-    # 启动倒计时线程
-    countdown_thread = threading.Thread(
-        target=group_game_countdown,
-        args=(chat_id, data_manager),
-        daemon=True
-    )
-    countdown_thread.start()
+    # 倒计时按开始时间计算截止时刻，等待发送的时间不会延长投注时间
+    group_game_countdown(chat_id, data_manager, start_time)
 
-def group_game_countdown(chat_id: int, data_manager: DataManager) -> None:
-    """群组游戏倒计时"""
-    group_game = data_manager.get_group_game(chat_id)
-    start_time = group_game['start_time']
-    message_id = group_game['message_id']
-    
-    # 倒计时
-    for remaining in range(GROUP_GAME_WAIT_TIME - 10, 0, -10):
-        # 检查游戏是否被取消
-        current_game = data_manager.get_group_game(chat_id)
-        if current_game['state'] != GROUP_GAME_BETTING:
-            return
-        
-        # 计算实际剩余时间
-        elapsed = time.time() - start_time
-        actual_remaining = max(1, int(GROUP_GAME_WAIT_TIME - elapsed))
-        
-        if actual_remaining <= 0:
-            break
-        
-        # 每10秒更新一次倒计时消息
-        if actual_remaining > 10:
-            # 获取已下注玩家及投注额
-            bets = current_game.get('bets', {})
-            player_count = len(bets)
-            high_rollers_count = 0
-            
-            # 计算1000金币以上玩家数量
-            for user_id_str, user_bets in bets.items():
-                total_bet = sum(bet['amount'] for bet in user_bets)
-                if total_bet >= 1000:
-                    high_rollers_count += 1
-            
-            # 更新消息加入高额玩家可摇骰子的提示
-            countdown_message = f"""
+def render_countdown(remaining: float, key: tuple) -> str:
+    """倒计时消息文本，key 为 CountdownView 中的可见内容"""
+    if len(key) == 1:
+        return GROUP_GAME_COUNTDOWN_MESSAGE.format(remaining=int(round(remaining)))
+    
+    _, player_count, high_rollers_count = key
+    # 更新消息加入高额玩家可摇骰子的提示
+    return f"""
 🎲 *骰子游戏进行中* 🎲
 
-⏳ 倒计时: {actual_remaining} 秒
+⏳ 倒计时: {int(round(remaining))} 秒
 👥 已下注: {player_count} 人
 💰 高额玩家: {high_rollers_count} 人
 
@@ -1607,26 +4192,97 @@ def group_game_countdown(chat_id: int, data_manager: DataManager) -> None:
 豹子1 200
 
 📢 投注1000金币以上可获得摇骰子机会！
-            """
-            
-            edit_message_text(chat_id, message_id, countdown_message)
-        
-        time.sleep(min(10, actual_remaining - 1))
-    
-    # 最后10秒倒计时
-    for remaining in range(10, 0, -1):
-        # 检查游戏是否被取消
-        current_game = data_manager.get_group_game(chat_id)
-        if current_game['state'] != GROUP_GAME_BETTING:
-            return
-        
-        countdown_message = GROUP_GAME_COUNTDOWN_MESSAGE.format(remaining=remaining)
-        edit_message_text(chat_id, message_id, countdown_message)
-        
-        time.sleep(1)
-    
+        """
+
+class CountdownView:
+    """
+    群组倒计时消息的渲染状态，在同一局的各次倒计时更新之间传递（只在群组邮箱中访问）
+    记录最后一次发送的可见内容和编辑请求，内容不变或上一次编辑还没完成时不再编辑
+    """
+    __slots__ = ('deadline', 'key', 'edit', 'edited_at', 'edits', 'skipped')
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline  # 投注截止的单调时钟时刻
+        self.key = None  # 最后一次发送的可见内容
+        self.edit = None  # 最后一次编辑请求的 Future
+        self.edited_at = 0.0
+        self.edits = 0
+        self.skipped = 0
+
+def countdown_bucket(remaining: float) -> int:
+    """
+    倒计时显示的时间段：超过10秒按10秒分段，最后10秒在 COUNTDOWN_FINAL_MARKS 处分段
+    只有进入新的时间段（或玩家人数变化）时才编辑倒计时消息
+    """
+    if remaining > 10:
+        return int(math.ceil(remaining / 10 - 1e-6)) * 10
+    return min((mark for mark in COUNTDOWN_FINAL_MARKS if mark >= remaining - 1e-6), default=COUNTDOWN_FINAL_MARKS[0])
+
+def group_game_countdown(chat_id: int, data_manager: DataManager, start_time: float,
+                         view: Optional[CountdownView] = None) -> None:
+    """
+    群组游戏倒计时的一次更新（在群组邮箱中执行）
+    每 COUNTDOWN_TICK 秒检查一次，可见内容（时间段、已下注人数、高额玩家人数）变化时才编辑消息，
+    上一次编辑还在发送中时跳过本次，下次检查再发送最新内容
+    按单调时钟的截止时刻投递下一次检查，倒计时结束后选择摇骰子玩家或直接开奖
+    """
+    current_game = data_manager.get_group_game(chat_id)
+
+    # 检查游戏是否被取消，或者已经是新的一局
+    if current_game['state'] != GROUP_GAME_BETTING or current_game['start_time'] != start_time:
+        return
+
+    if view is None:
+        # 开始时间是持久化的墙上时间（重启后继续倒计时），只在第一次换算成单调时钟的截止时刻
+        view = CountdownView(time.monotonic() + GROUP_GAME_WAIT_TIME - (time.time() - start_time))
+
+    remaining = view.deadline - time.monotonic()
+
+    if remaining > 0:
+        bucket = countdown_bucket(remaining)
+        if remaining > 10:
+            # 获取已下注玩家及投注额
+            bets = current_game.get('bets', {})
+            player_count = len(bets)
+            # 计算1000金币以上玩家数量
+            high_rollers_count = sum(
+                1 for user_bets in bets.values()
+                if sum(bet['amount'] for bet in user_bets) >= HIGH_ROLLER_THRESHOLD
+            )
+            key = (bucket, player_count, high_rollers_count)
+        else:
+            # 最后10秒只显示剩余时间
+            key = (bucket,)
+
+        now = time.monotonic()
+        if key != view.key:
+            if view.edit is not None and not view.edit.done():
+                view.skipped += 1
+            elif current_game['message_id'] is None:
+                # 开始消息发送失败，没有可编辑的消息
+                view.skipped += 1
+            elif view.key is not None and key[0] == view.key[0] and now - view.edited_at < COUNTDOWN_MIN_EDIT_INTERVAL:
+                # 只有人数变化时限制编辑频率
+                view.skipped += 1
+            else:
+                view.key = key
+                view.edited_at = now
+                view.edits += 1
+                view.edit = edit_message_text_nowait(chat_id, current_game['message_id'],
+                                                     render_countdown(remaining, key))
+
+        # 按截止时刻计算下一次检查的时刻，处理和发送的耗时不会累积
+        next_remaining = max(0, math.ceil(remaining / COUNTDOWN_TICK - 0.05) - 1) * COUNTDOWN_TICK
+        GROUP_MAILBOXES.post_later(max(0, remaining - next_remaining), chat_id, group_game_countdown,
+                                   chat_id, data_manager, start_time, view)
+        return
+
+    logger.info(f"群组 {chat_id} 倒计时结束，编辑消息 {view.edits} 次，跳过 {view.skipped} 次")
+    # 投注截止，先发出还在缓存中的投注确认
+    flush_bet_confirmations(chat_id)
+
     # 游戏结束，查找投注1000以上的玩家
-    final_game = data_manager.get_group_game(chat_id)
+    final_game = current_game
     bets = final_game.get('bets', {})
     high_rollers = {}  # 存储投注1000以上的玩家
     
@@ -1660,16 +4316,19 @@ def group_game_countdown(chat_id: int, data_manager: DataManager) -> None:
 ⏳ 如不摇骰子，将在20秒后自动开始...
         """
         
-        edit_message_text(chat_id, message_id, invite_text)
+        if final_game['message_id'] is None:
+            send_message_nowait(chat_id, invite_text)
+        else:
+            edit_message_text_nowait(chat_id, final_game['message_id'], invite_text)
         
-        # 创建计时器，20秒后检查是否需要自动摇骰子
-        threading.Timer(20, check_and_roll_dice, args=(chat_id, data_manager)).start()
+        # 20秒后检查是否需要自动摇骰子
+        GROUP_MAILBOXES.post_later(20, chat_id, check_and_roll_dice, chat_id, data_manager)
     else:
         # 没有高额投注者，直接开始摇骰子
         process_group_game_result(chat_id, data_manager)
 
 def check_and_roll_dice(chat_id: int, data_manager: DataManager) -> None:
-    """检查是否有人摇骰子，如果没有则自动开始"""
+    """检查是否有人摇骰子，如果没有则自动开始（在群组邮箱中执行）"""
     # 获取群组游戏状态
     group_game = data_manager.get_group_game(chat_id)
     
@@ -1693,16 +4352,16 @@ def check_and_roll_dice(chat_id: int, data_manager: DataManager) -> None:
 骰子将自动进行...
     """
     
-    try:
-        send_message(chat_id, auto_roll_message)
-    except Exception as e:
-        logger.error(f"发送自动摇骰子消息失败: {e}")
+    send_message_nowait(chat_id, auto_roll_message)
     
     # 处理游戏结果
     process_group_game_result(chat_id, data_manager)
 
 def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
-    """处理群组游戏结果"""
+    """
+    处理群组游戏结果：开始掷骰子（在群组邮箱中执行）
+    掷骰间隔、动画展示时间和下一局的开始都作为定时任务投递，不占用工作线程
+    """
     # 获取群组游戏状态
     group_game = data_manager.get_group_game(chat_id)
     
@@ -1710,16 +4369,6 @@ def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
     group_game['state'] = GROUP_GAME_ROLLING
     data_manager.update_group_game(chat_id, group_game)
     
-    # 发送正在摇骰子的消息
-    bet_count = len([bet for bets in group_game.get('bets', {}).values() for bet in bets])
-    player_count = len(group_game.get('bets', {}))
-    total_amount = sum([bet['amount'] for bets in group_game.get('bets', {}).values() for bet in bets])
-    
-    # 掷骰子时不发送游戏开始提示，直接掷骰子
-    
-    # 检查该群组是否有设定的骰子点数
-    fixed_dice = data_manager.get_fixed_dice(chat_id)
-    
     # 检查是否有用户已经发送了骰子表情
     user_dice_values = group_game.get("user_dice_values", [])
     
@@ -1728,34 +4377,65 @@ def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
     
     # 如果用户已经发送了足够的骰子表情，则使用这些点数
     if is_user_roll and len(user_dice_values) >= 3:
-        dice_result = user_dice_values[:3]  # 只使用前3个
         # 不需要额外发送骰子动画
+        finish_group_dice(chat_id, data_manager, group_game['start_time'], user_dice_values[:3])
     else:
         # 通过API发送真实骰子动画 (3个)
-        dice_result = []
-        
-        for dice_num in range(1, 4):  # 1, 2, 3
-            dice_response = send_dice(chat_id, emoji="🎲")
-            if dice_response.get("ok"):
-                # Telegram骰子API返回的值是1-6
-                value = dice_response["result"]["dice"]["value"]
-                dice_result.append(value)
-                
-                # 不再单独显示每个骰子的点数
-                # 让Telegram的原生骰子动画直接展示效果
-                
-                time.sleep(1.0)  # 短暂延迟，使骰子动画有序显示
+        roll_group_dice(chat_id, data_manager, group_game['start_time'], [], 1)
+
+def _is_current_roll(group_game: Dict[str, Any], start_time: float) -> bool:
+    """检查掷骰子的后续步骤是否仍属于当前这一局（游戏被停止或已开始新一局时返回False）"""
+    return (group_game['state'] == GROUP_GAME_ROLLING and group_game['start_time'] == start_time
+            and not group_game.get('settled'))
+
+def roll_group_dice(chat_id: int, data_manager: DataManager, start_time: float,
+                    dice_result: List[int], dice_num: int) -> None:
+    """发送第 dice_num 个骰子动画，发送完成后记录点数并继续下一个（在群组邮箱中执行）"""
+    if not _is_current_roll(data_manager.get_group_game(chat_id), start_time):
+        return
+    
+    # 骰子点数要从响应中读取，排在之前的消息之后发送；发送完成后回到群组邮箱继续，不占用工作线程等待
+    dice_future = TELEGRAM_OUTBOX.submit(chat_id, send_dice, chat_id, "🎲")
+    dice_future.add_done_callback(
+        lambda future: GROUP_MAILBOXES.post(chat_id, record_group_dice, chat_id, data_manager, start_time,
+                                            dice_result, dice_num, future)
+    )
+
+def record_group_dice(chat_id: int, data_manager: DataManager, start_time: float,
+                      dice_result: List[int], dice_num: int, dice_future: Future) -> None:
+    """记录第 dice_num 个骰子的点数，1秒后继续下一个，使骰子动画有序显示（在群组邮箱中执行）"""
+    if not _is_current_roll(data_manager.get_group_game(chat_id), start_time):
+        return
+    
+    dice_response = dice_future.result() if dice_future.exception() is None else {}
+    if dice_response.get("ok"):
+        # Telegram骰子API返回的值是1-6
+        # 不再单独显示每个骰子的点数，让Telegram的原生骰子动画直接展示效果
+        dice_result.append(dice_response["result"]["dice"]["value"])
+    
+    if dice_num < 3:
+        GROUP_MAILBOXES.post_later(1.0, chat_id, roll_group_dice, chat_id, data_manager,
+                                   start_time, dice_result, dice_num + 1)
+    else:
+        GROUP_MAILBOXES.post_later(1.0, chat_id, finish_group_dice, chat_id, data_manager,
+                                   start_time, dice_result)
+
+def finish_group_dice(chat_id: int, data_manager: DataManager, start_time: float,
+                      dice_result: List[int]) -> None:
+    """确定本局骰子点数，3秒后结算，给骰子动画一些时间显示（在群组邮箱中执行）"""
+    if not _is_current_roll(data_manager.get_group_game(chat_id), start_time):
+        return
+    
+    # 检查该群组是否有设定的骰子点数
+    fixed_dice = data_manager.get_fixed_dice(chat_id)
     
     # 检查是否要使用管理员设置的固定骰子点数（用于调试）
     if fixed_dice and len(fixed_dice) == 3:
         # 对管理员显示提示，但不会影响实际结果
         logger.info(f"群组 {chat_id} 有设置的固定骰子点数: {fixed_dice}")
+        admin_message = f"ℹ️ 群组 {chat_id} 有设置的固定骰子点数: {fixed_dice[0]}, {fixed_dice[1]}, {fixed_dice[2]}，但使用真实骰子点数。"
         for admin_id in ADMIN_IDS:
-            try:
-                admin_message = f"ℹ️ 群组 {chat_id} 有设置的固定骰子点数: {fixed_dice[0]}, {fixed_dice[1]}, {fixed_dice[2]}，但使用真实骰子点数。"
-                send_message(admin_id, admin_message)
-            except Exception as e:
-                logger.error(f"发送管理员消息失败: {e}")
+            send_message_nowait(admin_id, admin_message)
         
         # 清除固定点数，避免影响下一局
         data_manager.clear_fixed_dice(chat_id)
@@ -1769,68 +4449,28 @@ def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
     result = DiceGame.calculate_result(dice_result)
     
     # 给骰子动画一些时间显示
-    time.sleep(3)
+    GROUP_MAILBOXES.post_later(3, chat_id, announce_group_game_result, chat_id, data_manager,
+                               start_time, dice_result, result)
+
+def announce_group_game_result(chat_id: int, data_manager: DataManager, start_time: float,
+                               dice_result: List[int], result: Dict[str, Any]) -> None:
+    """结算所有投注并发送开奖结果和走势，5秒后开始新一局（在群组邮箱中执行）"""
+    group_game = data_manager.get_group_game(chat_id)
+    if not _is_current_roll(group_game, start_time):
+        return
     
     # 更新最后结果
     group_game['last_result'] = result
     data_manager.update_group_game(chat_id, group_game)
     
-    # 处理所有投注
+    # 结算所有投注
     winners_text = ""
     total_winners = 0
     
-    for user_id_str, bets in group_game['bets'].items():
-        user_id = int(user_id_str)
-        user_data = data_manager.get_user(user_id)
-        
-        if not user_data:
-            continue
-        
-        user_total_win = 0
-        
-        for bet in bets:
-            bet_type = bet['bet_type']
-            bet_value = bet['bet_value']
-            bet_amount = bet['amount']
-            
-            won, ratio = DiceGame.evaluate_bet(bet_type, bet_value, result)
-            
-            if won:
-                winnings = bet_amount * ratio
-                user_total_win += winnings
-                
-                # 更新用户余额
-                data_manager.update_balance(user_id, winnings)
-                
-                # 添加游戏记录
-                data_manager.add_game_record(
-                    user_id=user_id,
-                    game_type="group",
-                    bet_type=bet_type,
-                    bet_value=bet_value,
-                    bet_amount=bet_amount,
-                    result=dice_result,
-                    won=True,
-                    winnings=winnings,
-                    is_group_game=True,
-                    group_id=chat_id
-                )
-            else:
-                # 添加游戏记录
-                data_manager.add_game_record(
-                    user_id=user_id,
-                    game_type="group",
-                    bet_type=bet_type,
-                    bet_value=bet_value,
-                    bet_amount=bet_amount,
-                    result=dice_result,
-                    won=False,
-                    winnings=0,
-                    is_group_game=True,
-                    group_id=chat_id
-                )
-        
+    winnings_by_user = data_manager.settle_group_game(chat_id, dice_result, result)
+    for user_id_str, user_total_win in winnings_by_user.items():
         if user_total_win > 0:
+            user_data = data_manager.get_user(int(user_id_str))
             winners_text += f"🏆 *{user_data['name']}* 赢得 *+{user_total_win} 金币* 💰\n"
             total_winners += 1
     
@@ -1869,8 +4509,8 @@ def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
         winners=winners_text
     )
     
-    # 直接发送新消息，不编辑原消息，确保赔付表永久保留
-    send_message(chat_id, end_message)
+    # 直接发送新消息，不编辑原消息，确保赔付表永久保留；不等待发送完成
+    send_message_nowait(chat_id, end_message)
     
     # 生成并发送走势图
     # 获取该群组的历史记录用于分析走势(最多获取30条)
@@ -1925,11 +4565,7 @@ def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
         displayed_count = min(20, len(trend_codes))
         
         # 计算当前群组总游戏数
-        group_total_games = len([
-            game for game in data_manager.game_history 
-            if game.get('is_group_game', False) and 
-            str(game.get('group_id', '')) == str(chat_id)
-        ])
+        group_total_games = data_manager.count_group_games(chat_id)
         
         # 显示最近20条记录，使用真实游戏编号
         for i in range(max(0, len(trend_codes)-displayed_count), len(trend_codes)):
@@ -1976,17 +4612,13 @@ def process_group_game_result(chat_id: int, data_manager: DataManager) -> None:
             """
         
         # 发送走势图
-        try:
-            send_message(chat_id, trend_text)
-        except Exception as e:
-            logger.error(f"发送走势图失败: {e}")
+        send_message_nowait(chat_id, trend_text)
     
     # 5秒后开始新游戏
-    time.sleep(5)
-    start_new_group_game(chat_id, data_manager)
+    GROUP_MAILBOXES.post_later(5, chat_id, start_new_group_game, chat_id, data_manager)
 
 def start_new_group_game(chat_id: int, data_manager: DataManager) -> None:
-    """自动开始新的群组游戏"""
+    """自动开始新的群组游戏（在群组邮箱中执行）"""
     # 重置群组游戏状态
     data_manager.reset_group_game(chat_id)
     
@@ -1999,8 +4631,58 @@ def start_new_group_game(chat_id: int, data_manager: DataManager) -> None:
     # 开始新游戏
     handle_start_group_game(message, data_manager)
 
+def stop_group_game(chat_id: int, data_manager: DataManager) -> None:
+    """
+    停止群组游戏（在群组邮箱中执行）
+    取消该群组的倒计时、摇骰子期限和自动开局等定时任务，未结算的投注全部退还
+    """
+    cancelled = GROUP_MAILBOXES.cancel_timers(chat_id)
+    # 合并发送投注确认的定时任务已被取消，缓存的确认在退款提示之前发出
+    flush_bet_confirmations(chat_id)
+    group_game = data_manager.get_group_game(chat_id)
+    
+    if group_game['state'] == GROUP_GAME_IDLE and cancelled == 0:
+        send_message_nowait(chat_id, "❌ 当前没有正在进行的游戏。")
+        return
+    
+    # 已结算的游戏不会重复退款，只需重置状态
+    refunded = data_manager.refund_group_game(chat_id)
+    data_manager.reset_group_game(chat_id)
+    logger.info(f"群组 {chat_id} 的游戏已停止，取消 {cancelled} 个定时任务，退还 {refunded} 金币")
+    
+    stop_message = "🛑 *游戏已停止* 🛑\n\n游戏已被管理员终止。发送 /start 重新开始游戏。"
+    if refunded > 0:
+        stop_message += f"\n本局投注共 {refunded} 金币已全部退还。"
+    send_message_nowait(chat_id, stop_message)
+
+def resume_group_games(data_manager: DataManager) -> None:
+    """
+    启动时处理重启前未完成的群组游戏
+    投注阶段继续倒计时，等待摇骰子时重新计时，玩家已掷完骰子的继续结算，
+    已结算的直接开始新一局，机器人已开始掷骰子但未结算的退还全部投注
+    """
+    for chat_id, group_game in data_manager.get_active_group_games().items():
+        state = group_game['state']
+        if group_game.get('settled'):
+            GROUP_MAILBOXES.post(chat_id, start_new_group_game, chat_id, data_manager)
+        elif state == GROUP_GAME_BETTING:
+            GROUP_MAILBOXES.post(chat_id, group_game_countdown, chat_id, data_manager, group_game['start_time'])
+        elif state == GROUP_GAME_SELECTING_ROLLER and not group_game.get('dice_rolled', False):
+            elapsed = time.time() - group_game.get('roller_select_time', 0)
+            GROUP_MAILBOXES.post_later(max(0, 20 - elapsed), chat_id, check_and_roll_dice, chat_id, data_manager)
+        elif state == GROUP_GAME_ROLLING and group_game.get('selected_roller') is not None \
+                and len(group_game.get('user_dice_values', [])) >= 3:
+            GROUP_MAILBOXES.post(chat_id, process_group_game_result, chat_id, data_manager)
+        else:
+            refunded = data_manager.refund_group_game(chat_id)
+            logger.info(f"群组 {chat_id} 的游戏在重启时中断，已退还 {refunded} 金币")
+            send_message(chat_id, f"⚠️ *机器人已重启* ⚠️\n\n本局游戏被中断，已退还全部投注共 {refunded} 金币。")
+            GROUP_MAILBOXES.post(chat_id, start_new_group_game, chat_id, data_manager)
+        
+        logger.info(f"群组 {chat_id} 的游戏已恢复: {state}")
+
 def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager) -> None:
-    """处理群组中的投注消息"""
+    """处理群组中的投注消息（在群组邮箱中执行）"""
     chat_id = message["chat"]["id"]
     user_id = message["from"]["id"]
     user_name = message["from"]["first_name"]
@@ -2014,13 +4696,13 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
         else:
             # 检查用户是否是群组管理员
             try:
-                chat_member = requests.get(
-                    f"{API_URL}/getChatMember",
+                chat_member = TELEGRAM_API.get(
+                    "getChatMember",
                     params={
                         "chat_id": chat_id,
                         "user_id": user_id
                     }
-                ).json()
+                )
                 
                 if chat_member.get("ok") and chat_member.get("result"):
                     status = chat_member["result"]["status"]
@@ -2031,21 +4713,10 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
                 has_permission = False
         
         if has_permission:
-            # 获取群组游戏状态
-            group_game = data_manager.get_group_game(chat_id)
-            
-            if group_game['state'] != GROUP_GAME_IDLE:
-                # 设置状态为空闲
-                group_game['state'] = GROUP_GAME_IDLE
-                data_manager.update_group_game(chat_id, group_game)
-                
-                send_message(chat_id, "🛑 *游戏已停止* 🛑\n\n游戏已被管理员终止。发送 /start 重新开始游戏。")
-                return
-            else:
-                send_message(chat_id, "❌ 当前没有正在进行的游戏。")
-                return
+            stop_group_game(chat_id, data_manager)
+            return
         else:
-            send_message(chat_id, "❌ 只有管理员可以停止游戏。")
+            send_message_nowait(chat_id, "❌ 只有管理员可以停止游戏。")
             return
     
     # 检查是否是摇骰子命令
@@ -2071,27 +4742,27 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
 
 期待骰子的命运...
                 """
-                send_message(chat_id, roller_message, reply_to_message_id=message["message_id"])
+                send_message_nowait(chat_id, roller_message, reply_to_message_id=message["message_id"])
                 
                 # 玩家骰子点数信息也会显示
                 roller_info = f"""
 👑 *高额投注者摇骰子特权* 👑
 玩家 {user_data['name']} 将掷出骰子...
                 """
-                send_message(chat_id, roller_info)
+                send_message_nowait(chat_id, roller_info)
                 
                 # 处理游戏结果
                 process_group_game_result(chat_id, data_manager)
                 return
             else:
                 # 不是被选中的玩家
-                send_message(chat_id, f"❌ 只有被选中的高额投注玩家才能摇骰子。", reply_to_message_id=message["message_id"])
+                send_message_nowait(chat_id, f"❌ 只有被选中的高额投注玩家才能摇骰子。", reply_to_message_id=message["message_id"])
                 return
         elif group_game['state'] == GROUP_GAME_ROLLING:
-            send_message(chat_id, "⏳ 骰子正在被摇动中...", reply_to_message_id=message["message_id"])
+            send_message_nowait(chat_id, "⏳ 骰子正在被摇动中...", reply_to_message_id=message["message_id"])
             return
         elif group_game['state'] == GROUP_GAME_BETTING:
-            send_message(chat_id, "⏳ 游戏仍在投注阶段，请等待倒计时结束。", reply_to_message_id=message["message_id"])
+            send_message_nowait(chat_id, "⏳ 游戏仍在投注阶段，请等待倒计时结束。", reply_to_message_id=message["message_id"])
             return
     
     # 检查用户是否被封禁
@@ -2116,7 +4787,7 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
 当前余额: *{user_data['balance']}* 金币
 用户ID: {user_id}
         """
-        send_message(chat_id, balance_message, reply_to_message_id=message["message_id"])
+        send_message_nowait(chat_id, balance_message, reply_to_message_id=message["message_id"])
         return
     
     # 获取用户数据
@@ -2130,12 +4801,14 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
     # 计算总投注额
     total_amount = sum(amount for _, _, amount in bet_info_list)
     
-    # 检查余额
-    if user_data["balance"] < total_amount:
-        send_message(
+    # 整张投注单一次下注：余额检查、扣款和添加投注在同一临界区内完成，要么全部成功要么全部失败
+    balance, success = data_manager.add_bets_to_group_game(chat_id, user_id, bet_info_list)
+    
+    if not success and balance < total_amount:
+        send_message_nowait(
             chat_id, 
             INSUFFICIENT_BALANCE_MESSAGE.format(
-                balance=user_data["balance"],
+                balance=balance,
                 amount=total_amount,
                 user_id=user_id
             ),
@@ -2143,56 +4816,35 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
         )
         return
     
-    # 处理所有投注
-    success_bets = []
-    fail_bets = []
-    
-    for bet_info in bet_info_list:
-        bet_type, bet_value, amount = bet_info
-        # 添加投注
-        success = data_manager.add_bet_to_group_game(chat_id, user_id, bet_type, bet_value, amount)
-        
-        if success:
-            success_bets.append((bet_type, bet_value, amount))
-        else:
-            fail_bets.append((bet_type, bet_value, amount))
-    
+    success_bets = bet_info_list if success else []
+    fail_bets = [] if success else bet_info_list
+    
     if success_bets:
         # 构建成功投注的确认消息
-        confirm_lines = []
-        for bet_type, bet_value, amount in success_bets:
-            bet_name = BET_TYPES.get(bet_type, bet_type)
-            if bet_value is not None and bet_value != "any":
-                bet_display = f"{bet_name} {bet_value}"
-            else:
-                bet_display = bet_name
-            confirm_lines.append(f"- {bet_display}: {amount} 金币\n")
-            
-        # 获取最新余额
-        updated_user_data = data_manager.get_user(user_id)
+        confirm_lines = [f"- {bet_display(bet_type, bet_value)}: {amount} 金币\n"
+                         for bet_type, bet_value, amount in success_bets]
+        total_amount = sum(amount for _, _, amount in success_bets)
         
-        confirm_text = f"""
+        if BET_CONFIRM_MODE == "batch":
+            # 合并到本群组下一条投注确认消息中
+            queue_bet_confirmation(chat_id, user_data['name'], confirm_lines, total_amount, balance)
+        else:
+            confirm_text = f"""
 ✅ *投注成功*
 
 用户: {user_data['name']}
 投注明细:
 {"".join(confirm_lines)}
-总金额: {sum(amount for _, _, amount in success_bets)} 金币
-余额: {updated_user_data['balance']} 金币
-        """
-        
-        send_message(chat_id, confirm_text, reply_to_message_id=message["message_id"])
+总金额: {total_amount} 金币
+余额: {balance} 金币
+            """
+            
+            send_message_nowait(chat_id, confirm_text, reply_to_message_id=message["message_id"])
     
     if fail_bets:
         # 构建失败投注的错误消息
-        fail_lines = []
-        for bet_type, bet_value, amount in fail_bets:
-            bet_name = BET_TYPES.get(bet_type, bet_type)
-            if bet_value is not None and bet_value != "any":
-                bet_display = f"{bet_name} {bet_value}"
-            else:
-                bet_display = bet_name
-            fail_lines.append(f"- {bet_display}: {amount} 金币\n")
+        fail_lines = [f"- {bet_display(bet_type, bet_value)}: {amount} 金币\n"
+                      for bet_type, bet_value, amount in fail_bets]
         
         error_text = f"""
 ❌ *以下投注失败*:
@@ -2201,7 +4853,48 @@ def handle_group_bet_message(message: Dict[str, Any], data_manager: DataManager)
 请重试或调整投注。
         """
         
-        send_message(chat_id, error_text, reply_to_message_id=message["message_id"])
+        send_message_nowait(chat_id, error_text, reply_to_message_id=message["message_id"])
+
+def bet_display(bet_type: str, bet_value: Any) -> str:
+    """投注的显示名称，例如 大、豹子 1"""
+    bet_name = BET_TYPES.get(bet_type, bet_type)
+    if bet_value is not None and bet_value != "any":
+        return f"{bet_name} {bet_value}"
+    return bet_name
+
+# batch 方式下各群组缓存的投注确认 {chat_id: [每个玩家的确认文本]}
+# 只在该群组的邮箱中读写，同一群组不会并发访问
+_PENDING_BET_CONFIRMATIONS = {}
+
+# Telegram 单条消息的长度上限，合并的投注确认超过时分多条发送
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def queue_bet_confirmation(chat_id: int, user_name: str, confirm_lines: List[str],
+                           total_amount: int, balance: int) -> None:
+    """
+    缓存一名玩家的投注确认（在群组邮箱中执行）
+    窗口内第一条确认投递定时任务，BET_CONFIRM_WINDOW 秒后合并发送
+    """
+    pending = _PENDING_BET_CONFIRMATIONS.get(chat_id)
+    if pending is None:
+        pending = _PENDING_BET_CONFIRMATIONS[chat_id] = []
+        GROUP_MAILBOXES.post_later(BET_CONFIRM_WINDOW, chat_id, flush_bet_confirmations, chat_id)
+    pending.append(f"*{user_name}* 共 {total_amount} 金币, 余额 {balance} 金币\n{''.join(confirm_lines)}")
+
+def flush_bet_confirmations(chat_id: int) -> None:
+    """合并发送该群组缓存的投注确认（在群组邮箱中执行），没有缓存时不发送"""
+    pending = _PENDING_BET_CONFIRMATIONS.pop(chat_id, None)
+    if not pending:
+        return
+    
+    header = f"✅ *投注成功* ({len(pending)} 人)\n\n"
+    text = header
+    for entry in pending:
+        if len(text) + len(entry) + 1 > TELEGRAM_MESSAGE_LIMIT and text != header:
+            send_message_nowait(chat_id, text)
+            text = header
+        text += entry + "\n"
+    send_message_nowait(chat_id, text)
 
 def parse_group_bet_message(text: str) -> List[Tuple[str, Any, int]]:
     """
@@ -2466,7 +5159,7 @@ def _parse_special_bet(text: str, next_part: str) -> Optional[Tuple[str, Any, in
     return None
 
 def handle_dice_message(message: Dict[str, Any], data_manager: DataManager) -> None:
-    """处理用户发送的骰子消息"""
+    """处理用户发送的骰子消息（群组中的骰子在群组邮箱中执行）"""
     if "chat" not in message or message["chat"]["id"] >= 0:  # 非群组聊天
         return
     
@@ -2507,7 +5200,7 @@ def handle_dice_message(message: Dict[str, Any], data_manager: DataManager) -> N
 
 {user_data['name']} 掷出了: {dice_value}
             """
-            send_message(chat_id, dice_message, reply_to_message_id=message["message_id"])
+            send_message_nowait(chat_id, dice_message, reply_to_message_id=message["message_id"])
             
             # 如果已经掷了3个骰子，处理游戏结果
             if len(group_game["user_dice_values"]) >= 3:
@@ -2516,7 +5209,7 @@ def handle_dice_message(message: Dict[str, Any], data_manager: DataManager) -> N
             else:
                 # 继续等待玩家掷剩余的骰子
                 next_dice_message = f"请继续发送🎲表情掷出第{len(group_game['user_dice_values'])+1}/3个骰子"
-                send_message(chat_id, next_dice_message)
+                send_message_nowait(chat_id, next_dice_message)
 
 def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataManager) -> None:
     """处理按钮回调查询"""
@@ -2533,19 +5226,12 @@ def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataMana
     if data.startswith("grab_private_hongbao:"):
         hongbao_id = data.split(":", 1)[1]
         
-        # 确保hongbao属性存在
-        if not hasattr(data_manager, "hongbao"):
-            data_manager.hongbao = {}
-            answer_callback_query(callback_query["id"], "❌ 红包已失效或已被领取", show_alert=True)
-            return
-        
         # 检查红包是否存在
-        if hongbao_id not in data_manager.hongbao:
+        hongbao_info = data_manager.get_hongbao(hongbao_id)
+        if hongbao_info is None:
             answer_callback_query(callback_query["id"], "❌ 红包已失效或已被领取", show_alert=True)
             return
         
-        hongbao_info = data_manager.hongbao[hongbao_id]
-        
         # 检查红包是否已被领取
         if hongbao_info.get("is_claimed", False):
             answer_callback_query(callback_query["id"], "❌ 红包已被领取", show_alert=True)
@@ -2569,14 +5255,10 @@ def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataMana
         # 获取红包金额
         amount = hongbao_info["amount"]
         
-        # 更新用户余额
-        new_balance, success = data_manager.update_balance(user_id, amount)
+        # 更新用户余额并标记红包为已领取
+        new_balance, success = data_manager.claim_private_hongbao(hongbao_id, user_id)
         
         if success:
-            # 标记红包为已领取
-            hongbao_info["is_claimed"] = True
-            hongbao_info["claimed_at"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
             # 通知用户
             answer_callback_query(callback_query["id"], f"🎉 恭喜！您领取了 {amount} 金币", show_alert=True)
             
@@ -2591,9 +5273,6 @@ def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataMana
             
             # 更新消息，移除按钮
             edit_message_text(chat_id, message_id, updated_message)
-            
-            # 删除红包信息以节省内存
-            del data_manager.hongbao[hongbao_id]
         else:
             answer_callback_query(callback_query["id"], "❌ 领取红包失败，请稍后再试", show_alert=True)
     
@@ -2601,19 +5280,12 @@ def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataMana
     elif data.startswith("grab_hongbao:"):
         hongbao_id = data.split(":", 1)[1]
         
-        # 确保hongbao属性存在
-        if not hasattr(data_manager, "hongbao"):
-            data_manager.hongbao = {}
-            answer_callback_query(callback_query["id"], "❌ 红包已失效或已被抢完", show_alert=True)
-            return
-        
         # 检查红包是否存在
-        if hongbao_id not in data_manager.hongbao:
+        hongbao_info = data_manager.get_hongbao(hongbao_id)
+        if hongbao_info is None:
             answer_callback_query(callback_query["id"], "❌ 红包已失效或已被抢完", show_alert=True)
             return
         
-        hongbao_info = data_manager.hongbao[hongbao_id]
-        
         # 检查红包是否已被抢完
         if hongbao_info["remaining_count"] <= 0:
             answer_callback_query(callback_query["id"], "❌ 红包已被抢完", show_alert=True)
@@ -2635,26 +5307,10 @@ def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataMana
             data_manager.add_user(user_id, user_name)
             user_data = data_manager.get_user(user_id)
         
-        # 分配红包金额
-        amount = hongbao_info["amounts"][hongbao_info["total_count"] - hongbao_info["remaining_count"]]
-        
-        # 更新用户余额
-        new_balance, success = data_manager.update_balance(user_id, amount)
+        # 分配红包金额、更新用户余额和红包信息
+        amount, success = data_manager.grab_group_hongbao(hongbao_id, user_id, user_data["name"])
         
         if success:
-            # 更新红包信息
-            hongbao_info["remaining_count"] -= 1
-            hongbao_info["remaining_amount"] -= amount
-            
-            receiver_info = {
-                "user_id": user_id,
-                "user_name": user_data["name"],
-                "amount": amount,
-                "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            hongbao_info["receivers"].append(receiver_info)
-            
             # 通知用户
             answer_callback_query(callback_query["id"], f"🎉 恭喜！您抢到了 {amount} 金币", show_alert=True)
             
@@ -2671,9 +5327,6 @@ def handle_callback_query(callback_query: Dict[str, Any], data_manager: DataMana
                 
                 # 更新消息，移除按钮
                 edit_message_text(chat_id, message_id, updated_message)
-                
-                # 删除红包信息以节省内存
-                del data_manager.hongbao[hongbao_id]
             else:
                 # 还有红包可以抢，更新消息
                 updated_message = f"""
@@ -3284,7 +5937,7 @@ def handle_history_callback(user_id: int, chat_id: int, message_id: int, data_ma
         return
     
     # 获取全局历史记录用于分析走势(最多获取30条)
-    history = data_manager.game_history[-30:] if len(data_manager.game_history) > 0 else []
+    history = data_manager.get_recent_history(30)
     
     if not history:
         history_text = """
@@ -3386,7 +6039,7 @@ def handle_history_callback(user_id: int, chat_id: int, message_id: int, data_ma
             for i, game in enumerate(history[-10:]):
                 dice_result = game["result"]
                 total = sum(dice_result)
-                idx = len(data_manager.game_history) - 10 + i + 1
+                idx = data_manager.count_games() - 10 + i + 1
                 
                 # 判断结果类型
                 is_triple = len(set(dice_result)) == 1
@@ -3689,7 +6342,23 @@ def handle_admin_command(message: Dict[str, Any], data_manager: DataManager) ->
     # 处理 /stats 命令
     elif text == "/adminstats":
         # 显示全局统计信息
-        global_stats = data_manager.global_stats
+        global_stats = data_manager.get_global_stats()
+        flush_stats = data_manager.get_flush_stats()
+        mailbox_stats = GROUP_MAILBOXES.get_stats()
+        update_stats = UPDATE_DISPATCHER.get_stats()
+        outbox_stats = TELEGRAM_OUTBOX.get_stats()
+        if TELEGRAM_API.rate_limiter is not None:
+            rate_stats = TELEGRAM_API.rate_limiter.get_stats()
+            rate_text = (f"延后发送 {rate_stats['deferred']} 次, 收到 429 共 {rate_stats['throttled']} 次, "
+                         f"排队等待 p50 {rate_stats['wait_p50_ms']:.0f} 毫秒, p99 {rate_stats['wait_p99_ms']:.0f} 毫秒, "
+                         f"最长 {rate_stats['wait_max_ms']:.0f} 毫秒")
+        else:
+            rate_text = "未开启"
+        round_stats = ROUND_MESSAGES.get_stats()
+        outbox_methods = "".join(
+            f"\n  `{method}`: {stats['count']} 次, p50 {stats['p50_ms']:.0f} 毫秒, p99 {stats['p99_ms']:.0f} 毫秒"
+            for method, stats in sorted(outbox_stats['methods'].items())
+        )
         
         stats_text = f"""
 📊 *全局统计信息* 📊
@@ -3703,11 +6372,25 @@ def handle_admin_command(message: Dict[str, Any], data_manager: DataManager) ->
 金额: {global_stats['biggest_win']['amount']} 金币
 日期: {global_stats['biggest_win']['date'] or '无'}
 
-总用户数: {len(data_manager.users)}
+总用户数: {data_manager.count_users()}
+
+上次落盘: {flush_stats['last_flush_ms']:.1f} 毫秒, {flush_stats['last_flush_bytes']} 字节
+日志大小: {flush_stats['journal_bytes']} 字节
+启动恢复: {flush_stats['recovery_ms']:.1f} 毫秒
+群组邮箱: {mailbox_stats['chats']} 个群组待处理, {mailbox_stats['tasks']} 个任务
+更新队列: {update_stats['chats']} 个会话待处理, {update_stats['tasks']} 条更新, 最深 {update_stats['max_depth']} 条, 背压阻塞 {update_stats['blocked_posts']} 次 ({update_stats['blocked_ms']:.0f} 毫秒)
+定时任务: {mailbox_stats['pending']} 个待触发, 调度延迟 p50 {mailbox_stats['lag_p50_ms']:.1f} 毫秒, p99 {mailbox_stats['lag_p99_ms']:.1f} 毫秒, 最大 {mailbox_stats['lag_max_ms']:.1f} 毫秒
+出站请求: {outbox_stats['queued']} 个排队, {outbox_stats['in_flight']} 个发送中{outbox_methods}
+频率限制: {rate_text}
+群组每局请求: 最近 {round_stats['rounds']} 局平均 {round_stats['avg']:.1f} 个, 最多 {round_stats['max']} 个 (投注确认: {BET_CONFIRM_MODE})
         """
         
         send_message(chat_id, stats_text)
     
+    # 处理 /lockstats 命令 - 查看锁等待和持有时间
+    elif text == "/lockstats":
+        send_message(chat_id, f"🔒 *锁统计* 🔒\n```\n{LOCK_PROFILER.dump()}\n```")
+    
     # 处理 /stop 命令 - 停止群组游戏
     elif text == "/stop" or text == "/stopgame":
         # 只有管理员或群组管理员可以停止游戏
@@ -3718,13 +6401,13 @@ def handle_admin_command(message: Dict[str, Any], data_manager: DataManager) ->
             else:
                 # 检查用户是否是群组管理员
                 try:
-                    chat_member = requests.get(
-                        f"{API_URL}/getChatMember",
+                    chat_member = TELEGRAM_API.get(
+                        "getChatMember",
                         params={
                             "chat_id": chat_id,
                             "user_id": user_id
                         }
-                    ).json()
+                    )
                     
                     if chat_member.get("ok") and chat_member.get("result"):
                         status = chat_member["result"]["status"]
@@ -3735,22 +6418,468 @@ def handle_admin_command(message: Dict[str, Any], data_manager: DataManager) ->
                     has_permission = False
             
             if has_permission:
-                # 获取群组游戏状态
-                group_game = data_manager.get_group_game(chat_id)
-                
-                if group_game['state'] != GROUP_GAME_IDLE:
-                    # 设置状态为空闲
-                    group_game['state'] = GROUP_GAME_IDLE
-                    data_manager.update_group_game(chat_id, group_game)
-                    
-                    send_message(chat_id, "🛑 *游戏已停止* 🛑\n\n游戏已被管理员终止。发送 /start 重新开始游戏。")
-                else:
-                    send_message(chat_id, "❌ 当前没有正在进行的游戏。")
+                # 停止游戏需要与该群组的其它游戏事件按顺序执行
+                GROUP_MAILBOXES.post(chat_id, stop_group_game, chat_id, data_manager)
             else:
                 send_message(chat_id, "❌ 只有管理员可以停止游戏。")
         else:
             send_message(chat_id, "❌ 此命令只能在群组中使用。")
 
+# ============== 基准测试 ==============
+
+def benchmark_storage(user_count: int = 100000) -> None:
+    """对比旧版缩进 JSON 和记录流快照的保存及冷启动加载耗时"""
+    import tempfile
+
+    data = _empty_data()
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for i in range(user_count):
+        data['users'][str(i)] = {
+            'name': f"玩家{i}", 'balance': random.randint(0, 100000), 'total_bets': i * 10,
+            'total_winnings': i * 5, 'games_played': i % 500, 'joined_date': now, 'last_activity': now,
+            'vip_level': i % 6, 'daily_bonus_claimed': None,
+            'history': [{
+                'timestamp': now, 'game_type': 'group', 'bet_type': 'big', 'bet_value': None,
+                'bet_amount': 100, 'result': [1, 2, 3], 'won': False, 'winnings': 0,
+                'is_group_game': True, 'group_game_number': n, 'group_id': -100
+            } for n in range(5)]
+        }
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = os.path.join(directory, "user_data.json")
+        snapshot_file = os.path.join(directory, "user_data.snap")
+
+        started = time.perf_counter()
+        with open(legacy_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        legacy_save = time.perf_counter() - started
+
+        # 新格式中用户历史单独存放在 .history 文件中
+        _split_user_history(data)
+        started = time.perf_counter()
+        _write_snapshot(snapshot_file, data)
+        snapshot_save = time.perf_counter() - started
+
+        del data
+        started = time.perf_counter()
+        _read_snapshot(legacy_file)
+        legacy_load = time.perf_counter() - started
+
+        started = time.perf_counter()
+        data = _read_snapshot(snapshot_file)
+        snapshot_load = time.perf_counter() - started
+
+        # 最新一代快照损坏时回退到上一代的恢复耗时
+        _write_snapshot(f"{snapshot_file}.1", data)
+        _write_snapshot(f"{snapshot_file}.2", data)
+        del data
+        with open(f"{snapshot_file}.2", 'r+b') as f:
+            f.seek(os.path.getsize(f"{snapshot_file}.2") // 2)
+            f.write(b'#')
+        started = time.perf_counter()
+        _recover_data(snapshot_file)
+        fallback_recovery = time.perf_counter() - started
+
+        print(f"{user_count} 个用户 (编码器: {'orjson' if orjson is not None else 'json'})")
+        print(f"旧版 JSON: 保存 {legacy_save:.2f} 秒, 加载 {legacy_load:.2f} 秒, "
+              f"{os.path.getsize(legacy_file) / 1024 / 1024:.1f} MB")
+        print(f"记录流快照: 保存 {snapshot_save:.2f} 秒, 加载 {snapshot_load:.2f} 秒, "
+              f"{os.path.getsize(snapshot_file) / 1024 / 1024:.1f} MB "
+              f"(历史文件 {os.path.getsize(snapshot_file + '.history') / 1024 / 1024:.1f} MB)")
+        print(f"最新一代损坏时回退恢复: {fallback_recovery:.2f} 秒")
+
+def _use_single_lock(data_manager: DataManager, chat_ids: List[str]) -> None:
+    """让所有分层锁指向同一把锁，模拟改造前所有操作共用一把全局锁"""
+    lock = threading.RLock()
+    data_manager._group_locks = {chat_id_str: lock for chat_id_str in chat_ids}
+    data_manager._group_locks_lock = lock
+    data_manager._hongbao_lock = lock
+    data_manager._user_locks = [lock]
+    data_manager._stats_lock = lock
+    data_manager._history_lock = lock
+
+def benchmark_locks(group_count: int = 200, rounds: int = 5, bets_per_round: int = 20) -> None:
+    """
+    锁竞争基准测试：每个群组一个线程，同时开局、下注和结算
+    对比分层锁和单一全局锁的总吞吐量以及下注、结算延迟
+    """
+    import tempfile
+
+    def percentile(values: List[float], p: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+    for mode in ("分层锁", "单一全局锁"):
+        with tempfile.TemporaryDirectory() as directory:
+            data_manager = DataManager(os.path.join(directory, "user_data.snap"))
+            chat_ids = [str(-1000 - i) for i in range(group_count)]
+            if mode == "单一全局锁":
+                _use_single_lock(data_manager, chat_ids)
+
+            # 每个群组有自己的一批玩家
+            for group_index in range(group_count):
+                for player in range(bets_per_round):
+                    user_id = group_index * bets_per_round + player + 1
+                    data_manager.add_user(user_id, f"玩家{user_id}")
+                    data_manager.update_balance(user_id, 10 ** 9)
+
+            bet_latencies = []
+            settle_latencies = []
+            start_barrier = threading.Barrier(group_count + 1)
+
+            def play(group_index: int) -> None:
+                chat_id = int(chat_ids[group_index])
+                bets = []
+                settles = []
+                start_barrier.wait()
+                for _ in range(rounds):
+                    group_game = data_manager.get_group_game(chat_id)
+                    group_game['state'] = GROUP_GAME_BETTING
+                    data_manager.update_group_game(chat_id, group_game)
+                    for player in range(bets_per_round):
+                        user_id = group_index * bets_per_round + player + 1
+                        started = time.perf_counter()
+                        data_manager.add_bet_to_group_game(chat_id, user_id, "big", None, 100)
+                        bets.append(time.perf_counter() - started)
+                    dice_result = DiceGame.roll_dice()
+                    started = time.perf_counter()
+                    data_manager.settle_group_game(chat_id, dice_result, DiceGame.calculate_result(dice_result))
+                    settles.append(time.perf_counter() - started)
+                    data_manager.reset_group_game(chat_id)
+                bet_latencies.extend(bets)
+                settle_latencies.extend(settles)
+
+            threads = [threading.Thread(target=play, args=(i,)) for i in range(group_count)]
+            for thread in threads:
+                thread.start()
+            start_barrier.wait()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            data_manager.flush_journal()
+
+            total_bets = len(bet_latencies)
+            print(f"{mode}: {group_count} 个群组, {total_bets} 注, {elapsed:.2f} 秒, "
+                  f"{total_bets / elapsed:.0f} 注/秒; "
+                  f"下注延迟 p50 {percentile(bet_latencies, 0.5):.2f} ms, p99 {percentile(bet_latencies, 0.99):.2f} ms; "
+                  f"结算延迟 p50 {percentile(settle_latencies, 0.5):.2f} ms, "
+                  f"p99 {percentile(settle_latencies, 0.99):.2f} ms")
+
+def benchmark_reads(group_count: int = 50, rounds: int = 10, bets_per_round: int = 20, readers: int = 4) -> None:
+    """
+    读取延迟基准测试：每个群组一个线程不停下注和结算，同时若干线程查询余额和排行榜
+    分别统计 JSON 和 SQLite 后端的余额查询、排行榜查询延迟
+    """
+    import tempfile
+
+    def percentile(values: List[float], p: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+    for backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory() as directory:
+            if backend == "sqlite":
+                data_manager = SqliteDataManager(os.path.join(directory, "user_data.db"))
+            else:
+                data_manager = DataManager(os.path.join(directory, "user_data.snap"))
+            user_count = group_count * bets_per_round
+            for user_id in range(1, user_count + 1):
+                data_manager.add_user(user_id, f"玩家{user_id}")
+                data_manager.update_balance(user_id, 10 ** 9)
+
+            settling = threading.Event()
+            settling.set()
+            balance_latencies = []
+            leaderboard_latencies = []
+
+            def play(group_index: int) -> None:
+                chat_id = -1000 - group_index
+                for _ in range(rounds):
+                    group_game = data_manager.get_group_game(chat_id)
+                    group_game['state'] = GROUP_GAME_BETTING
+                    data_manager.update_group_game(chat_id, group_game)
+                    for player in range(bets_per_round):
+                        user_id = group_index * bets_per_round + player + 1
+                        data_manager.add_bet_to_group_game(chat_id, user_id, "big", None, 100)
+                    dice_result = DiceGame.roll_dice()
+                    data_manager.settle_group_game(chat_id, dice_result, DiceGame.calculate_result(dice_result))
+                    data_manager.reset_group_game(chat_id)
+
+            def read() -> None:
+                balances = []
+                leaderboards = []
+                while settling.is_set():
+                    started = time.perf_counter()
+                    data_manager.get_user(random.randint(1, user_count))['balance']
+                    balances.append(time.perf_counter() - started)
+                    if len(balances) % 100 == 0:
+                        started = time.perf_counter()
+                        data_manager.get_leaderboard(metric="balance")
+                        leaderboards.append(time.perf_counter() - started)
+                    # 模拟查询请求的到达间隔，避免查询线程空转抢占结算线程
+                    time.sleep(0.001)
+                balance_latencies.extend(balances)
+                leaderboard_latencies.extend(leaderboards)
+
+            players = [threading.Thread(target=play, args=(i,)) for i in range(group_count)]
+            reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+            started = time.perf_counter()
+            for thread in reader_threads + players:
+                thread.start()
+            for thread in players:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            settling.clear()
+            for thread in reader_threads:
+                thread.join()
+            data_manager.flush_journal()
+
+            print(f"{backend}: {group_count} 个群组结算 {group_count * rounds} 局, {elapsed:.2f} 秒; "
+                  f"余额查询 {len(balance_latencies)} 次, p50 {percentile(balance_latencies, 0.5):.3f} ms, "
+                  f"p99 {percentile(balance_latencies, 0.99):.3f} ms; "
+                  f"排行榜查询 {len(leaderboard_latencies)} 次, p50 {percentile(leaderboard_latencies, 0.5):.3f} ms, "
+                  f"p99 {percentile(leaderboard_latencies, 0.99):.3f} ms")
+
+@contextmanager
+def _stub_api(api_delay_ms: int = 0):
+    """
+    基准测试用的本地模拟 Telegram API：每次请求延迟 api_delay_ms 毫秒后返回成功
+    期间 API_URL 指向模拟服务器，并关闭 TELEGRAM_API 的频率限制；支持 HTTP/1.1 keep-alive
+    """
+    global API_URL
+
+    class StubApiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 响应头和响应体分开写出，keep-alive 连接上需要关闭 Nagle 算法，否则每次响应都会等待延迟确认
+        disable_nagle_algorithm = True
+
+        def _reply(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            time.sleep(api_delay_ms / 1000)
+            body = b'{"ok": true, "result": {"message_id": 1, "dice": {"value": 3}}}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = _reply
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    original_api_url = API_URL
+    original_rate_limiter = TELEGRAM_API.rate_limiter
+    API_URL = f"http://127.0.0.1:{server.server_address[1]}"
+    TELEGRAM_API.rate_limiter = None
+    try:
+        yield server
+    finally:
+        API_URL = original_api_url
+        TELEGRAM_API.rate_limiter = original_rate_limiter
+        server.shutdown()
+        server.server_close()
+
+def benchmark_api(message_count: int = 2000, threads: int = 8, api_delay_ms: int = 0) -> None:
+    """
+    API 客户端基准测试：多个线程向本地模拟 API 发送消息
+    对比每次新建连接（模块级 requests.post）和共用连接池客户端的每秒消息数
+    """
+    def send_unpooled(chat_id: int) -> None:
+        requests.post(f"{API_URL}/sendMessage", data={"chat_id": chat_id, "text": "测试"},
+                      timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT)).json()
+
+    def send_pooled(chat_id: int) -> None:
+        TELEGRAM_API.post("sendMessage", data={"chat_id": chat_id, "text": "测试"})
+
+    with _stub_api(api_delay_ms):
+        for mode, send in (("每次新建连接", send_unpooled), ("连接池", send_pooled)):
+            per_thread = message_count // threads
+
+            def worker(thread_index: int) -> None:
+                for i in range(per_thread):
+                    send(thread_index)
+
+            workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+            started = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            print(f"{mode}: {per_thread * threads} 条消息, {threads} 个线程, API 延迟 {api_delay_ms} ms, "
+                  f"{elapsed:.2f} 秒, {per_thread * threads / elapsed:.0f} 条/秒")
+
+def benchmark_runtime(update_count: int = 100, chat_count: int = 20, api_delay_ms: int = 100) -> None:
+    """
+    运行模式基准测试：本地模拟 Telegram API，每次请求延迟 api_delay_ms 毫秒
+    对比主线程逐条处理和 threaded 模式（工作线程按会话分发）的吞吐量，结果中注明各模式的处理线程数
+    """
+    import tempfile
+
+    updates = [
+        {"update_id": i + 1,
+         "message": {"message_id": i + 1, "text": "/help",
+                     "chat": {"id": i % chat_count + 1, "type": "private"},
+                     "from": {"id": i % chat_count + 1, "first_name": f"玩家{i % chat_count + 1}"}}}
+        for i in range(update_count)
+    ]
+
+    def run_sequential(data_manager: DataManager) -> None:
+        for update in updates:
+            handle_update(update, data_manager)
+
+    def run_threaded(data_manager: DataManager) -> None:
+        dispatcher = ChatMailboxes(UPDATE_WORKER_THREADS, max_pending=UPDATE_QUEUE_LIMIT)
+        for update in updates:
+            dispatcher.post(update_chat_key(update), handle_update, update, data_manager)
+        while dispatcher.get_stats()['chats']:
+            time.sleep(0.01)
+
+    with _stub_api(api_delay_ms):
+        for mode, threads, run in (("逐条处理", 1, run_sequential),
+                                   ("threaded", UPDATE_WORKER_THREADS, run_threaded)):
+            with tempfile.TemporaryDirectory() as directory:
+                data_manager = DataManager(os.path.join(directory, "user_data.snap"))
+                for chat_index in range(chat_count):
+                    data_manager.add_user(chat_index + 1, f"玩家{chat_index + 1}")
+                started = time.perf_counter()
+                run(data_manager)
+                elapsed = time.perf_counter() - started
+                print(f"{mode}: {update_count} 条更新, {chat_count} 个会话, {threads} 个处理线程, "
+                      f"API 延迟 {api_delay_ms} ms, {elapsed:.2f} 秒, {update_count / elapsed:.1f} 条/秒")
+
+def benchmark_ingest(update_count: int = 200, interval_ms: int = 20) -> None:
+    """
+    更新接收延迟基准测试：本地模拟 Telegram 每 interval_ms 毫秒产生一条更新
+    对比长轮询（以及旧版每次轮询后休眠1秒）和 webhook 推送，从产生更新到交给分发器的端到端延迟
+    """
+    global API_URL
+
+    pending = []  # 已产生的更新，getUpdates 按 offset 返回
+    cond = threading.Condition()
+
+    class FakeTelegramHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            query = dict(pair.split("=", 1) for pair in self.path.partition("?")[2].split("&") if pair)
+            offset = int(query.get("offset", 0))
+            deadline = time.monotonic() + int(query.get("timeout", 0))
+            with cond:
+                # 长轮询：没有新更新时等待，直到有更新或超时
+                while not (pending and pending[-1]["update_id"] >= offset) and time.monotonic() < deadline:
+                    cond.wait(deadline - time.monotonic())
+                result = [u for u in pending if u["update_id"] >= offset]
+            body = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # deleteWebhook 等其它请求直接返回成功
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            body = b'{"ok": true, "result": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def make_update(update_id: int) -> Dict[str, Any]:
+        return {"update_id": update_id,
+                "message": {"message_id": update_id, "text": "大100",
+                            "chat": {"id": -1, "type": "group"}, "from": {"id": 1, "first_name": "玩家1"}}}
+
+    def measure(mode: str) -> List[float]:
+        with cond:
+            pending.clear()
+        produced = {}
+        latencies = []
+        done = threading.Event()
+
+        def sink(update: Dict[str, Any]) -> None:
+            latencies.append((time.perf_counter() - produced[update["update_id"]]) * 1000)
+            if len(latencies) == update_count:
+                done.set()
+
+        stop = threading.Event()
+        if mode == "webhook":
+            server = WebhookServer(sink, host="127.0.0.1", port=0, secret_token="benchmark")
+            server.start()
+            session = requests.Session()
+            webhook_url = f"http://127.0.0.1:{server.port}/"
+
+            def deliver(update: Dict[str, Any]) -> None:
+                session.post(webhook_url, data=json.dumps(update),
+                             headers={"X-Telegram-Bot-Api-Secret-Token": "benchmark"})
+        else:
+            def poll() -> None:
+                poll_updates(sink, stop, timeout=1)
+
+            def poll_old() -> None:
+                # 旧版主循环：每次 getUpdates 返回后固定休眠1秒
+                last_update_id = None
+                while not stop.is_set():
+                    for update in get_updates(offset=last_update_id, timeout=1):
+                        last_update_id = update["update_id"] + 1
+                        sink(update)
+                    time.sleep(1)
+
+            poller = threading.Thread(target=poll_old if mode == "长轮询+休眠1秒" else poll, daemon=True)
+            poller.start()
+
+            def deliver(update: Dict[str, Any]) -> None:
+                with cond:
+                    pending.append(update)
+                    cond.notify_all()
+
+        for i in range(update_count):
+            update = make_update(i + 1)
+            produced[update["update_id"]] = time.perf_counter()
+            deliver(update)
+            time.sleep(interval_ms / 1000)
+        done.wait(30)
+        stop.set()
+        if mode == "webhook":
+            server.stop()
+        else:
+            poller.join()
+        return latencies
+
+    def percentile(values: List[float], q: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+    fake = ThreadingHTTPServer(("127.0.0.1", 0), FakeTelegramHandler)
+    fake.daemon_threads = True
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    original_api_url = API_URL
+    API_URL = f"http://127.0.0.1:{fake.server_address[1]}"
+    try:
+        for mode in ("长轮询+休眠1秒", "长轮询", "webhook"):
+            latencies = measure(mode)
+            print(f"{mode}: {len(latencies)} 条更新, 间隔 {interval_ms} ms, 延迟 p50 {percentile(latencies, 0.5):.1f} ms, "
+                  f"p99 {percentile(latencies, 0.99):.1f} ms, 最大 {max(latencies, default=0):.1f} ms")
+    finally:
+        API_URL = original_api_url
+        fake.shutdown()
+        fake.server_close()
+
 # ============== 主函数 ==============
 
 def create_gif_with_text(text: str, output_path: str) -> bool:
@@ -3797,104 +6926,84 @@ def create_gif_with_text(text: str, output_path: str) -> bool:
         logger.error(f"创建GIF出错: {e}")
         return False
 
-def main():
-    """主程序入口"""
-    print("正在启动骰子游戏机器人...")
-    
-    # 创建数据管理器
-    data_manager = DataManager()
-    
-    # 用于追踪最后处理的更新ID
-    last_update_id = None
-    
-    try:
-        # 主循环
-        while True:
-            try:
-                # 获取更新
-                updates = get_updates(offset=last_update_id)
+def handle_update(update: Dict[str, Any], data_manager: DataManager) -> None:
+    """处理一条 Telegram 更新（消息或按钮回调）"""
+    # 处理消息
+    if "message" in update:
+        message = update["message"]
+        
+        # 检查是否是骰子消息，群组中的骰子交给群组邮箱按顺序处理
+        if "dice" in message:
+            if "chat" in message and message["chat"]["id"] < 0:
+                GROUP_MAILBOXES.post(message["chat"]["id"], handle_dice_message, message, data_manager)
+            return
+        
+        # 忽略其他非文本消息
+        if "text" not in message:
+            return
+        
+        # 获取基本信息
+        text = message["text"]
+        
+        # 处理命令
+        if text.startswith("/"):
+            if text.startswith("/start"):
+                handle_start_command(message, data_manager)
+            elif text.startswith("/help"):
+                handle_help_command(message, data_manager)
+            elif text.startswith("/rules"):
+                handle_rules_command(message, data_manager)
+            elif text.startswith("/play"):
+                handle_play_command(message, data_manager)
+            elif text.startswith("/balance"):
+                handle_balance_command(message, data_manager)
+            elif text.startswith("/history"):
+                # 处理历史记录查询
+                user_id = message["from"]["id"]
+                chat_id = message["chat"]["id"]
+                result = send_message(chat_id, "正在加载历史数据...")
+                if result.get("ok"):
+                    message_id = result["result"]["message_id"]
+                    handle_history_callback(user_id, chat_id, message_id, data_manager)
+            elif text.startswith("/addcoins") or text.startswith("/ban") or text.startswith("/unban") or text == "/adminstats" or text == "/lockstats" or text.startswith("/setdice"):
+                handle_admin_command(message, data_manager)
+            elif text.lower() == "/stop" and message["chat"]["id"] < 0:
+                # 停止群组游戏，与该群组的其它游戏事件按顺序处理
+                GROUP_MAILBOXES.post(message["chat"]["id"], handle_group_bet_message, message, data_manager)
+            # 其他命令...
+        else:
+            # 处理非命令消息
+            # 检查是否在输入投注金额状态
+            user_id = message["from"]["id"]
+            text = message["text"]
+            
+            # 检查是否是"反水"请求
+            if "chat" in message and message["chat"]["id"] < 0 and text.strip() == "反水":
+                # 获取用户数据
+                user_data = data_manager.get_user(user_id)
+                chat_id = message["chat"]["id"]
+                
+                if not user_data:
+                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
+                                reply_to_message_id=message["message_id"])
+                    return
                 
-                for update in updates:
-                    # 更新最后处理的更新ID
-                    last_update_id = update["update_id"] + 1
+                # 计算反水金额
+                rebate_amount = data_manager.calculate_rebate(user_id)
+                
+                if rebate_amount <= 0:
+                    send_message(chat_id, "❌ 您暂时没有可领取的反水", 
+                                reply_to_message_id=message["message_id"])
+                    return
+                
+                # 领取反水
+                rebate_amount, success = data_manager.claim_rebate(user_id)
+                
+                if success:
+                    new_balance = data_manager.get_user(user_id)["balance"]
                     
-                    # 处理消息
-                    if "message" in update:
-                        message = update["message"]
-                        
-                        # 检查是否是骰子消息
-                        if "dice" in message:
-                            handle_dice_message(message, data_manager)
-                            continue
-                        
-                        # 忽略其他非文本消息
-                        if "text" not in message:
-                            continue
-                        
-                        # 获取基本信息
-                        text = message["text"]
-                        
-                        # 处理命令
-                        if text.startswith("/"):
-                            if text.startswith("/start"):
-                                handle_start_command(message, data_manager)
-                            elif text.startswith("/help"):
-                                handle_help_command(message, data_manager)
-                            elif text.startswith("/rules"):
-                                handle_rules_command(message, data_manager)
-                            elif text.startswith("/play"):
-                                handle_play_command(message, data_manager)
-                            elif text.startswith("/balance"):
-                                handle_balance_command(message, data_manager)
-                            elif text.startswith("/history"):
-                                # 处理历史记录查询
-                                user_id = message["from"]["id"]
-                                chat_id = message["chat"]["id"]
-                                result = send_message(chat_id, "正在加载历史数据...")
-                                if result.get("ok"):
-                                    message_id = result["result"]["message_id"]
-                                    handle_history_callback(user_id, chat_id, message_id, data_manager)
-                            elif text.startswith("/addcoins") or text.startswith("/ban") or text.startswith("/unban") or text == "/adminstats" or text.startswith("/setdice"):
-                                handle_admin_command(message, data_manager)
-                            # 其他命令...
-                        else:
-                            # 处理非命令消息
-                            # 检查是否在输入投注金额状态
-                            user_id = message["from"]["id"]
-                            text = message["text"]
-                            
-                            # 检查是否是"反水"请求
-                            if "chat" in message and message["chat"]["id"] < 0 and text.strip() == "反水":
-                                # 获取用户数据
-                                user_data = data_manager.get_user(user_id)
-                                chat_id = message["chat"]["id"]
-                                
-                                if not user_data:
-                                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
-                                                reply_to_message_id=message["message_id"])
-                                    continue
-                                
-                                # 计算反水金额
-                                rebate_amount = data_manager.calculate_rebate(user_id)
-                                
-                                if rebate_amount <= 0:
-                                    send_message(chat_id, "❌ 您暂时没有可领取的反水", 
-                                                reply_to_message_id=message["message_id"])
-                                    continue
-                                
-                                # 添加反水
-                                new_balance, success = data_manager.update_balance(user_id, rebate_amount)
-                                
-                                if success:
-                                    # 记录此次反水
-                                    data_manager.rebate_records[user_id] = {
-                                        "last_claimed": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                        "total_bets": user_data["total_bets"],
-                                        "amount": rebate_amount
-                                    }
-                                    
-                                    # 发送反水成功消息
-                                    rebate_message = f"""
+                    # 发送反水成功消息
+                    rebate_message = f"""
 💰 *反水成功* 💰
 
 用户: {user_data['name']}
@@ -3904,246 +7013,240 @@ ID: {user_id}
 
 投注满100金币即可获得1金币反水
 祝您游戏愉快！
-                                    """
-                                    
-                                    send_message(chat_id, rebate_message, reply_to_message_id=message["message_id"])
-                                else:
-                                    send_message(chat_id, "❌ 反水失败，请稍后再试", 
-                                                reply_to_message_id=message["message_id"])
+                    """
+                    
+                    send_message(chat_id, rebate_message, reply_to_message_id=message["message_id"])
+                else:
+                    send_message(chat_id, "❌ 反水失败，请稍后再试", 
+                                reply_to_message_id=message["message_id"])
+            
+            # 检查是否是红包命令
+            elif "chat" in message and text.strip().startswith("hb "):
+                chat_id = message["chat"]["id"]
+                user_data = data_manager.get_user(user_id)
+                
+                if not user_data:
+                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
+                                reply_to_message_id=message["message_id"])
+                    return
+                
+                try:
+                    parts = text.strip().split()
+                    
+                    # 判断是群组红包还是私人红包
+                    is_single_target = "reply_to_message" in message
+                    
+                    if is_single_target:
+                        # 私人红包，只需要金额: hb 金额 或 hb 金额o
+                        if len(parts) != 2:
+                            send_message(chat_id, "❌ 私人红包格式错误，正确格式: hb [金额] 或 hb [金额]o", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 检查金额是否带o后缀
+                        amount_str = parts[1]
+                        
+                        if amount_str.endswith('o'):
+                            amount_str = amount_str[:-1]  # 移除o后缀
+                        
+                        try:
+                            amount = int(amount_str)
+                        except ValueError:
+                            send_message(chat_id, "❌ 红包金额必须是正整数", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        if amount <= 0:
+                            send_message(chat_id, "❌ 红包金额必须大于0", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 检查余额是否足够
+                        if user_data["balance"] < amount:
+                            send_message(chat_id, f"❌ 您的余额不足，当前余额: {user_data['balance']} 金币", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 扣除用户余额
+                        new_balance, success = data_manager.update_balance(user_id, -amount)
+                        
+                        if not success:
+                            send_message(chat_id, "❌ 发送红包失败，请稍后再试", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        try:
+                            target_user_id = message["reply_to_message"]["from"]["id"]
+                            target_name = message["reply_to_message"]["from"]["first_name"]
+                            
+                            # 确保目标用户存在
+                            target_user = data_manager.get_user(target_user_id)
+                            if not target_user:
+                                # 如果用户不存在，创建新用户
+                                data_manager.add_user(target_user_id, target_name)
                             
-                            # 检查是否是红包命令
-                            elif "chat" in message and text.strip().startswith("hb "):
-                                chat_id = message["chat"]["id"]
-                                user_data = data_manager.get_user(user_id)
-                                
-                                if not user_data:
-                                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
-                                                reply_to_message_id=message["message_id"])
-                                    continue
-                                
-                                try:
-                                    parts = text.strip().split()
-                                    
-                                    # 判断是群组红包还是私人红包
-                                    is_single_target = "reply_to_message" in message
-                                    
-                                    if is_single_target:
-                                        # 私人红包，只需要金额: hb 金额 或 hb 金额o
-                                        if len(parts) != 2:
-                                            send_message(chat_id, "❌ 私人红包格式错误，正确格式: hb [金额] 或 hb [金额]o", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 检查金额是否带o后缀
-                                        amount_str = parts[1]
-                                        
-                                        if amount_str.endswith('o'):
-                                            amount_str = amount_str[:-1]  # 移除o后缀
-                                        
-                                        try:
-                                            amount = int(amount_str)
-                                        except ValueError:
-                                            send_message(chat_id, "❌ 红包金额必须是正整数", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        if amount <= 0:
-                                            send_message(chat_id, "❌ 红包金额必须大于0", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 检查余额是否足够
-                                        if user_data["balance"] < amount:
-                                            send_message(chat_id, f"❌ 您的余额不足，当前余额: {user_data['balance']} 金币", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 扣除用户余额
-                                        new_balance, success = data_manager.update_balance(user_id, -amount)
-                                        
-                                        if not success:
-                                            send_message(chat_id, "❌ 发送红包失败，请稍后再试", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        try:
-                                            target_user_id = message["reply_to_message"]["from"]["id"]
-                                            target_name = message["reply_to_message"]["from"]["first_name"]
-                                            
-                                            # 确保目标用户存在
-                                            target_user = data_manager.get_user(target_user_id)
-                                            if not target_user:
-                                                # 如果用户不存在，创建新用户
-                                                data_manager.add_user(target_user_id, target_name)
-                                            
-                                            # 创建私人红包
-                                            hongbao_id = f"{chat_id}_{int(time.time())}_private"
-                                            
-                                            # 初始化私人红包
-                                            hongbao_info = {
-                                                "sender_id": user_id,
-                                                "sender_name": user_data["name"],
-                                                "target_id": target_user_id,
-                                                "target_name": target_name,
-                                                "amount": amount,
-                                                "is_claimed": False,
-                                                "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                            }
-                                            
-                                            # 保存红包信息
-                                            if not hasattr(data_manager, "hongbao"):
-                                                data_manager.hongbao = {}
-                                            
-                                            data_manager.hongbao[hongbao_id] = hongbao_info
-                                            
-                                            # 创建抢红包按钮
-                                            grab_button = {
-                                                "inline_keyboard": [
-                                                    [
-                                                        {
-                                                            "text": "🧧 领取红包 🧧",
-                                                            "callback_data": f"grab_private_hongbao:{hongbao_id}"
-                                                        }
-                                                    ]
-                                                ]
-                                            }
-                                            
-                                            # 发送红包提示，使用GIF动画
-                                            hongbao_message = f"""
+                            # 创建私人红包
+                            hongbao_id = f"{chat_id}_{int(time.time())}_private"
+                            
+                            # 初始化私人红包
+                            hongbao_info = {
+                                "sender_id": user_id,
+                                "sender_name": user_data["name"],
+                                "target_id": target_user_id,
+                                "target_name": target_name,
+                                "amount": amount,
+                                "is_claimed": False,
+                                "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                            }
+                            
+                            # 保存红包信息
+                            data_manager.put_hongbao(hongbao_id, hongbao_info)
+                            
+                            # 创建抢红包按钮
+                            grab_button = {
+                                "inline_keyboard": [
+                                    [
+                                        {
+                                            "text": "🧧 领取红包 🧧",
+                                            "callback_data": f"grab_private_hongbao:{hongbao_id}"
+                                        }
+                                    ]
+                                ]
+                            }
+                            
+                            # 发送红包提示，使用GIF动画
+                            hongbao_message = f"""
 🧧 *私人红包* 🧧
 
 {user_data['name']} 发送了一个红包给 {target_name}
 金额: {amount} 金币
 
 请点击下方按钮领取！
-                                            """
-                                            # 使用GIF动画发送红包
-                                            result = send_animation(
-                                                chat_id, 
-                                                "attached_assets/GIf_hb_02.mp4", 
-                                                caption=hongbao_message, 
-                                                reply_markup=grab_button
-                                            )
-                                            
-                                            # 保存消息ID，用于后续更新
-                                            if result.get("ok"):
-                                                message_id = result["result"]["message_id"]
-                                                hongbao_info["message_id"] = message_id
-                                                data_manager.hongbao[hongbao_id] = hongbao_info
-                                            
-                                        except Exception as e:
-                                            logger.error(f"处理私人红包错误: {e}")
-                                            send_message(chat_id, "❌ 发送私人红包失败，请确保回复了有效的用户消息", 
-                                                        reply_to_message_id=message["message_id"])
-                                            # 退还金币
-                                            data_manager.update_balance(user_id, amount)
-                                    else:
-                                        # 群组红包，需要人数和金额: hb 人数 金额 或 hb 人数 金额o
-                                        if len(parts) != 3:
-                                            send_message(chat_id, "❌ 群组红包格式错误，正确格式: hb [人数] [金额] 或 hb [人数] [金额]o", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        people_count = int(parts[1])
-                                        
-                                        # 检查金额是否带o后缀
-                                        amount_str = parts[2]
-                                        
-                                        if amount_str.endswith('o'):
-                                            amount_str = amount_str[:-1]  # 移除o后缀
-                                        
-                                        try:
-                                            amount = int(amount_str)
-                                        except ValueError:
-                                            send_message(chat_id, "❌ 红包金额必须是正整数", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 检查人数和金额的有效性
-                                        if people_count <= 0:
-                                            send_message(chat_id, "❌ 红包人数必须大于0", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        if amount <= 0:
-                                            send_message(chat_id, "❌ 红包金额必须大于0", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 检查余额是否足够
-                                        if user_data["balance"] < amount:
-                                            send_message(chat_id, f"❌ 您的余额不足，当前余额: {user_data['balance']} 金币", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 扣除用户余额
-                                        new_balance, success = data_manager.update_balance(user_id, -amount)
-                                        
-                                        if not success:
-                                            send_message(chat_id, "❌ 发送红包失败，请稍后再试", 
-                                                        reply_to_message_id=message["message_id"])
-                                            continue
-                                        
-                                        # 群组红包
-                                        # 保存红包信息，等待用户领取
-                                        hongbao_id = f"{chat_id}_{int(time.time())}_group"
-                                        
-                                        # 生成随机红包金额
-                                        random_amounts = []
-                                        remaining = amount
-                                        
-                                        # 为每个人分配随机金额，最后一个人获得剩余金额
-                                        for i in range(people_count - 1):
-                                            # 确保每个人至少能得到1金币
-                                            max_possible = remaining - (people_count - i - 1)
-                                            if max_possible <= 1:
-                                                # 如果剩余金额不够分，就给最低1金币
-                                                coin = 1
-                                            else:
-                                                # 随机分配，但至少1金币
-                                                coin = random.randint(1, max_possible)
-                                            random_amounts.append(coin)
-                                            remaining -= coin
-                                        
-                                        # 最后一个人获得剩余的全部金额
-                                        random_amounts.append(remaining)
-                                        
-                                        # 打乱金额顺序，这样先抢的人不一定能得到更多
-                                        random.shuffle(random_amounts)
-                                        
-                                        # 初始化红包信息
-                                        hongbao_info = {
-                                            "sender_id": user_id,
-                                            "sender_name": user_data["name"],
-                                            "total_amount": amount,
-                                            "amounts": random_amounts,  # 随机金额列表
-                                            "remaining_amount": amount,
-                                            "total_count": people_count,
-                                            "remaining_count": people_count,
-                                            "receivers": [],
-                                            "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                        }
-                                        
-                                        # 保存红包信息
-                                        if not hasattr(data_manager, "hongbao"):
-                                            data_manager.hongbao = {}
-                                        
-                                        data_manager.hongbao[hongbao_id] = hongbao_info
-                                        
-                                        # 创建抢红包按钮
-                                        grab_button = {
-                                            "inline_keyboard": [
-                                                [
-                                                    {
-                                                        "text": "🧧 抢红包 🧧",
-                                                        "callback_data": f"grab_hongbao:{hongbao_id}"
-                                                    }
-                                                ]
-                                            ]
-                                        }
-                                        
-                                        # 发送红包提示，使用GIF动画
-                                        hongbao_message = f"""
+                            """
+                            # 使用GIF动画发送红包
+                            result = send_animation(
+                                chat_id, 
+                                "attached_assets/GIf_hb_02.mp4", 
+                                caption=hongbao_message, 
+                                reply_markup=grab_button
+                            )
+                            
+                            # 保存消息ID，用于后续更新
+                            if result.get("ok"):
+                                message_id = result["result"]["message_id"]
+                                hongbao_info["message_id"] = message_id
+                                data_manager.put_hongbao(hongbao_id, hongbao_info)
+                            
+                        except Exception as e:
+                            logger.error(f"处理私人红包错误: {e}")
+                            send_message(chat_id, "❌ 发送私人红包失败，请确保回复了有效的用户消息", 
+                                        reply_to_message_id=message["message_id"])
+                            # 退还金币
+                            data_manager.update_balance(user_id, amount)
+                    else:
+                        # 群组红包，需要人数和金额: hb 人数 金额 或 hb 人数 金额o
+                        if len(parts) != 3:
+                            send_message(chat_id, "❌ 群组红包格式错误，正确格式: hb [人数] [金额] 或 hb [人数] [金额]o", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        people_count = int(parts[1])
+                        
+                        # 检查金额是否带o后缀
+                        amount_str = parts[2]
+                        
+                        if amount_str.endswith('o'):
+                            amount_str = amount_str[:-1]  # 移除o后缀
+                        
+                        try:
+                            amount = int(amount_str)
+                        except ValueError:
+                            send_message(chat_id, "❌ 红包金额必须是正整数", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 检查人数和金额的有效性
+                        if people_count <= 0:
+                            send_message(chat_id, "❌ 红包人数必须大于0", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        if amount <= 0:
+                            send_message(chat_id, "❌ 红包金额必须大于0", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 检查余额是否足够
+                        if user_data["balance"] < amount:
+                            send_message(chat_id, f"❌ 您的余额不足，当前余额: {user_data['balance']} 金币", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 扣除用户余额
+                        new_balance, success = data_manager.update_balance(user_id, -amount)
+                        
+                        if not success:
+                            send_message(chat_id, "❌ 发送红包失败，请稍后再试", 
+                                        reply_to_message_id=message["message_id"])
+                            return
+                        
+                        # 群组红包
+                        # 保存红包信息，等待用户领取
+                        hongbao_id = f"{chat_id}_{int(time.time())}_group"
+                        
+                        # 生成随机红包金额
+                        random_amounts = []
+                        remaining = amount
+                        
+                        # 为每个人分配随机金额，最后一个人获得剩余金额
+                        for i in range(people_count - 1):
+                            # 确保每个人至少能得到1金币
+                            max_possible = remaining - (people_count - i - 1)
+                            if max_possible <= 1:
+                                # 如果剩余金额不够分，就给最低1金币
+                                coin = 1
+                            else:
+                                # 随机分配，但至少1金币
+                                coin = random.randint(1, max_possible)
+                            random_amounts.append(coin)
+                            remaining -= coin
+                        
+                        # 最后一个人获得剩余的全部金额
+                        random_amounts.append(remaining)
+                        
+                        # 打乱金额顺序，这样先抢的人不一定能得到更多
+                        random.shuffle(random_amounts)
+                        
+                        # 初始化红包信息
+                        hongbao_info = {
+                            "sender_id": user_id,
+                            "sender_name": user_data["name"],
+                            "total_amount": amount,
+                            "amounts": random_amounts,  # 随机金额列表
+                            "remaining_amount": amount,
+                            "total_count": people_count,
+                            "remaining_count": people_count,
+                            "receivers": [],
+                            "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        }
+                        
+                        # 保存红包信息
+                        data_manager.put_hongbao(hongbao_id, hongbao_info)
+                        
+                        # 创建抢红包按钮
+                        grab_button = {
+                            "inline_keyboard": [
+                                [
+                                    {
+                                        "text": "🧧 抢红包 🧧",
+                                        "callback_data": f"grab_hongbao:{hongbao_id}"
+                                    }
+                                ]
+                            ]
+                        }
+                        
+                        # 发送红包提示，使用GIF动画
+                        hongbao_message = f"""
 🧧 *红包来啦* 🧧
 
 {user_data['name']} 发送了一个金额红包
@@ -4151,106 +7254,103 @@ ID: {user_id}
 数量: {people_count} 个
 
 点击下方按钮抢红包！
-                                        """
-                                        # 使用GIF动画发送红包
-                                        result = send_animation(
-                                            chat_id, 
-                                            "attached_assets/GIf_hb_02.mp4", 
-                                            caption=hongbao_message, 
-                                            reply_markup=grab_button
-                                        )
-                                        
-                                        # 保存消息ID，用于后续更新
-                                        if result.get("ok"):
-                                            message_id = result["result"]["message_id"]
-                                            hongbao_info["message_id"] = message_id
-                                            data_manager.hongbao[hongbao_id] = hongbao_info
-                                        
-                                except ValueError:
-                                    send_message(chat_id, "❌ 红包格式错误，请检查人数和金额是否为正整数", 
-                                                reply_to_message_id=message["message_id"])
-                                except Exception as e:
-                                    logger.error(f"处理红包错误: {e}")
-                                    send_message(chat_id, "❌ 发送红包失败，请稍后再试", 
-                                                reply_to_message_id=message["message_id"])
-                                    
-                            # 检查是否是"抢"红包的请求（已替换为按钮形式）
-                            elif "chat" in message and message["chat"]["id"] < 0 and text.strip() == "抢":
-                                chat_id = message["chat"]["id"]
-                                send_message(chat_id, "请点击红包下方的按钮来抢红包！", 
-                                            reply_to_message_id=message["message_id"])
-                                
-                            # 管理员清除余额命令
-                            elif "chat" in message and text.strip().startswith("清除余额") and user_id in ADMIN_IDS:
-                                chat_id = message["chat"]["id"]
-                                
-                                # 解析命令
-                                parts = text.strip().split()
-                                
-                                # 检查是否指定了用户ID
-                                if len(parts) >= 2:
-                                    try:
-                                        target_user_id = int(parts[1])
-                                        target_user = data_manager.get_user(target_user_id)
-                                        
-                                        if target_user:
-                                            # 重置指定用户的余额
-                                            old_balance = target_user["balance"]
-                                            data_manager.users[str(target_user_id)]["balance"] = 0
-                                            
-                                            # 发送确认消息
-                                            send_message(chat_id, f"✅ 已清除用户 {target_user['name']} (ID: {target_user_id}) 的余额\n原余额: {old_balance} 金币", 
-                                                        reply_to_message_id=message["message_id"])
-                                        else:
-                                            send_message(chat_id, f"❌ 用户ID {target_user_id} 不存在", 
-                                                        reply_to_message_id=message["message_id"])
-                                    except ValueError:
-                                        send_message(chat_id, "❌ 无效的用户ID，请提供正确的数字ID", 
-                                                    reply_to_message_id=message["message_id"])
-                                else:
-                                    # 清除所有用户的余额
-                                    user_count = 0
-                                    for user_id_str in data_manager.users:
-                                        if data_manager.users[user_id_str]["balance"] > 0:
-                                            data_manager.users[user_id_str]["balance"] = 0
-                                            user_count += 1
-                                    
-                                    # 发送确认消息
-                                    send_message(chat_id, f"✅ 已清除所有用户的余额，共影响 {user_count} 个用户", 
-                                                reply_to_message_id=message["message_id"])
-                            
-                            # 反水命令
-                            elif "chat" in message and text.strip().lower() == "fs":
-                                chat_id = message["chat"]["id"]
-                                user_data = data_manager.get_user(user_id)
-                                
-                                if not user_data:
-                                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
-                                                reply_to_message_id=message["message_id"])
-                                    continue
-                                
-                                # 计算并领取反水
-                                rebate_amount, success = data_manager.claim_rebate(user_id)
-                                
-                                if success:
-                                    rebate_message = f"✅ 反水领取成功！\n反水金额: {rebate_amount} 金币\n当前余额: {user_data['balance']} 金币"
-                                else:
-                                    rebate_message = "❌ 暂无可领取的反水"
-                                
-                                send_message(chat_id, rebate_message, reply_to_message_id=message["message_id"])
+                        """
+                        # 使用GIF动画发送红包
+                        result = send_animation(
+                            chat_id, 
+                            "attached_assets/GIf_hb_02.mp4", 
+                            caption=hongbao_message, 
+                            reply_markup=grab_button
+                        )
+                        
+                        # 保存消息ID，用于后续更新
+                        if result.get("ok"):
+                            message_id = result["result"]["message_id"]
+                            hongbao_info["message_id"] = message_id
+                            data_manager.put_hongbao(hongbao_id, hongbao_info)
+                        
+                except ValueError:
+                    send_message(chat_id, "❌ 红包格式错误，请检查人数和金额是否为正整数", 
+                                reply_to_message_id=message["message_id"])
+                except Exception as e:
+                    logger.error(f"处理红包错误: {e}")
+                    send_message(chat_id, "❌ 发送红包失败，请稍后再试", 
+                                reply_to_message_id=message["message_id"])
+                    
+            # 检查是否是"抢"红包的请求（已替换为按钮形式）
+            elif "chat" in message and message["chat"]["id"] < 0 and text.strip() == "抢":
+                chat_id = message["chat"]["id"]
+                send_message(chat_id, "请点击红包下方的按钮来抢红包！", 
+                            reply_to_message_id=message["message_id"])
+                
+            # 管理员清除余额命令
+            elif "chat" in message and text.strip().startswith("清除余额") and user_id in ADMIN_IDS:
+                chat_id = message["chat"]["id"]
+                
+                # 解析命令
+                parts = text.strip().split()
+                
+                # 检查是否指定了用户ID
+                if len(parts) >= 2:
+                    try:
+                        target_user_id = int(parts[1])
+                        target_user = data_manager.get_user(target_user_id)
+                        
+                        if target_user:
+                            # 重置指定用户的余额
+                            old_balance = data_manager.clear_balance(target_user_id)
                             
-                            # 查询余额命令
-                            elif "chat" in message and text.strip() == "ye":
-                                chat_id = message["chat"]["id"]
-                                user_data = data_manager.get_user(user_id)
-                                
-                                if not user_data:
-                                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
-                                                reply_to_message_id=message["message_id"])
-                                    continue
-                                
-                                # 发送余额信息
-                                balance_message = f"""
+                            # 发送确认消息
+                            send_message(chat_id, f"✅ 已清除用户 {target_user['name']} (ID: {target_user_id}) 的余额\n原余额: {old_balance} 金币", 
+                                        reply_to_message_id=message["message_id"])
+                        else:
+                            send_message(chat_id, f"❌ 用户ID {target_user_id} 不存在", 
+                                        reply_to_message_id=message["message_id"])
+                    except ValueError:
+                        send_message(chat_id, "❌ 无效的用户ID，请提供正确的数字ID", 
+                                    reply_to_message_id=message["message_id"])
+                else:
+                    # 清除所有用户的余额
+                    user_count = data_manager.clear_all_balances()
+                    
+                    # 发送确认消息
+                    send_message(chat_id, f"✅ 已清除所有用户的余额，共影响 {user_count} 个用户", 
+                                reply_to_message_id=message["message_id"])
+            
+            # 反水命令
+            elif "chat" in message and text.strip().lower() == "fs":
+                chat_id = message["chat"]["id"]
+                user_data = data_manager.get_user(user_id)
+                
+                if not user_data:
+                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
+                                reply_to_message_id=message["message_id"])
+                    return
+                
+                # 计算并领取反水
+                rebate_amount, success = data_manager.claim_rebate(user_id)
+                
+                if success:
+                    # get_user 返回的是领取前的快照，重新读取领取后的余额
+                    new_balance = data_manager.get_user(user_id)["balance"]
+                    rebate_message = f"✅ 反水领取成功！\n反水金额: {rebate_amount} 金币\n当前余额: {new_balance} 金币"
+                else:
+                    rebate_message = "❌ 暂无可领取的反水"
+                
+                send_message(chat_id, rebate_message, reply_to_message_id=message["message_id"])
+            
+            # 查询余额命令
+            elif "chat" in message and text.strip() == "ye":
+                chat_id = message["chat"]["id"]
+                user_data = data_manager.get_user(user_id)
+                
+                if not user_data:
+                    send_message(chat_id, "❌ 您还没有注册账户，请先使用 /start 命令创建账户", 
+                                reply_to_message_id=message["message_id"])
+                    return
+                
+                # 发送余额信息
+                balance_message = f"""
 💰 *余额查询* 💰
 
 用户: {user_data['name']}
@@ -4259,31 +7359,279 @@ ID: {user_id}
 VIP等级: {user_data['vip_level']} 级
 总投注: {user_data['total_bets']} 金币
 总赢取: {user_data['total_winnings']} 金币
-                                """
-                                send_message(chat_id, balance_message, reply_to_message_id=message["message_id"])
-                            
-                            # 检查是否在输入投注金额状态
-                            elif user_id in USER_STATES and USER_STATES[user_id]["state"] == STATE_ENTERING_BET_AMOUNT:
-                                handle_bet_amount_message(message, data_manager)
-                            # 检查是否是群组投注消息
-                            elif "chat" in message and message["chat"]["id"] < 0:  # 群组ID是负数
-                                handle_group_bet_message(message, data_manager)
-                    
-                    # 处理回调查询
-                    elif "callback_query" in update:
-                        handle_callback_query(update["callback_query"], data_manager)
-                
-                # 短暂休眠避免过度轮询
-                time.sleep(1)
-                
+                """
+                send_message(chat_id, balance_message, reply_to_message_id=message["message_id"])
+            
+            # 检查是否在输入投注金额状态
+            elif user_id in USER_STATES and USER_STATES[user_id]["state"] == STATE_ENTERING_BET_AMOUNT:
+                handle_bet_amount_message(message, data_manager)
+            # 检查是否是群组投注消息
+            elif "chat" in message and message["chat"]["id"] < 0:  # 群组ID是负数
+                GROUP_MAILBOXES.post(message["chat"]["id"], handle_group_bet_message, message, data_manager)
+    
+    # 处理回调查询
+    elif "callback_query" in update:
+        handle_callback_query(update["callback_query"], data_manager)
+
+
+class WebhookServer:
+    """
+    webhook 模式的更新接收服务器
+    校验 X-Telegram-Bot-Api-Secret-Token 后把更新放入有界队列并立即返回 200，不等待处理；
+    队列已满时返回 503，Telegram 稍后重新推送。转发线程按接收顺序把更新交给 sink
+    """
+
+    def __init__(self, sink, host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 secret_token: str = WEBHOOK_SECRET, max_pending: int = UPDATE_QUEUE_LIMIT):
+        self._sink = sink
+        self._secret_token = secret_token.encode()
+        self._queue = queue.Queue(max_pending)
+        self._received = 0
+        self._rejected = 0
+        self._forwarder = None
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        """实际监听的端口（port 为 0 时由系统分配）"""
+        return self._server.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                # 先校验密钥和长度，再读取请求体；拒绝时不读取请求体，关闭连接
+                token = (self.headers.get("X-Telegram-Bot-Api-Secret-Token") or "").encode()
+                if not hmac.compare_digest(token, server._secret_token):
+                    server._rejected += 1
+                    self.close_connection = True
+                    self._reply(403)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= WEBHOOK_MAX_BODY:
+                    self.close_connection = True
+                    self._reply(413)
+                    return
+                body = self.rfile.read(length) if length else b""
+                try:
+                    update = _loads(body)
+                except ValueError:
+                    self._reply(400)
+                    return
+                try:
+                    server._queue.put_nowait(update)
+                except queue.Full:
+                    logger.warning("webhook 更新队列已满，要求 Telegram 稍后重新推送")
+                    self._reply(503)
+                    return
+                server._received += 1
+                self._reply(200)
+
+            def _reply(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return WebhookHandler
+
+    def _forward(self) -> None:
+        while True:
+            update = self._queue.get()
+            if update is None:
+                return
+            try:
+                self._sink(update)
             except Exception as e:
-                logger.error(f"获取更新异常: {e}")
-                time.sleep(1)
+                logger.error(f"分发 webhook 更新出错: {e}", exc_info=True)
+
+    def start(self) -> None:
+        """开始监听，并启动转发线程"""
+        self._forwarder = threading.Thread(target=self._forward, name="webhook-forward", daemon=True)
+        self._forwarder.start()
+        threading.Thread(target=self._server.serve_forever, name="webhook", daemon=True).start()
+        logger.info(f"webhook 服务器正在监听 {self._server.server_address[0]}:{self.port}")
+
+    def stop(self) -> None:
+        """停止监听，已接收的更新全部交给 sink 后返回"""
+        self._server.shutdown()
+        self._server.server_close()
+        self._queue.put(None)
+        self._forwarder.join()
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取已接收、密钥校验失败的请求数，以及排队中的更新数"""
+        return {'received': self._received, 'rejected': self._rejected, 'queued': self._queue.qsize()}
+
+def poll_updates(sink, stop: threading.Event = None, timeout: int = 60) -> None:
+    """
+    getUpdates 长轮询，把每条更新交给 sink，设置 stop 后返回
+    没有新更新时在服务端等待，收到更新立即返回，无需额外休眠
+    """
+    # 之前以 webhook 模式运行过时 getUpdates 会返回 409，先删除 webhook
+    delete_webhook()
+    last_update_id = None
+    while stop is None or not stop.is_set():
+        started = time.monotonic()
+        updates = get_updates(offset=last_update_id, timeout=timeout)
+        for update in updates:
+            last_update_id = update["update_id"] + 1
+            sink(update)
+        if not updates and timeout and time.monotonic() - started < 1:
+            # 长轮询提前返回空结果说明请求出错，稍后重试
+            time.sleep(1)
+
+def start_webhook_server(sink) -> WebhookServer:
+    """
+    启动 webhook 服务器并向 Telegram 注册
+    WEBHOOK_URL 为空时 setWebhook 会删除 webhook，机器人收不到任何更新，因此未设置或注册失败时抛出 RuntimeError
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("webhook 模式需要设置 WEBHOOK_URL")
+    server = WebhookServer(sink)
+    server.start()
+    result = set_webhook(WEBHOOK_URL, WEBHOOK_SECRET)
+    if not result.get("ok"):
+        server.stop()
+        raise RuntimeError(f"设置 webhook 失败: {result}")
+    return server
+
+def receive_updates(sink) -> None:
+    """按 UPDATE_SOURCE 接收更新（长轮询或 webhook）并交给 sink，直到 KeyboardInterrupt"""
+    if UPDATE_SOURCE != "webhook":
+        poll_updates(sink)
+        return
+    
+    server = start_webhook_server(sink)
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        server.stop()
+
+def main():
+    """主程序入口"""
+    print("正在启动骰子游戏机器人...")
+    
+    # 创建数据管理器
+    data_manager = create_data_manager()
+    
+    # 继续或退款重启前未完成的群组游戏
+    resume_group_games(data_manager)
+    
+    try:
+        # 按会话分发：同一会话按顺序处理，不同会话并行；积压达到上限时暂停接收
+        receive_updates(lambda update: UPDATE_DISPATCHER.post(update_chat_key(update), handle_update, update, data_manager))
     
     except KeyboardInterrupt:
         print("正在关闭骰子游戏机器人...")
         data_manager.save_data()
+        if LOCK_PROFILING:
+            logger.info(f"锁统计:\n{LOCK_PROFILER.dump()}")
+        print("数据已保存。再见！")
+
+def update_chat_key(update: Dict[str, Any]) -> Optional[int]:
+    """更新所属的会话：消息或按钮所在的聊天ID（私聊时即用户ID）"""
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        callback_query = update["callback_query"]
+        if "message" in callback_query:
+            return callback_query["message"]["chat"]["id"]
+        return callback_query["from"]["id"]
+    return None
+
+def run_shard_worker(shard_index: int, shard_count: int, updates: multiprocessing.Queue) -> None:
+    """sharded 模式的工作进程：处理路由到本分片的会话，收到 None 时处理完积压的更新后退出"""
+    # Ctrl+C 由主进程处理，工作进程收到 None 后自行退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 全局发送频率由各工作进程平分；每个会话只由一个分片处理，会话的频率限制不用拆分
+    TELEGRAM_API.rate_limiter = RateLimiter(API_GLOBAL_RATE / shard_count, max(1, API_GLOBAL_BURST // shard_count))
+    data_manager = ShardedSqliteDataManager(SQLITE_FILE, shard_index, shard_count)
+    resume_group_games(data_manager)
+    logger.info(f"分片 {shard_index}/{shard_count} 已启动 (pid {os.getpid()})")
+    
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        UPDATE_DISPATCHER.post(update_chat_key(update), handle_update, update, data_manager)
+    
+    while UPDATE_DISPATCHER.get_stats()['chats']:
+        time.sleep(0.1)
+    data_manager.save_data()
+    if LOCK_PROFILING:
+        logger.info(f"分片 {shard_index} 锁统计:\n{LOCK_PROFILER.dump()}")
+
+def sharded_main():
+    """
+    sharded 模式的主程序入口：主进程只拉取更新，按会话ID散列分发到各工作进程
+    同一会话总是由同一个进程按顺序处理，群组游戏状态由该进程独占
+    """
+    print(f"正在以 sharded 模式启动骰子游戏机器人（{SHARD_PROCESSES} 个工作进程）...")
+    if STORAGE_BACKEND != "sqlite":
+        # 工作进程只能通过 SQLite 共享余额等数据，不能悄悄忽略 JSON 数据
+        sys.exit("sharded 模式需要 SQLite 存储后端（STORAGE_BACKEND=sqlite），JSON 数据请先用 migrate-sqlite 迁移")
+    
+    # 每个工作进程一个有界队列，工作进程处理不过来时主进程暂停拉取
+    queues = [multiprocessing.Queue(UPDATE_QUEUE_LIMIT) for _ in range(SHARD_PROCESSES)]
+    workers = [
+        multiprocessing.Process(target=run_shard_worker, args=(i, SHARD_PROCESSES, queues[i]), name=f"shard-{i}")
+        for i in range(SHARD_PROCESSES)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        receive_updates(lambda update: queues[shard_for_chat(update_chat_key(update), SHARD_PROCESSES)].put(update))
+    except KeyboardInterrupt:
+        print("正在关闭骰子游戏机器人...")
+        for updates_queue in queues:
+            updates_queue.put(None)
+        for worker in workers:
+            worker.join()
         print("数据已保存。再见！")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "migrate-sqlite":
+        # 一次性迁移: python 139.py migrate-sqlite [快照文件] [SQLite文件]
+        migrate_json_to_sqlite(*sys.argv[2:4])
+    elif command == "export-json":
+        # 导出可读 JSON: python 139.py export-json [输出文件] [快照文件]
+        export_json(*sys.argv[2:4])
+    elif command == "bench-storage":
+        # 存储格式基准测试: python 139.py bench-storage [用户数]
+        benchmark_storage(*map(int, sys.argv[2:3]))
+    elif command == "bench-locks":
+        # 锁竞争基准测试: python 139.py bench-locks [群组数] [每群局数] [每局注数]
+        benchmark_locks(*map(int, sys.argv[2:5]))
+    elif command == "bench-reads":
+        # 读取延迟基准测试: python 139.py bench-reads [群组数] [每群局数] [每局注数] [查询线程数]
+        benchmark_reads(*map(int, sys.argv[2:6]))
+    elif command == "bench-api":
+        # API 客户端基准测试: python 139.py bench-api [消息数] [线程数] [API延迟毫秒]
+        benchmark_api(*map(int, sys.argv[2:5]))
+    elif command == "bench-runtime":
+        # 运行模式基准测试: python 139.py bench-runtime [更新数] [会话数] [API延迟毫秒]
+        benchmark_runtime(*map(int, sys.argv[2:5]))
+    elif command == "bench-ingest":
+        # 更新接收延迟基准测试: python 139.py bench-ingest [更新数] [间隔毫秒]
+        benchmark_ingest(*map(int, sys.argv[2:4]))
+    elif UPDATE_SOURCE == "webhook" and not WEBHOOK_URL:
+        # 没有推送地址时 setWebhook 会删除 webhook，机器人收不到任何更新
+        sys.exit("webhook 模式需要设置 WEBHOOK_URL（Telegram 推送的 HTTPS 地址）")
+    elif RUNTIME_MODE == "sharded":
+        sharded_main()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,29 @@
+import importlib.util
+import os
+import tempfile
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "139.py")
+
+# 模块导入时在当前目录创建 bot.log，测试中导入时写到临时目录
+LOG_DIR = tempfile.mkdtemp(prefix="dice_bot_log_")
+
+
+def load_bot():
+    """加载一份独立的机器人模块（各测试的全局状态互不影响）"""
+    spec = importlib.util.spec_from_file_location("dice_bot", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    os.chdir(LOG_DIR)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
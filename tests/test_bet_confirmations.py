@@ -0,0 +1,83 @@
+import os
+import tempfile
+import time
+import unittest
+
+from support import FakeResponse, load_bot
+
+
+class BatchConfirmationTest(unittest.TestCase):
+    """batch 方式下同一窗口内的投注确认合并为一条消息，每局请求数在提交时统计"""
+
+    chat_id = -100
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.bot.BET_CONFIRM_MODE = "batch"
+        self.bot.BET_CONFIRM_WINDOW = 1
+        self.bot.TELEGRAM_API.rate_limiter = None
+        self.sent = []
+        self.bot.TELEGRAM_API.session.post = self._fake_post
+        self.directory = tempfile.TemporaryDirectory()
+        self.data_manager = self.bot.DataManager(os.path.join(self.directory.name, "user_data.snap"))
+
+    def tearDown(self):
+        self.bot.GROUP_MAILBOXES.cancel_timers(self.chat_id)
+        self.directory.cleanup()
+
+    def _fake_post(self, url, data=None, files=None, timeout=None):
+        self.sent.append((url.rsplit("/", 1)[1], data))
+        return FakeResponse({"ok": True, "result": {"message_id": len(self.sent)}})
+
+    def _wait_for(self, predicate, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.02)
+        return False
+
+    def _texts(self, marker):
+        return [data["text"] for method, data in self.sent if method == "sendMessage" and marker in data["text"]]
+
+    def _bet(self, user_id, text):
+        message = {"chat": {"id": self.chat_id}, "from": {"id": user_id, "first_name": f"玩家{user_id}"},
+                   "text": text, "message_id": 100 + user_id}
+        self.bot.GROUP_MAILBOXES.post(self.chat_id, self.bot.handle_group_bet_message, message, self.data_manager)
+
+    def test_bets_in_one_window_share_one_confirmation(self):
+        for user_id in (1, 2, 3):
+            self.data_manager.add_user(user_id, f"玩家{user_id}")
+            self.data_manager.update_balance(user_id, 1000)
+        start = {"chat": {"id": self.chat_id}, "from": {"id": 0}}
+        self.bot.GROUP_MAILBOXES.post(self.chat_id, self.bot.handle_start_group_game, start, self.data_manager)
+        self._bet(1, "大100")
+        self._bet(2, "小200 单50")
+        self._bet(3, "双300")
+        # 余额不足的玩家立即收到失败回复，不等合并窗口
+        self._bet(4, "大100")
+
+        self.assertTrue(self._wait_for(lambda: self._texts("投注成功")))
+        confirmations = self._texts("投注成功")
+        self.assertEqual(len(confirmations), 1)
+        self.assertIn("(3 人)", confirmations[0])
+        for user_id in (1, 2, 3):
+            self.assertIn(f"玩家{user_id}", confirmations[0])
+        self.assertIn("余额 750 金币", confirmations[0])
+        failures = [index for index, (method, data) in enumerate(self.sent)
+                    if method == "sendMessage" and data.get("reply_to_message_id") == 104]
+        self.assertEqual(len(failures), 1)
+        self.assertLess(failures[0], [data.get("text") for _, data in self.sent].index(confirmations[0]))
+
+        # 停止倒计时，等出站队列发完后结束本局统计：计数与发给该群组的请求数相同
+        self.bot.GROUP_MAILBOXES.cancel_timers(self.chat_id)
+        self.assertTrue(self._wait_for(lambda: self.bot.GROUP_MAILBOXES.get_stats()['tasks'] == 0
+                                       and self.bot.TELEGRAM_OUTBOX.get_stats()['queued'] == 0
+                                       and self.bot.TELEGRAM_OUTBOX.get_stats()['in_flight'] == 0))
+        sent_to_group = sum(1 for _, data in self.sent if data.get("chat_id") == self.chat_id)
+        self.assertEqual(self.bot.ROUND_MESSAGES.finish_round(self.chat_id), sent_to_group)
+        self.assertEqual(self.bot.ROUND_MESSAGES.get_stats()['rounds'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
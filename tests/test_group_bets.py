@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from support import load_bot
+
+
+class BetSlipTest(unittest.TestCase):
+    """投注单全部成功或全部不生效，两种存储后端行为相同"""
+
+    chat_id = -100
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _data_managers(self):
+        yield self.bot.DataManager(os.path.join(self.directory.name, "user_data.snap"))
+        yield self.bot.SqliteDataManager(os.path.join(self.directory.name, "user_data.db"))
+
+    def _start(self, data_manager):
+        data_manager.add_user(1, "玩家1")
+        data_manager.update_balance(1, 3000)
+        self.assertIsNotNone(data_manager.start_group_game(self.chat_id))
+        self.assertTrue(data_manager.add_bet_to_group_game(self.chat_id, 1, "big", None, 500))
+
+    def _assert_unchanged(self, data_manager, result):
+        self.assertEqual(result, (2500, False))
+        self.assertEqual(data_manager.get_user(1)['balance'], 2500)
+        self.assertEqual(data_manager.get_user(1)['total_bets'], 500)
+        self.assertEqual(data_manager.get_group_game(self.chat_id)['bets'],
+                         {'1': [{'bet_type': 'big', 'bet_value': None, 'amount': 500}]})
+
+    def test_insufficient_balance_rejects_whole_slip(self):
+        for data_manager in self._data_managers():
+            with self.subTest(backend=type(data_manager).__name__):
+                self._start(data_manager)
+                # 前两注余额足够，加上最后一注超出余额
+                result = data_manager.add_bets_to_group_game(
+                    self.chat_id, 1, [("small", None, 1000), ("odd", None, 1000), ("triple", "any", 1000)])
+                self._assert_unchanged(data_manager, result)
+
+    def test_invalid_leg_rejects_whole_slip(self):
+        for data_manager in self._data_managers():
+            with self.subTest(backend=type(data_manager).__name__):
+                self._start(data_manager)
+                # 负数金额会抵消其它投注的扣款
+                result = data_manager.add_bets_to_group_game(
+                    self.chat_id, 1, [("small", None, 1000), ("odd", None, -900)])
+                self._assert_unchanged(data_manager, result)
+                result = data_manager.add_bets_to_group_game(
+                    self.chat_id, 1, [("small", None, 1000), ("unknown", None, 100)])
+                self._assert_unchanged(data_manager, result)
+
+    def test_whole_slip_is_placed(self):
+        for data_manager in self._data_managers():
+            with self.subTest(backend=type(data_manager).__name__):
+                self._start(data_manager)
+                result = data_manager.add_bets_to_group_game(
+                    self.chat_id, 1, [("small", None, 1000), ("sum", 10, 1500)])
+                self.assertEqual(result, (0, True))
+                self.assertEqual(data_manager.get_user(1)['total_bets'], 3000)
+                self.assertEqual([bet['amount'] for bet in data_manager.get_group_game(self.chat_id)['bets']['1']],
+                                 [500, 1000, 1500])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import time
+import unittest
+
+from support import FakeResponse, load_bot
+
+
+class GroupCountdownTest(unittest.TestCase):
+    """群组倒计时走到截止后进入选择摇骰子玩家的流程"""
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.bot.GROUP_GAME_WAIT_TIME = 1
+        self.bot.TELEGRAM_API.rate_limiter = None
+        self.sent = []
+        self.bot.TELEGRAM_API.session.post = self._fake_post
+        self.directory = tempfile.TemporaryDirectory()
+        self.data_manager = self.bot.DataManager(os.path.join(self.directory.name, "user_data.snap"))
+
+    def tearDown(self):
+        self.bot.GROUP_MAILBOXES.cancel_timers(self.chat_id)
+        self.directory.cleanup()
+
+    chat_id = -100
+
+    def _fake_post(self, url, data=None, files=None, timeout=None):
+        method = url.rsplit("/", 1)[1]
+        self.sent.append((method, data))
+        result = {"message_id": len(self.sent)}
+        if method == "sendDice":
+            result["dice"] = {"value": 3}
+        return FakeResponse({"ok": True, "result": result})
+
+    def _wait_for(self, predicate, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.02)
+        return False
+
+    def test_countdown_expiry_selects_high_roller(self):
+        self.data_manager.add_user(1, "玩家1")
+        self.data_manager.update_balance(1, 4000)
+        balance = self.data_manager.get_user(1)['balance']
+        message = {"chat": {"id": self.chat_id}, "from": {"id": 0}}
+        self.bot.GROUP_MAILBOXES.post(self.chat_id, self.bot.handle_start_group_game, message, self.data_manager)
+        self.assertTrue(self._wait_for(
+            lambda: self.data_manager.get_group_game(self.chat_id)['state'] == self.bot.GROUP_GAME_BETTING))
+
+        bet = {"chat": {"id": self.chat_id}, "from": {"id": 1, "first_name": "玩家1"},
+               "text": "大1000", "message_id": 1}
+        self.bot.GROUP_MAILBOXES.post(self.chat_id, self.bot.handle_group_bet_message, bet, self.data_manager)
+
+        self.assertTrue(self._wait_for(
+            lambda: self.data_manager.get_group_game(self.chat_id)['state'] == self.bot.GROUP_GAME_SELECTING_ROLLER))
+        self.assertEqual(self.data_manager.get_group_game(self.chat_id)['selected_roller'], 1)
+        self.assertTrue(self._wait_for(lambda: any(
+            method == "editMessageText" and "投注时间结束" in data["text"] for method, data in self.sent)))
+        # 等待摇骰子的期限已经投递
+        self.assertEqual(self.bot.GROUP_MAILBOXES.get_stats()['pending'], 1)
+        self.assertEqual(self.data_manager.get_user(1)['balance'], balance - 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
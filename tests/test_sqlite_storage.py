@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from support import load_bot
+
+
+class SqliteStorageTest(unittest.TestCase):
+    """SQLite 后端：从 JSON 数据迁移、事务回滚后恢复内存状态"""
+
+    chat_id = -100
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.directory = tempfile.TemporaryDirectory()
+        self.data_file = os.path.join(self.directory.name, "user_data.snap")
+        self.db_file = os.path.join(self.directory.name, "user_data.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _play(self, data_manager, user_id, bet_type, amount, won, group_id=None):
+        data_manager.update_balance(user_id, -amount)
+        winnings = amount * 2 if won else 0
+        if won:
+            data_manager.update_balance(user_id, winnings)
+        data_manager.add_game_record(user_id, "dice", bet_type, None, amount, [4, 5, 6], won, winnings,
+                                     is_group_game=group_id is not None, group_id=group_id)
+
+    def test_migration_matches_json_backend(self):
+        source = self.bot.DataManager(self.data_file)
+        for user_id in (1, 2):
+            source.add_user(user_id, f"玩家{user_id}")
+            source.update_balance(user_id, 5000)
+        self._play(source, 1, "big", 300, True, group_id=self.chat_id)
+        self._play(source, 2, "small", 200, False, group_id=self.chat_id)
+        self._play(source, 1, "odd", 100, False)
+        self._play(source, 2, "even", 50, True, group_id=-200)
+        source.flush_journal()
+
+        self.bot.migrate_json_to_sqlite(self.data_file, self.db_file)
+        target = self.bot.SqliteDataManager(self.db_file)
+
+        def history(data_manager, user_id):
+            return [(r['bet_type'], r['bet_amount'], r['won'], r['winnings'], r['group_game_number'])
+                    for r in data_manager.get_user_history(user_id)]
+
+        for user_id in (1, 2):
+            for field in ('balance', 'total_bets', 'total_winnings', 'games_played'):
+                self.assertEqual(target.get_user(user_id)[field], source.get_user(user_id)[field])
+            self.assertEqual(history(target, user_id), history(source, user_id))
+        for group_id in (self.chat_id, -200):
+            self.assertEqual(target.count_group_games(group_id), source.count_group_games(group_id))
+        self.assertEqual(target.count_games(), source.count_games())
+        self.assertEqual(target.get_global_stats(), source.get_global_stats())
+
+        # 群组游戏编号接着迁移前的计数继续
+        self._play(target, 1, "big", 100, False, group_id=self.chat_id)
+        self.assertEqual(target.get_user_history(1, 1)[0]['group_game_number'], 3)
+
+    def test_rollback_restores_memory(self):
+        data_manager = self.bot.SqliteDataManager(self.db_file)
+        data_manager.add_user(1, "玩家1")
+        data_manager.update_balance(1, 5000)
+        self.assertIsNotNone(data_manager.start_group_game(self.chat_id))
+        self.assertTrue(data_manager.add_bet_to_group_game(self.chat_id, 1, "big", None, 1000))
+
+        chat_id_str = str(self.chat_id)
+        with self.assertRaises(RuntimeError):
+            with data_manager._group_lock(chat_id_str), data_manager._transaction(chat_id_str):
+                # 嵌套的事务并入外层事务，外层出错时一起回滚
+                self.assertTrue(data_manager.add_bet_to_group_game(self.chat_id, 1, "small", None, 2000))
+                data_manager.set_fixed_dice(self.chat_id, [1, 2, 3])
+                raise RuntimeError("模拟出错")
+
+        self.assertEqual(data_manager.get_user(1)['balance'], 4000)
+        group_game = data_manager.get_group_game(self.chat_id)
+        self.assertEqual(group_game['state'], self.bot.GROUP_GAME_BETTING)
+        self.assertEqual([bet['amount'] for bet in group_game['bets']['1']], [1000])
+        self.assertIsNone(data_manager.get_fixed_dice(self.chat_id))
+
+        # 回滚后的内存状态与数据库一致，之后的写入不会带上回滚掉的投注
+        self.assertTrue(data_manager.add_bet_to_group_game(self.chat_id, 1, "odd", None, 500))
+        reloaded = self.bot.SqliteDataManager(self.db_file)
+        self.assertEqual([bet['amount'] for bet in reloaded.get_group_game(self.chat_id)['bets']['1']],
+                         [1000, 500])
+        self.assertEqual(reloaded.get_user(1)['balance'], 3500)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+import unittest
+
+from support import load_bot
+
+
+class JsonStorageTest(unittest.TestCase):
+    """快照+日志存储：崩溃后重放日志、快照损坏时回退到上一代、读取旧版 JSON 数据文件"""
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.directory = tempfile.TemporaryDirectory()
+        self.data_file = os.path.join(self.directory.name, "user_data.snap")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _play(self, data_manager, user_id, amount, group_id=None):
+        data_manager.update_balance(user_id, -amount)
+        data_manager.add_game_record(user_id, "dice", "big", None, amount, [4, 5, 6], False, 0,
+                                     is_group_game=group_id is not None, group_id=group_id)
+
+    def test_crash_replays_journal(self):
+        data_manager = self.bot.DataManager(self.data_file)
+        data_manager.add_user(1, "玩家1")
+        data_manager.update_balance(1, 5000)
+        self._play(data_manager, 1, 300, group_id=-100)
+        self._play(data_manager, 1, 200, group_id=-100)
+        data_manager.flush_journal()
+        # 没有保存快照就退出，崩溃时最后一条记录只写了一半
+        with open(data_manager.journal_file, 'ab') as f:
+            f.write(b'{"op": "user", "id": "1", "da')
+
+        recovered = self.bot.DataManager(self.data_file)
+        self.assertFalse(os.path.exists(self.data_file))
+        self.assertEqual(recovered.get_user(1)['balance'], 4500)
+        self.assertEqual(recovered.get_user(1)['games_played'], 2)
+        self.assertEqual([record['bet_amount'] for record in recovered.get_user_history(1)], [200, 300])
+        self.assertEqual(recovered.count_group_games(-100), 2)
+        self.assertEqual(recovered.get_global_stats()['total_bets'], 500)
+
+    def test_corrupt_snapshot_falls_back_to_previous_generation(self):
+        data_manager = self.bot.DataManager(self.data_file)
+        data_manager.add_user(1, "玩家1")
+        data_manager.update_balance(1, 5000)
+        self._play(data_manager, 1, 300, group_id=-100)
+        data_manager.save_data()
+        self._play(data_manager, 1, 200, group_id=-100)
+        data_manager.save_data()
+        self._play(data_manager, 1, 100, group_id=-100)
+        data_manager.flush_journal()
+
+        generations = self.bot._numbered_files(self.data_file)
+        self.assertEqual(len(generations), 2)
+        # 最新一代快照损坏：末尾的校验记录被截断
+        newest = generations[-1][1]
+        with open(newest, 'r+b') as f:
+            f.truncate(os.path.getsize(newest) - 10)
+
+        with self.assertLogs(self.bot.logger, 'ERROR') as logs:
+            recovered = self.bot.DataManager(self.data_file)
+        self.assertIn(newest, logs.output[0])
+        self.assertEqual(recovered.get_user(1)['balance'], 4400)
+        self.assertEqual([record['bet_amount'] for record in recovered.get_user_history(1)], [100, 200, 300])
+        self.assertEqual(recovered.count_group_games(-100), 3)
+
+    def test_all_snapshots_corrupt_refuses_to_start(self):
+        data_manager = self.bot.DataManager(self.data_file)
+        data_manager.add_user(1, "玩家1")
+        data_manager.update_balance(1, 5000)
+        data_manager.save_data()
+
+        for _, path in self.bot._numbered_files(self.data_file):
+            with open(path, 'r+b') as f:
+                f.seek(len(self.bot.SNAPSHOT_MAGIC) + 2)
+                f.write(b'#')
+        # 不能以空数据启动
+        with self.assertRaises(RuntimeError):
+            self.bot.DataManager(self.data_file)
+
+    def test_load_legacy_json(self):
+        legacy = {
+            'users': {
+                '1': {'name': '玩家1', 'balance': 800, 'total_bets': 200, 'total_winnings': 0,
+                      'games_played': 2, 'vip_level': 0, 'banned': False,
+                      'history': [{'bet_amount': 150, 'result': [1, 2, 3]},
+                                  {'bet_amount': 50, 'result': [6, 6, 6]}]},
+                '2': {'name': '玩家2', 'balance': 300, 'total_bets': 0, 'total_winnings': 0,
+                      'games_played': 0, 'vip_level': 0, 'banned': False, 'history': []}
+            },
+            'game_history': [
+                {'user_id': '1', 'is_group_game': True, 'group_id': -100, 'bet_amount': 150},
+                {'user_id': '1', 'is_group_game': True, 'group_id': -100, 'bet_amount': 50},
+                {'user_id': '1', 'is_group_game': False, 'bet_amount': 10}
+            ],
+            'chat_messages': [],
+            'global_stats': {'total_games': 3, 'total_bets': 210, 'total_winnings': 0,
+                             'biggest_win': {'user_id': None, 'amount': 0, 'date': None}}
+        }
+        with open(os.path.join(self.directory.name, "user_data.json"), 'w', encoding='utf-8') as f:
+            json.dump(legacy, f, ensure_ascii=False, indent=2)
+
+        data_manager = self.bot.DataManager(self.data_file)
+        self.assertEqual(data_manager.get_user(1)['balance'], 800)
+        self.assertEqual(data_manager.get_user(2)['balance'], 300)
+        self.assertNotIn('history', data_manager.get_user(1))
+        self.assertEqual([record['bet_amount'] for record in data_manager.get_user_history(1)], [50, 150])
+        self.assertEqual(data_manager.count_games(), 3)
+        # 旧版文件没有计数器，从历史记录统计
+        self.assertEqual(data_manager.count_group_games(-100), 2)
+
+        # 保存后从新格式的快照读取，内容不变
+        data_manager.save_data()
+        reloaded = self.bot.DataManager(self.data_file)
+        self.assertEqual(reloaded.get_user(1)['balance'], 800)
+        self.assertEqual([record['bet_amount'] for record in reloaded.get_user_history(1)], [50, 150])
+        self.assertEqual(reloaded.count_group_games(-100), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
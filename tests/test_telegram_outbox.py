@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from support import FakeResponse, load_bot
+
+
+class RetryAfterTest(unittest.TestCase):
+    """收到 429 后延后重试，重试时重新上传完整的文件"""
+
+    chat_id = 100
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.uploads = []
+        self.bot.TELEGRAM_API.session.post = self._fake_post
+        self.directory = tempfile.TemporaryDirectory()
+        self.animation_path = os.path.join(self.directory.name, "animation.mp4")
+        with open(self.animation_path, "wb") as animation_file:
+            animation_file.write(os.urandom(4096))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _fake_post(self, url, data=None, files=None, timeout=None):
+        self.uploads.append(len(files["animation"][1].read()))
+        if len(self.uploads) == 1:
+            return FakeResponse({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                 "parameters": {"retry_after": 0.1}})
+        return FakeResponse({"ok": True, "result": {"message_id": 1}})
+
+    def test_retry_uploads_whole_file(self):
+        result = self.bot.send_animation(self.chat_id, self.animation_path)
+        self.assertTrue(result.get("ok"))
+        self.assertEqual(self.uploads, [4096, 4096])
+
+
+if __name__ == "__main__":
+    unittest.main()
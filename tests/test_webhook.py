@@ -0,0 +1,84 @@
+import http.client
+import json
+import threading
+import unittest
+
+from support import load_bot
+
+
+class WebhookServerTest(unittest.TestCase):
+    """webhook 服务器：密钥校验失败时拒绝，队列已满时返回 503，其余更新按顺序交给 sink"""
+
+    secret = "s3cret"
+
+    def setUp(self):
+        self.bot = load_bot()
+        self.dispatched = []
+        self.forwarding = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.server = self.bot.WebhookServer(self._sink, host="127.0.0.1", port=0,
+                                             secret_token=self.secret, max_pending=1)
+        self.server.start()
+        self.stopped = False
+
+    def tearDown(self):
+        if not self.stopped:
+            self._stop()
+
+    def _stop(self):
+        """停止服务器，等已接收的更新都交给 sink"""
+        self.release.set()
+        self.server.stop()
+        self.stopped = True
+
+    def _sink(self, update):
+        self.forwarding.set()
+        self.release.wait(5)
+        self.dispatched.append(update["update_id"])
+
+    def _post(self, update_id, token=None, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        body = json.dumps({"update_id": update_id}).encode()
+        request_headers = {"Content-Type": "application/json"}
+        if token is not None:
+            request_headers["X-Telegram-Bot-Api-Secret-Token"] = token
+        request_headers.update(headers or {})
+        try:
+            connection.request("POST", "/", body=body, headers=request_headers)
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    def test_wrong_or_missing_secret_is_rejected(self):
+        self.assertEqual(self._post(1, token="wrong"), 403)
+        self.assertEqual(self._post(2), 403)
+        self.assertEqual(self._post(3, token=""), 403)
+        self.assertEqual(self._post(4, token=self.secret), 200)
+
+        self._stop()
+        self.assertEqual(self.dispatched, [4])
+        self.assertEqual(self.server.get_stats()['rejected'], 3)
+        self.assertEqual(self.server.get_stats()['received'], 1)
+
+    def test_oversized_body_is_rejected(self):
+        self.assertEqual(self._post(1, token=self.secret,
+                                    headers={"Content-Length": str(self.bot.WEBHOOK_MAX_BODY + 1)}), 413)
+        self.assertEqual(self._post(2, token=self.secret), 200)
+        self._stop()
+        self.assertEqual(self.dispatched, [2])
+
+    def test_full_queue_asks_telegram_to_retry(self):
+        self.release.clear()
+        self.assertEqual(self._post(1, token=self.secret), 200)
+        # 转发线程正在处理第一条，第二条占满队列
+        self.assertTrue(self.forwarding.wait(5))
+        self.assertEqual(self._post(2, token=self.secret), 200)
+        self.assertEqual(self._post(3, token=self.secret), 503)
+
+        self._stop()
+        self.assertEqual(self.dispatched, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()